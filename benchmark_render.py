@@ -0,0 +1,308 @@
+'''
+
+Benchmark of render_shapenet_obj.py: renders the example chair and table, and synthetic
+meshes with a controlled number of faces, across engines, resolutions, numbers of views
+and quality presets. Every configuration runs in its own process, as a real run does,
+and the views per second, the time to the first image and the peak RSS are reported as
+JSON. The results can be stored as a baseline and compared with later runs:
+
+python benchmark_render.py --save_baseline benchmark_baseline.json
+python benchmark_render.py --baseline benchmark_baseline.json --tolerance 0.15
+
+'''
+
+import argparse
+import itertools
+import json
+import math
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+import render_stats
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+EXAMPLE_MESHES = [
+    os.path.join(SCRIPT_DIR, 'input_examples', 'chair', 'a682c4bf731e3af2ca6a405498436716.obj'),
+    os.path.join(SCRIPT_DIR, 'input_examples', 'table', '8106aef3eb88f9e4578defb131c3ea1d.obj'),
+]
+
+# Metrics compared with the baseline, and whether higher values are better
+METRICS = {'views_per_sec': True, 'time_to_first_image': False, 'peak_rss_mb': False}
+
+
+def parse_list(value, cast=str):
+    return [cast(v) for v in value.split(',') if v]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmarks render_shapenet_obj.py on example and synthetic meshes.')
+
+    parser.add_argument('--engines', type=str, default='CYCLES',
+                        help='comma separated render engines, e.g. CYCLES,BLENDER_EEVEE')
+
+    parser.add_argument('--resolutions', type=str, default='256',
+                        help='comma separated image resolutions')
+
+    parser.add_argument('--views', type=str, default='4',
+                        help='comma separated numbers of views per model')
+
+    parser.add_argument('--qualities', type=str, default='draft',
+                        help='comma separated quality presets (draft, preview, final, or default for the Blender defaults). Only used with CYCLES.')
+
+    parser.add_argument('--write_behind', type=str, default='0',
+                        help='comma separated numbers of write-behind threads, e.g. 0,4 to compare the images written by Blender with the asynchronous writer')
+
+    parser.add_argument('--face_counts', type=str, default='1000,10000,100000',
+                        help='comma separated face counts of the synthetic meshes, empty for none')
+
+    parser.add_argument('--no_examples', action="store_true",
+                        help='if set, do not render the chair and table of input_examples')
+
+    parser.add_argument('--render_args', type=str, default='',
+                        help='extra arguments passed to every render, e.g. "--batch_views --loader numpy"')
+
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='number of runs of every configuration, the median is reported')
+
+    parser.add_argument('--work_dir', type=str, default='./benchmark_work',
+                        help='folder for the synthetic meshes and the rendered images')
+
+    parser.add_argument('--output', type=str, default=None,
+                        help='path of the JSON results, printed if not set')
+
+    parser.add_argument('--baseline', type=str, default=None,
+                        help='JSON results of a previous run to compare with. The exit code is 1 if a metric regressed.')
+
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='relative change of a metric, with respect to the baseline, reported as a regression')
+
+    parser.add_argument('--save_baseline', type=str, default=None,
+                        help='path where the results are stored as the new baseline')
+
+    args = parser.parse_args()
+    return args
+
+
+def write_synthetic_mesh(path, num_faces):
+    '''
+    Writes a torus with about num_faces triangles, fitting the unit box like the
+    normalized ShapeNet models, together with a single material.
+    '''
+    rings = max(3, int(round(math.sqrt(num_faces / 4.0))))
+    segments = max(3, int(round(num_faces / (2.0 * rings))))
+    u = np.linspace(0, 2 * np.pi, rings, endpoint=False)[:, None]
+    v = np.linspace(0, 2 * np.pi, segments, endpoint=False)[None, :]
+    radius, tube = 0.35, 0.12
+    x = (radius + tube * np.cos(v)) * np.cos(u)
+    z = (radius + tube * np.cos(v)) * np.sin(u)
+    y = tube * np.sin(v) * np.ones_like(u)
+    vertices = np.stack([x, y, z], axis=-1).reshape(-1, 3)
+
+    i, j = np.meshgrid(np.arange(rings), np.arange(segments), indexing='ij')
+    a = i * segments + j
+    b = ((i + 1) % rings) * segments + j
+    c = ((i + 1) % rings) * segments + (j + 1) % segments
+    d = i * segments + (j + 1) % segments
+    faces = np.concatenate([np.stack([a, b, c], -1).reshape(-1, 3),
+                            np.stack([a, c, d], -1).reshape(-1, 3)]) + 1
+
+    name = os.path.splitext(os.path.basename(path))[0]
+    with open(os.path.splitext(path)[0] + '.mtl', 'w') as f:
+        f.write('newmtl synthetic\nKd 0.6 0.45 0.3\nKs 0.1 0.1 0.1\nd 1\n')
+    with open(path, 'w') as f:
+        f.write('mtllib {}.mtl\no {}\n'.format(name, name))
+        np.savetxt(f, vertices, fmt='v %.6f %.6f %.6f')
+        f.write('usemtl synthetic\ns 1\n')
+        np.savetxt(f, faces, fmt='f %d %d %d')
+    return len(faces)
+
+
+def benchmark_meshes(args):
+    meshes = [] if args.no_examples else list(EXAMPLE_MESHES)
+    mesh_dir = os.path.join(args.work_dir, 'meshes')
+    os.makedirs(mesh_dir, exist_ok=True)
+    for num_faces in parse_list(args.face_counts, int):
+        path = os.path.join(mesh_dir, 'synthetic_{}.obj'.format(num_faces))
+        if not os.path.exists(path):
+            write_synthetic_mesh(path, num_faces)
+        meshes.append(path)
+    return meshes
+
+
+def configurations(args):
+    for engine in parse_list(args.engines):
+        # The quality presets only exist for Cycles
+        qualities = parse_list(args.qualities) if engine == 'CYCLES' else ['default']
+        for resolution, views, quality, write_behind in itertools.product(
+                parse_list(args.resolutions, int), parse_list(args.views, int), qualities,
+                parse_list(args.write_behind, int)):
+            yield {'engine': engine, 'resolution': resolution, 'views': views, 'quality': quality,
+                   'write_behind': write_behind}
+
+
+def count_images(folder):
+    if not os.path.isdir(folder):
+        return 0
+    return sum(1 for name in os.listdir(folder) if name.endswith('.png'))
+
+
+def run_render(args, mesh_path, config, run_dir):
+    '''
+    Renders one mesh with one configuration in a new process. The time to the first
+    image is measured by polling the output folder, the peak RSS of the process is
+    taken from its resource usage.
+    '''
+    if os.path.exists(run_dir):
+        shutil.rmtree(run_dir)
+    os.makedirs(run_dir)
+    stats_log = os.path.join(run_dir, 'render_stats.jsonl')
+    cmd = [sys.executable, os.path.join(SCRIPT_DIR, 'render_shapenet_obj.py'),
+           '--obj_path', mesh_path,
+           '--output_folder', run_dir,
+           '--engine', config['engine'],
+           '--resolution', str(config['resolution']),
+           '--views', str(config['views']),
+           '--stats_log', stats_log,
+           '--force']
+    if config['quality'] != 'default':
+        cmd += ['--quality', config['quality']]
+    if config.get('write_behind'):
+        cmd += ['--write_behind', str(config['write_behind'])]
+    cmd += args.render_args.split()
+
+    image_folder = os.path.join(run_dir, os.path.splitext(os.path.basename(mesh_path))[0])
+    with open(os.path.join(run_dir, 'render.log'), 'w') as log:
+        start = time.time()
+        process = subprocess.Popen(cmd, stdout=log, stderr=subprocess.STDOUT, cwd=SCRIPT_DIR)
+        first_image = None
+        while True:
+            pid, status, usage = os.wait4(process.pid, os.WNOHANG)
+            if first_image is None and count_images(image_folder) > 0:
+                first_image = time.time() - start
+            if pid != 0:
+                break
+            time.sleep(0.05)
+        wall = time.time() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+
+    if process.returncode != 0 or not os.path.exists(stats_log):
+        return {'error': 'render failed with exit code {}, see {}'.format(
+            process.returncode, os.path.join(run_dir, 'render.log'))}
+    records = render_stats.read_records(stats_log)
+    model = [r for r in records if r.get('type') == 'model' and r.get('status') == 'done']
+    if not model:
+        return {'error': 'no model rendered, see {}'.format(os.path.join(run_dir, 'render.log'))}
+    model = model[-1]
+    # Blender writes the images inside the render stage, the asynchronous writer after it
+    render_seconds = sum(model['stages'].get(name, 0.0) for name in ['render', 'readback', 'write_wait'])
+    return {
+        'views_per_sec': model['views'] / render_seconds if render_seconds > 0 else 0.0,
+        'wall_views_per_sec': model['views'] / wall,
+        'time_to_first_image': first_image if first_image is not None else wall,
+        'wall_seconds': wall,
+        # ru_maxrss is in kilobytes on Linux
+        'peak_rss_mb': usage.ru_maxrss / 2**10,
+        'faces': model['faces'],
+        'stages': model['stages'],
+    }
+
+
+def run_key(result):
+    key = '{mesh}|{engine}|{resolution}|{views}|{quality}'.format(**result)
+    # Keys of the baselines from before --write_behind are unchanged
+    if result.get('write_behind'):
+        key += '|write_behind={}'.format(result['write_behind'])
+    return key
+
+
+def median_result(runs):
+    result = dict(runs[-1])
+    for name in ['views_per_sec', 'wall_views_per_sec', 'time_to_first_image', 'wall_seconds', 'peak_rss_mb']:
+        result[name] = statistics.median(r[name] for r in runs)
+    return result
+
+
+def compare(results, baseline, tolerance):
+    '''
+    Returns the metrics which are worse than in the baseline by more than tolerance,
+    relative to the baseline value.
+    '''
+    baseline_runs = {run_key(r): r for r in baseline['results'] if 'error' not in r}
+    regressions = []
+    for result in results:
+        old = baseline_runs.get(run_key(result))
+        if old is None or 'error' in result:
+            continue
+        for name, higher_is_better in METRICS.items():
+            if not old.get(name):
+                continue
+            change = (result[name] - old[name]) / old[name]
+            if (higher_is_better and change < -tolerance) or (not higher_is_better and change > tolerance):
+                regressions.append({'run': run_key(result), 'metric': name,
+                                    'baseline': old[name], 'value': result[name], 'change': change})
+    return regressions
+
+
+def main():
+    args = parse_args()
+    meshes = benchmark_meshes(args)
+    results = []
+    for mesh_path, config in itertools.product(meshes, list(configurations(args))):
+        mesh = os.path.splitext(os.path.basename(mesh_path))[0]
+        runs = []
+        for r in range(args.repeat):
+            run = run_render(args, mesh_path, config, os.path.join(args.work_dir, 'run'))
+            if 'error' in run:
+                runs = [run]
+                break
+            runs.append(run)
+        result = dict(config, mesh=mesh)
+        result.update(runs[0] if 'error' in runs[0] else median_result(runs))
+        results.append(result)
+        if 'error' in result:
+            print('{}: {}'.format(run_key(result), result['error']), file=sys.stderr)
+        else:
+            print('{}: {:.2f} views/s, first image after {:.2f}s, peak RSS {:.0f} MB'.format(
+                run_key(result), result['views_per_sec'], result['time_to_first_image'], result['peak_rss_mb']),
+                file=sys.stderr)
+
+    report = {
+        'time': time.time(),
+        'python': sys.version.split()[0],
+        'cpu_count': os.cpu_count(),
+        'render_args': args.render_args,
+        'results': results,
+    }
+    exit_code = 0
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        report['regressions'] = compare(results, baseline, args.tolerance)
+        for r in report['regressions']:
+            print('REGRESSION {}: {} {:.3f} -> {:.3f} ({:+.0%})'.format(
+                r['run'], r['metric'], r['baseline'], r['value'], r['change']), file=sys.stderr)
+        exit_code = 1 if report['regressions'] else 0
+    if any('error' in r for r in results):
+        exit_code = 1
+
+    output = json.dumps(report, indent=2)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+    if args.save_baseline is not None:
+        with open(args.save_baseline, 'w') as f:
+            f.write(output)
+    sys.exit(exit_code)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,355 @@
+'''
+
+Static, paginated HTML gallery of all the rendered models. Every model gets a card
+with a strip of its views, its descriptions from the captions CSV and its category;
+the models are listed in pages of all the models and in pages of each category, the
+category filters, linked from every page.
+
+The strips of a page are tiled in a few JPEG sprite sheets, each card showing its part
+of a sheet as a CSS background, and a sheet is only loaded once one of its cards comes
+near the viewport, so a page costs a handful of requests whatever the number of views.
+The strips are made of the 64 pixel thumbnails of thumbnail_cache.py.
+
+The gallery is built incrementally: the models keep their place in the pages, new
+models are added at the end of their listings, and only the pages whose models, views
+or descriptions changed are written again. The navigation (categories and page
+numbers) is in gallery.js, so that adding pages does not change the existing ones.
+
+python build_gallery.py --renders_folder output_renders/ --output_folder gallery/
+
+'''
+
+import argparse
+import hashlib
+import html
+import io
+import json
+import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+from caption_store import CaptionStore
+from image_io import write_file
+from plot_renderings import find_model_folders
+from thumbnail_cache import ThumbnailCache, DEFAULT_CACHE_DIR, DEFAULT_BUDGET_MB
+
+STATE_NAME = 'gallery_state.json'
+
+ALL = 'all'
+UNCATEGORIZED = 'uncategorized'
+
+# Strips tiled in one sprite sheet
+SHEET_MODELS = 25
+
+BACKGROUND = (17, 17, 17)
+
+STYLE = '''
+body { background: #111; color: #ddd; font-family: sans-serif; margin: 0 16px; }
+nav { margin: 12px 0; line-height: 2; }
+nav a { color: #9cf; margin-right: 10px; text-decoration: none; }
+nav a.current { color: #fff; font-weight: bold; }
+main { display: flex; flex-wrap: wrap; gap: 12px; }
+.card { background: #1b1b1b; padding: 8px; }
+.strip { background-color: #111; background-repeat: no-repeat; }
+.card h3 { font-size: 12px; font-family: monospace; margin: 6px 0 2px; }
+.card .category { font-size: 12px; color: #999; margin: 0; }
+.card ul { font-size: 13px; margin: 4px 0; padding-left: 18px; max-height: 90px; overflow-y: auto; }
+'''
+
+SCRIPT = '''
+(function () {
+  var body = document.body;
+  var listing = body.dataset.listing, page = parseInt(body.dataset.page, 10);
+  function pageUrl(name, number) {
+    return '../' + name + '/page_' + ('000' + number).slice(-4) + '.html';
+  }
+  function link(text, href, current) {
+    return '<a href="' + href + '"' + (current ? ' class="current"' : '') + '>' + text + '</a>';
+  }
+  var filters = GALLERY.listings.map(function (l) {
+    return link(l.label + ' (' + l.models + ')', pageUrl(l.name, 1), l.name === listing);
+  });
+  document.getElementById('filters').innerHTML = filters.join('');
+  var current = GALLERY.listings.filter(function (l) { return l.name === listing; })[0];
+  var pages = [];
+  if (current) {
+    if (page > 1) pages.push(link('&laquo; previous', pageUrl(listing, page - 1)));
+    for (var k = 1; k <= current.pages; k++) {
+      if (k === 1 || k === current.pages || Math.abs(k - page) <= 3) pages.push(link(k, pageUrl(listing, k), k === page));
+      else if (Math.abs(k - page) === 4) pages.push('&hellip;');
+    }
+    if (page < current.pages) pages.push(link('next &raquo;', pageUrl(listing, page + 1)));
+  }
+  document.querySelectorAll('.pages').forEach(function (nav) { nav.innerHTML = pages.join(''); });
+
+  // The sprite sheets are loaded once a card using them comes near the viewport
+  var strips = document.querySelectorAll('.strip');
+  function load(strip) { strip.style.backgroundImage = 'url(' + strip.dataset.sheet + ')'; }
+  if (!('IntersectionObserver' in window)) { strips.forEach(load); return; }
+  var observer = new IntersectionObserver(function (entries) {
+    entries.forEach(function (entry) {
+      if (entry.isIntersecting) { load(entry.target); observer.unobserve(entry.target); }
+    });
+  }, { rootMargin: '600px 0px' });
+  strips.forEach(function (strip) { observer.observe(strip); });
+})();
+'''
+
+
+def listing_name(category):
+    return re.sub(r'[^a-z0-9_-]+', '_', category.lower()).strip('_') or UNCATEGORIZED
+
+
+def strip_views(views, count):
+    # count views evenly spaced around the model
+    count = min(count, len(views))
+    return [views[i * len(views) // count] for i in range(count)]
+
+
+def model_signature(views, descriptions, category):
+    sha = hashlib.sha1()
+    for view in views:
+        st = os.stat(view)
+        sha.update('{}|{}|{}\n'.format(view, st.st_mtime_ns, st.st_size).encode('utf-8'))
+    sha.update(json.dumps([descriptions, category]).encode('utf-8'))
+    return sha.hexdigest()
+
+
+def read_models(renders_folder, captions, num_views):
+    '''
+    Returns modelId -> strip views, descriptions, category and signature of every
+    rendered model.
+    '''
+    models = {}
+    for model_id, folder in find_model_folders(renders_folder).items():
+        views = sorted(name for name in os.listdir(folder) if name.startswith(model_id + '_r_') and name.endswith('.png'))
+        views = strip_views([os.path.join(folder, name) for name in views], num_views)
+        descriptions = captions.descriptions(model_id) if captions is not None else []
+        category = (captions.category(model_id) if captions is not None else None) or UNCATEGORIZED
+        models[model_id] = {
+            'views': views,
+            'descriptions': descriptions,
+            'category': category,
+            'signature': model_signature(views, descriptions, category),
+        }
+    return models
+
+
+def update_order(order, model_ids):
+    # The models keep their place, the removed ones are dropped and the new ones appended
+    present = set(model_ids)
+    kept = [model_id for model_id in order if model_id in present]
+    known = set(kept)
+    return kept + sorted(model_id for model_id in model_ids if model_id not in known)
+
+
+def load_state(path, settings):
+    try:
+        with open(path) as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        state = None
+    if state is None or state.get('settings') != settings:
+        # Pages written with other settings are all written again
+        state = {'settings': settings, 'listings': {}, 'pages': {}}
+    return state
+
+
+def page_path(output_folder, listing, number):
+    return os.path.join(output_folder, listing, 'page_{:04d}.html'.format(number))
+
+
+def sheet_name(number, k):
+    return 'page_{:04d}_{}.jpg'.format(number, k)
+
+
+def build_sheet(views_of_models, thumbnails, size, num_views):
+    # One row of thumbnails per model, each centered in a size x size cell
+    sheet = Image.new('RGB', (num_views * size, len(views_of_models) * size), BACKGROUND)
+    for row, views in enumerate(views_of_models):
+        for col, view in enumerate(views):
+            image = thumbnails.open(view, size).convert('RGBA')
+            if max(image.size) > size:
+                scale = size / max(image.size)
+                image = image.resize((max(1, round(image.size[0] * scale)), max(1, round(image.size[1] * scale))), Image.LANCZOS)
+            x = col * size + (size - image.size[0]) // 2
+            y = row * size + (size - image.size[1]) // 2
+            sheet.paste(image, (x, y), image)
+    return sheet
+
+
+def render_card(model_id, model, sheet, row, size, num_views):
+    width = num_views * size
+    descriptions = ''.join('<li>{}</li>'.format(html.escape(d)) for d in model['descriptions'])
+    return (
+        '<div class="card" style="width:{w}px">'
+        '<div class="strip" data-sheet="{sheet}" style="width:{w}px;height:{h}px;background-position:0 -{y}px"></div>'
+        '<h3>{model_id}</h3><p class="category">{category}</p><ul>{descriptions}</ul></div>\n'
+    ).format(w=width, h=size, y=row * size, sheet=html.escape(sheet), model_id=html.escape(model_id),
+             category=html.escape(model['category']), descriptions=descriptions)
+
+
+def build_page(task):
+    '''
+    Writes the sprite sheets and the HTML of one page.
+    '''
+    output_folder, listing, label, number, model_ids, models, signature, thumbnails, args = task
+    folder = os.path.join(output_folder, listing)
+    os.makedirs(folder, exist_ok=True)
+    cards = []
+    for k in range(0, len(model_ids), SHEET_MODELS):
+        chunk = model_ids[k:k + SHEET_MODELS]
+        sheet = build_sheet([models[m]['views'] for m in chunk], thumbnails, args.thumbnail_size, args.strip_views)
+        buffer = io.BytesIO()
+        sheet.save(buffer, 'JPEG', quality=args.jpeg_quality)
+        name = sheet_name(number, k // SHEET_MODELS)
+        write_file(os.path.join(folder, name), buffer.getvalue())
+        # The signature of the page in the URL, so that browsers do not show a stale sheet
+        url = '{}?v={}'.format(name, signature[:12])
+        for row, model_id in enumerate(chunk):
+            cards.append(render_card(model_id, models[model_id], url, row, args.thumbnail_size, args.strip_views))
+
+    title = html.escape('{}, page {}'.format(label, number))
+    page = (
+        '<!DOCTYPE html>\n<html>\n<head>\n<meta charset="utf-8">\n<title>{title}</title>\n'
+        '<link rel="stylesheet" href="../gallery.css">\n</head>\n'
+        '<body data-listing="{listing}" data-page="{number}">\n'
+        '<nav id="filters"></nav>\n<nav class="pages"></nav>\n<main>\n{cards}</main>\n<nav class="pages"></nav>\n'
+        '<script src="../gallery.js"></script>\n</body>\n</html>\n'
+    ).format(title=title, listing=listing, number=number, cards=''.join(cards))
+    write_file(page_path(output_folder, listing, number), page.encode('utf-8'))
+
+
+def remove_page(output_folder, listing, number):
+    folder = os.path.join(output_folder, listing)
+    prefix = 'page_{:04d}'.format(number)
+    if not os.path.isdir(folder):
+        return
+    for name in os.listdir(folder):
+        if name == prefix + '.html' or name.startswith(prefix + '_'):
+            os.remove(os.path.join(folder, name))
+
+
+def write_site_files(output_folder, listings):
+    # The navigation data and code, shared by all the pages and written on every run
+    data = {'listings': [{'name': name, 'label': label, 'pages': pages, 'models': count}
+                         for name, label, pages, count in listings]}
+    script = 'var GALLERY = {};\n{}'.format(json.dumps(data), SCRIPT)
+    write_file(os.path.join(output_folder, 'gallery.js'), script.encode('utf-8'))
+    write_file(os.path.join(output_folder, 'gallery.css'), STYLE.encode('utf-8'))
+    index = ('<!DOCTYPE html>\n<html>\n<head>\n<meta charset="utf-8">\n'
+             '<meta http-equiv="refresh" content="0; url={0}/page_0001.html">\n</head>\n'
+             '<body><a href="{0}/page_0001.html">gallery</a></body>\n</html>\n').format(ALL)
+    write_file(os.path.join(output_folder, 'index.html'), index.encode('utf-8'))
+
+
+def build_gallery(args):
+    start = time.time()
+    captions = CaptionStore(args.csv_path) if args.csv_path is not None and os.path.exists(args.csv_path) else None
+    models = read_models(args.renders_folder, captions, args.strip_views)
+    if captions is not None:
+        captions.close()
+
+    os.makedirs(args.output_folder, exist_ok=True)
+    state_path = os.path.join(args.output_folder, STATE_NAME)
+    settings = {'page_size': args.page_size, 'strip_views': args.strip_views,
+                'thumbnail_size': args.thumbnail_size, 'jpeg_quality': args.jpeg_quality}
+    state = load_state(state_path, settings)
+    if args.force:
+        state['pages'] = {}
+
+    # The listing of all the models, then one per category
+    labels = {ALL: 'All'}
+    members = {ALL: list(models)}
+    for model_id, model in models.items():
+        name = listing_name(model['category'])
+        labels.setdefault(name, model['category'])
+        members.setdefault(name, []).append(model_id)
+    names = [ALL] + sorted(name for name in members if name != ALL)
+
+    thumbnails = ThumbnailCache(args.thumbnail_cache, args.thumbnail_budget)
+    tasks, pages, listings = [], {}, []
+    for name in names:
+        order = update_order(state['listings'].get(name, []), members[name])
+        state['listings'][name] = order
+        chunks = [order[k:k + args.page_size] for k in range(0, len(order), args.page_size)]
+        for number, model_ids in enumerate(chunks, 1):
+            key = '{}/{}'.format(name, number)
+            signature = hashlib.sha1('\n'.join('{} {}'.format(m, models[m]['signature']) for m in model_ids)
+                                     .encode('utf-8')).hexdigest()
+            pages[key] = signature
+            if state['pages'].get(key) != signature or not os.path.exists(page_path(args.output_folder, name, number)):
+                tasks.append((args.output_folder, name, labels[name], number, model_ids, models, signature, thumbnails, args))
+        listings.append((name, labels[name], len(chunks), len(order)))
+
+    # Pages of listings which got shorter, or of categories without models any more
+    for key in state['pages']:
+        if key not in pages:
+            name, number = key.rsplit('/', 1)
+            remove_page(args.output_folder, name, int(number))
+    for name in list(state['listings']):
+        if name not in members:
+            del state['listings'][name]
+
+    with ThreadPoolExecutor(args.threads) as pool:
+        for _ in pool.map(build_page, tasks):
+            pass
+    write_site_files(args.output_folder, listings)
+    state['pages'] = pages
+    write_file(state_path, json.dumps(state).encode('utf-8'))
+
+    elapsed = time.time() - start
+    print('{} models in {} listings, {} of {} pages written in {:.2f}s'.format(
+        len(models), len(listings), len(tasks), len(pages), elapsed))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Builds a static HTML gallery of all the rendered models.')
+
+    parser.add_argument('--renders_folder', type=str, default='output_renders/',
+                        help='path to folder with renderings')
+
+    parser.add_argument('--csv_path', type=str, default='input_examples/captions.tablechair.csv',
+                        help='path to CSV file with textual descriptions')
+
+    parser.add_argument('--output_folder', type=str, default='output_gallery/',
+                        help='folder of the gallery, open its index.html in a browser')
+
+    parser.add_argument('--page_size', type=int, default=200,
+                        help='number of models per page')
+
+    parser.add_argument('--strip_views', type=int, default=8,
+                        help='number of views in the strip of a model, evenly spaced around it')
+
+    parser.add_argument('--thumbnail_size', type=int, default=64,
+                        help='size of the views in the strips, in pixels')
+
+    parser.add_argument('--jpeg_quality', type=int, default=85,
+                        help='JPEG quality of the sprite sheets')
+
+    parser.add_argument('--thumbnail_cache', type=str, default=DEFAULT_CACHE_DIR,
+                        help='folder of the thumbnails of the views')
+
+    parser.add_argument('--thumbnail_budget', type=int, default=DEFAULT_BUDGET_MB,
+                        help='size of the thumbnail cache in MB, the least recently used thumbnails are removed beyond it')
+
+    parser.add_argument('--threads', type=int, default=8,
+                        help='number of threads writing the pages')
+
+    parser.add_argument('--force', action="store_true",
+                        help='if set, write again all the pages')
+
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    args = parse_args()
+    build_gallery(args)
+
+
+if __name__ == '__main__':
+    main()
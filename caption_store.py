@@ -0,0 +1,299 @@
+'''
+
+Indexed store of the Text2Shape captions, shared by the scripts reading the captions
+CSV. The CSV is parsed once into a compact binary index, written next to it as
+<csv>.idx, which is memory-mapped instead of parsed again: the descriptions of a
+model are found in O(1) through an open-addressing hash table of the modelIds, and
+those of a category through a table of their rows.
+
+The index records the size, modification time and SHA-1 of the CSV. It is rebuilt
+when the content of the CSV changes, and only its header is updated when the CSV was
+touched without being changed. When the folder of the CSV can not be written, e.g. a
+read-only dataset mount, the index goes to a per-user cache folder instead.
+
+'''
+
+import csv
+import hashlib
+import mmap
+import os
+import struct
+import threading
+import zlib
+
+import numpy as np
+
+MAGIC = b'T2SCAPIX'
+INDEX_VERSION = 1
+
+# magic, version, CSV size, CSV mtime, CSV SHA-1, modelId width, categories, models, rows, hash table size, text size
+HEADER = struct.Struct('<8sIQq20sIIIIIQ')
+
+CATEGORY_WIDTH = 32
+
+# Indexes of the CSV files in read-only folders, named by the hash of the path of the CSV
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'text2shape_captions')
+
+ROW_DTYPE = np.dtype([('offset', '<u8'), ('length', '<u4')])
+RANGE_DTYPE = np.dtype([('start', '<u4'), ('count', '<u4')])
+
+
+def model_dtype(id_width):
+    return np.dtype([('model_id', 'S{}'.format(id_width)), ('category', '<u2'), ('start', '<u4'), ('count', '<u4')])
+
+
+def default_index_path(csv_path):
+    return csv_path + '.idx'
+
+
+def fallback_index_path(csv_path):
+    digest = hashlib.sha1(os.path.abspath(csv_path).encode('utf-8')).hexdigest()
+    return os.path.join(CACHE_DIR, '{}_{}.idx'.format(os.path.basename(csv_path), digest[:16]))
+
+
+def file_sha1(path):
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(2**20), b''):
+            sha.update(chunk)
+    return sha.digest()
+
+
+def _align(offset):
+    return (offset + 7) // 8 * 8
+
+
+def _section_layout(id_width, num_categories, num_models, num_rows, capacity):
+    # (name, dtype, count) of the sections following the header, each aligned to 8 bytes
+    return [
+        ('categories', np.dtype('S{}'.format(CATEGORY_WIDTH)), num_categories),
+        ('category_ranges', RANGE_DTYPE, num_categories),
+        ('category_rows', np.dtype('<u4'), num_rows),
+        ('models', model_dtype(id_width), num_models),
+        ('model_rows', np.dtype('<u4'), num_rows),
+        ('table', np.dtype('<u4'), capacity),
+        ('rows', ROW_DTYPE, num_rows),
+    ]
+
+
+def _slot(model_id, capacity):
+    return zlib.crc32(model_id) & (capacity - 1)
+
+
+def build_index(csv_path, index_path, digest=None):
+    '''
+    Parses the CSV and writes its index to index_path.
+    '''
+    st = os.stat(csv_path)
+    digest = digest or file_sha1(csv_path)
+    model_ids, categories, descriptions = [], [], []
+    with open(csv_path, newline='') as csvfile:
+        reader = csv.DictReader(csvfile)
+        for row in reader:
+            model_ids.append(row['modelId'].encode('utf-8'))
+            categories.append(row['category'])
+            descriptions.append(row['description'].encode('utf-8'))
+    num_rows = len(model_ids)
+
+    category_names = sorted(set(categories))
+    category_index = {name: i for i, name in enumerate(category_names)}
+    row_categories = np.array([category_index[c] for c in categories], dtype=np.int64)
+    category_rows = np.argsort(row_categories, kind='stable').astype('<u4')
+    category_ranges = np.zeros(len(category_names), dtype=RANGE_DTYPE)
+    counts = np.bincount(row_categories, minlength=len(category_names))
+    category_ranges['count'] = counts
+    category_ranges['start'] = np.cumsum(counts) - counts
+
+    # Models in order of first appearance, with their rows in the order of the CSV
+    first = {}
+    for i, model_id in enumerate(model_ids):
+        first.setdefault(model_id, i)
+    model_order = {model_id: k for k, model_id in enumerate(first)}
+    row_models = np.array([model_order[m] for m in model_ids], dtype=np.int64)
+    model_rows = np.argsort(row_models, kind='stable').astype('<u4')
+    id_width = max([len(m) for m in first] or [1])
+    models = np.zeros(len(first), dtype=model_dtype(id_width))
+    models['model_id'] = list(first)
+    models['category'] = [row_categories[i] for i in first.values()]
+    counts = np.bincount(row_models, minlength=len(first))
+    models['count'] = counts
+    models['start'] = np.cumsum(counts) - counts
+
+    # Open addressing with linear probing, at most half full; a slot holds the model number + 1
+    capacity = 1 << max(1, (2 * len(first)).bit_length())
+    table = np.zeros(capacity, dtype='<u4')
+    for k, model_id in enumerate(first):
+        slot = _slot(model_id, capacity)
+        while table[slot]:
+            slot = (slot + 1) & (capacity - 1)
+        table[slot] = k + 1
+
+    rows = np.zeros(num_rows, dtype=ROW_DTYPE)
+    lengths = np.array([len(d) for d in descriptions], dtype=np.int64)
+    rows['length'] = lengths
+    rows['offset'] = np.cumsum(lengths) - lengths
+    text = b''.join(descriptions)
+
+    sections = {
+        'categories': np.array([c.encode('utf-8')[:CATEGORY_WIDTH] for c in category_names],
+                               dtype='S{}'.format(CATEGORY_WIDTH)),
+        'category_ranges': category_ranges,
+        'category_rows': category_rows,
+        'models': models,
+        'model_rows': model_rows,
+        'table': table,
+        'rows': rows,
+    }
+    header = HEADER.pack(MAGIC, INDEX_VERSION, st.st_size, st.st_mtime_ns, digest, id_width,
+                         len(category_names), len(first), num_rows, capacity, len(text))
+    # Each writer has its own temporary file, as several processes may build a missing index at once
+    tmp_path = '{}.{}.{}.tmp'.format(index_path, os.getpid(), threading.get_ident())
+    with open(tmp_path, 'wb') as f:
+        f.write(header)
+        offset = HEADER.size
+        for name, dtype, count in _section_layout(id_width, len(category_names), len(first), num_rows, capacity):
+            f.write(b'\0' * (_align(offset) - offset))
+            data = sections[name].astype(dtype).tobytes()
+            f.write(data)
+            offset = _align(offset) + len(data)
+        f.write(b'\0' * (_align(offset) - offset))
+        f.write(text)
+    try:
+        os.replace(tmp_path, index_path)
+    except OSError:
+        os.remove(tmp_path)
+        raise
+    print('caption index: {} descriptions of {} models written to {}'.format(num_rows, len(first), index_path))
+
+
+def read_header(index_path):
+    try:
+        with open(index_path, 'rb') as f:
+            values = HEADER.unpack(f.read(HEADER.size))
+    except (OSError, struct.error):
+        return None
+    if values[0] != MAGIC or values[1] != INDEX_VERSION:
+        return None
+    return values
+
+
+def ensure_index(csv_path, index_path=None):
+    '''
+    Returns the path of an index up to date with the CSV, built if missing or stale,
+    next to the CSV or, if it can not be written there, in CACHE_DIR.
+    '''
+    if index_path is not None:
+        return _ensure_index(csv_path, index_path)
+    # A missing CSV is an error, not a folder to fall back from
+    os.stat(csv_path)
+    try:
+        return _ensure_index(csv_path, default_index_path(csv_path))
+    except OSError:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        return _ensure_index(csv_path, fallback_index_path(csv_path))
+
+
+def _ensure_index(csv_path, index_path):
+    st = os.stat(csv_path)
+    header = read_header(index_path)
+    if header is not None and header[2] == st.st_size and header[3] == st.st_mtime_ns:
+        return index_path
+    digest = file_sha1(csv_path)
+    if header is not None and header[4] == digest:
+        # Same content, only the modification time changed
+        with open(index_path, 'r+b') as f:
+            f.write(HEADER.pack(*(header[:2] + (st.st_size, st.st_mtime_ns) + header[4:])))
+        return index_path
+    build_index(csv_path, index_path, digest)
+    return index_path
+
+
+class CaptionStore:
+    '''
+    Memory-mapped reader of the index of a captions CSV.
+    '''
+
+    def __init__(self, csv_path, index_path=None):
+        self.index_path = ensure_index(csv_path, index_path)
+        with open(self.index_path, 'rb') as f:
+            self.buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        header = HEADER.unpack_from(self.buffer)
+        id_width, num_categories, num_models, num_rows, capacity, text_size = header[5:]
+        offset = HEADER.size
+        for name, dtype, count in _section_layout(id_width, num_categories, num_models, num_rows, capacity):
+            offset = _align(offset)
+            setattr(self, name, np.frombuffer(self.buffer, dtype=dtype, count=count, offset=offset))
+            offset += dtype.itemsize * count
+        self.text_offset = _align(offset)
+        self.capacity = capacity
+        self.category_names = [c.decode('utf-8') for c in self.categories]
+
+    def __len__(self):
+        return len(self.models)
+
+    def __contains__(self, model_id):
+        return self._model(model_id) is not None
+
+    def _model(self, model_id):
+        key = model_id.encode('utf-8')
+        slot = _slot(key, self.capacity)
+        while True:
+            k = int(self.table[slot])
+            if k == 0:
+                return None
+            if self.models[k - 1]['model_id'] == key:
+                return self.models[k - 1]
+            slot = (slot + 1) & (self.capacity - 1)
+
+    def _texts(self, rows):
+        texts = []
+        for row in self.rows[rows]:
+            start = self.text_offset + int(row['offset'])
+            texts.append(self.buffer[start:start + int(row['length'])].decode('utf-8'))
+        return texts
+
+    def descriptions(self, model_id):
+        model = self._model(model_id)
+        if model is None:
+            return []
+        return self._texts(self.model_rows[model['start']:model['start'] + model['count']])
+
+    def category(self, model_id):
+        model = self._model(model_id)
+        return None if model is None else self.category_names[model['category']]
+
+    def model_ids(self, category=None):
+        # In order of first appearance in the CSV
+        if category is None or category.lower() == 'all':
+            return [m.decode('utf-8') for m in self.models['model_id']]
+        if category not in self.category_names:
+            return []
+        selected = self.models['category'] == self.category_names.index(category)
+        return [m.decode('utf-8') for m in self.models['model_id'][selected]]
+
+    def category_descriptions(self, category=None):
+        # In order of the CSV
+        if category is None or category.lower() == 'all':
+            return self._texts(np.arange(len(self.rows)))
+        if category not in self.category_names:
+            return []
+        start, count = self.category_ranges[self.category_names.index(category)]
+        return self._texts(self.category_rows[start:start + count])
+
+    def model_categories(self):
+        # modelId -> category, in order of first appearance in the CSV
+        return {model_id.decode('utf-8'): self.category_names[category]
+                for model_id, category in zip(self.models['model_id'], self.models['category'])}
+
+    def captions(self):
+        # modelId -> list of its descriptions
+        captions = {}
+        for model in self.models:
+            rows = self.model_rows[model['start']:model['start'] + model['count']]
+            captions[model['model_id'].decode('utf-8')] = self._texts(rows)
+        return captions
+
+    def close(self):
+        for name in ['categories', 'category_ranges', 'category_rows', 'models', 'model_rows', 'table', 'rows']:
+            setattr(self, name, None)
+        self.buffer.close()
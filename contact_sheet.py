@@ -0,0 +1,151 @@
+'''
+
+Contact sheets of the rendered views, composited directly with NumPy and PIL instead
+of a grid of matplotlib subplots. The views are decoded at a reduced size, tiled into a
+preallocated canvas with the grid of plot_renderings.py, under a band with the quoted
+descriptions, drawn once with a cached font. The sheet has the size of the matplotlib
+figure, 1200 x 1200 pixels.
+
+'''
+
+import math
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+
+SHEET_SIZE = 1200
+
+BACKGROUND = (0, 0, 0)
+TEXT_COLOR = (255, 255, 255)
+
+FONT_SIZE = 16
+# Margin around the caption band and between the cells, in pixels
+MARGIN = 12
+
+# Threads decoding the views of a sheet, PIL releases the GIL while decoding
+DECODE_THREADS = 4
+
+_decoders = None
+
+
+def grid_shape(num_images):
+    # Same grid as plot_renderings.plot_figure
+    num_rows = max(1, int(math.sqrt(num_images)))
+    num_cols = max(1, int(math.ceil(num_images / num_rows)))
+    return num_rows, num_cols
+
+
+@lru_cache(maxsize=4)
+def load_font(size=FONT_SIZE):
+    # DejaVu Sans is the font of matplotlib, the default font of PIL is the fallback
+    for name in ['DejaVuSans.ttf', 'Arial.ttf']:
+        try:
+            return ImageFont.truetype(name, size)
+        except OSError:
+            pass
+    try:
+        return ImageFont.load_default(size)
+    except TypeError:
+        return ImageFont.load_default()
+
+
+def wrap_line(text, font, width):
+    # Splits a description in lines no wider than width
+    lines = []
+    line = ''
+    for word in text.split():
+        candidate = word if not line else line + ' ' + word
+        if line and font.getlength(candidate) > width:
+            lines.append(line)
+            line = word
+        else:
+            line = candidate
+    lines.append(line)
+    return lines
+
+
+def caption_band(descriptions, width, font=None):
+    '''
+    Returns the quoted descriptions, wrapped to the width of the sheet, as an RGB array.
+    '''
+    font = font or load_font()
+    if not descriptions:
+        return np.zeros((0, width, 3), dtype=np.uint8)
+    lines = []
+    for description in descriptions:
+        lines += wrap_line('"' + description + '"', font, width - 2 * MARGIN)
+    ascent, descent = font.getmetrics()
+    line_height = ascent + descent + 2
+    band = Image.new('RGB', (width, line_height * len(lines) + 2 * MARGIN), BACKGROUND)
+    draw = ImageDraw.Draw(band)
+    for i, line in enumerate(lines):
+        draw.text((MARGIN, MARGIN + i * line_height), line, font=font, fill=TEXT_COLOR)
+    return np.asarray(band)
+
+
+def load_view(image_file, cell_size):
+    '''
+    Decodes a view at about the size of a cell and returns it as an RGBA image fitting
+    in cell_size x cell_size.
+    '''
+    image = Image.open(image_file)
+    factor = max(1, min(image.size) // cell_size)
+    if factor > 1:
+        # JPEG is decoded directly at the reduced size, other formats are box-reduced once decoded
+        image.draft(image.mode, (image.size[0] // factor, image.size[1] // factor))
+    if image.mode != 'RGBA':
+        image = image.convert('RGBA')
+    factor = max(1, min(image.size) // cell_size)
+    if factor > 1:
+        image = image.reduce(factor)
+    if max(image.size) > cell_size:
+        scale = cell_size / max(image.size)
+        image = image.resize((max(1, round(image.size[0] * scale)), max(1, round(image.size[1] * scale))), Image.BILINEAR)
+    return image
+
+
+def decoder_pool():
+    # Created on first use, so that every process of a pool gets its own
+    global _decoders
+    if _decoders is None:
+        _decoders = ThreadPoolExecutor(DECODE_THREADS)
+    return _decoders
+
+
+def compose_sheet(image_files, descriptions, size=SHEET_SIZE, thumbnails=None):
+    '''
+    Returns the contact sheet of the views, with the descriptions on top, as an RGB
+    PIL image of size x size pixels. The views given by path are read from the
+    thumbnails of a thumbnail_cache.ThumbnailCache when there is one.
+    '''
+    canvas = np.empty((size, size, 3), dtype=np.uint8)
+    canvas[:] = BACKGROUND
+    band = caption_band(descriptions, size)[:size // 2]
+    canvas[:len(band)] = band
+    sheet = Image.fromarray(canvas)
+
+    if image_files:
+        num_rows, num_cols = grid_shape(len(image_files))
+        top = len(band)
+        cell_size = min((size - top) // num_rows, size // num_cols)
+        left = (size - cell_size * num_cols) // 2
+
+        def load(image_file):
+            # Missing thumbnails are built in the threads decoding the views
+            if thumbnails is not None and isinstance(image_file, str):
+                image_file = thumbnails.thumbnail_path(image_file, cell_size - MARGIN)
+            return load_view(image_file, cell_size - MARGIN)
+        views = decoder_pool().map(load, image_files)
+        for i, view in enumerate(views):
+            row, col = divmod(i, num_cols)
+            y = top + row * cell_size + (cell_size - view.size[1]) // 2
+            x = left + col * cell_size + (cell_size - view.size[0]) // 2
+            # Over the background, with the alpha of the view
+            sheet.paste(view, (x, y), view)
+    return sheet
+
+
+def save_sheet(image_files, descriptions, output_path, size=SHEET_SIZE, thumbnails=None):
+    compose_sheet(image_files, descriptions, size, thumbnails).save(output_path)
@@ -0,0 +1,177 @@
+'''
+
+Deduplication of the models before rendering. Every OBJ gets a canonical fingerprint:
+the hash of its quantized vertices and faces, independent of the order of vertices and
+faces and of duplicated vertices, together with the UVs and the materials (colors and
+texture content) which also change the rendered images, plus a bounding-box signature.
+Models with the same fingerprint are rendered once, and the outputs of the rendered
+one are hard-linked for the others.
+
+The fingerprints are cached in a JSON file and only computed again for the OBJ files
+which changed. Nothing here depends on bpy.
+
+'''
+
+import hashlib
+import json
+import os
+from multiprocessing import Pool
+
+import numpy as np
+
+import mesh_io
+
+INDEX_VERSION = 1
+
+# Vertices and UVs are compared on a grid of 10**-QUANTIZE_DECIMALS
+QUANTIZE_DECIMALS = 4
+
+BBOX_DECIMALS = 2
+
+
+def file_digest(path):
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(2**20), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def material_digest(material):
+    texture = None
+    if material['map_Kd'] is not None and os.path.exists(material['map_Kd']):
+        texture = file_digest(material['map_Kd'])
+    values = [round(v, 4) for v in material['Kd'] + material['Ks'] + [material['d']]]
+    return hashlib.sha1(repr((values, texture)).encode('utf-8')).hexdigest()
+
+
+def fingerprint(obj_path, decimals=QUANTIZE_DECIMALS):
+    '''
+    Returns the fingerprint of an OBJ file: hash, bounding-box signature, and number
+    of unique vertices and faces.
+    '''
+    mesh = mesh_io.parse_obj(obj_path)
+    faces = mesh['faces'].astype(np.int64)
+    scale = 10.0 ** decimals
+
+    # Used vertices on the grid, sorted, so that their order and duplicates do not matter
+    used = np.unique(faces)
+    quantized = np.round(mesh['vertices'][used] * scale).astype(np.int64)
+    vertices, inverse = np.unique(quantized, axis=0, return_inverse=True)
+    remap = np.zeros(len(mesh['vertices']), dtype=np.int64)
+    remap[used] = inverse.reshape(-1)
+    faces = remap[faces]
+
+    corner_uvs = np.full(faces.shape + (2,), -1, dtype=np.int64)
+    if len(mesh['uvs']):
+        face_uvs = mesh['face_uvs']
+        uvs = np.round(mesh['uvs'] * scale).astype(np.int64)
+        corner_uvs = np.where((face_uvs >= 0)[..., None], uvs[np.maximum(face_uvs, 0)], -1)
+
+    # Materials by content, numbered in sorted order instead of their order in the file
+    digests = [material_digest(m) for m in mesh['materials']]
+    names = sorted(set(digests))
+    rank = np.array([names.index(d) for d in digests] or [-1], dtype=np.int64)
+    face_materials = rank[np.minimum(mesh['material_index'].astype(np.int64), len(rank) - 1)]
+
+    # Each triangle starts from its smallest vertex, keeping the winding, then triangles are sorted
+    shift = np.argmin(faces, axis=1)
+    order = (np.arange(3)[None, :] + shift[:, None]) % 3
+    faces = np.take_along_axis(faces, order, axis=1)
+    corner_uvs = np.take_along_axis(corner_uvs, order[:, :, None], axis=1)
+    rows = np.unique(np.concatenate([faces, face_materials[:, None], corner_uvs.reshape(-1, 6)], axis=1), axis=0)
+
+    sha = hashlib.sha1()
+    sha.update(vertices.tobytes())
+    sha.update(rows.tobytes())
+    sha.update('|'.join(names).encode('utf-8'))
+
+    bbox = []
+    if len(used):
+        points = mesh['vertices'][used].astype(np.float64)
+        bbox = np.round(np.concatenate([points.min(axis=0), points.max(axis=0)]), BBOX_DECIMALS).tolist()
+    return {'hash': sha.hexdigest(), 'bbox': bbox, 'vertices': len(vertices), 'faces': len(rows)}
+
+
+def _fingerprint_entry(path):
+    st = os.stat(path)
+    try:
+        entry = fingerprint(path)
+    except Exception as e:
+        # Unreadable models are never grouped, the render reports the error
+        entry = {'hash': None, 'error': repr(e)}
+    entry['stat'] = [st.st_size, st.st_mtime_ns]
+    return path, entry
+
+
+def load_fingerprints(index_path, paths, processes=1):
+    '''
+    Returns the fingerprints of the paths, from the cached index for the unchanged
+    files, computed with a pool of processes for the others.
+    '''
+    cached = {}
+    if os.path.exists(index_path):
+        with open(index_path) as f:
+            index = json.load(f)
+        if index.get('version') == INDEX_VERSION:
+            cached = index['entries']
+
+    fingerprints = {}
+    missing = []
+    for path in paths:
+        entry = cached.get(path)
+        if entry is not None and os.path.exists(path) and entry['stat'] == [os.stat(path).st_size, os.stat(path).st_mtime_ns]:
+            fingerprints[path] = entry
+        elif os.path.exists(path):
+            missing.append(path)
+    if missing:
+        print('fingerprinting {} models...'.format(len(missing)))
+        if processes > 1:
+            with Pool(processes) as pool:
+                fingerprints.update(pool.imap_unordered(_fingerprint_entry, missing, chunksize=16))
+        else:
+            fingerprints.update(map(_fingerprint_entry, missing))
+        cached.update(fingerprints)
+        os.makedirs(os.path.dirname(os.path.abspath(index_path)), exist_ok=True)
+        tmp_path = index_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'version': INDEX_VERSION, 'entries': cached}, f)
+        os.replace(tmp_path, index_path)
+    return fingerprints
+
+
+def group_duplicates(paths, fingerprints):
+    '''
+    Groups the paths by fingerprint, in the order of the paths. The first path of each
+    group is the one to render.
+    '''
+    groups = {}
+    for path in paths:
+        entry = fingerprints.get(path)
+        key = entry['hash'] if entry is not None and entry['hash'] is not None else 'path:' + path
+        groups.setdefault(key, []).append(path)
+    return list(groups.values())
+
+
+def near_duplicates(groups, fingerprints):
+    # Different geometries with the same bounding box and size, worth a look
+    by_signature = {}
+    for group in groups:
+        entry = fingerprints.get(group[0])
+        if entry is None or entry['hash'] is None:
+            continue
+        signature = (tuple(entry['bbox']), entry['faces'])
+        by_signature.setdefault(signature, []).append(group[0])
+    return [paths for paths in by_signature.values() if len(paths) > 1]
+
+
+def link_file(src, dst):
+    # A hard link costs no space, a symbolic link works across file systems
+    if os.path.lexists(dst):
+        if os.path.exists(dst) and os.path.samefile(src, dst):
+            return
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        os.symlink(os.path.abspath(src), dst)
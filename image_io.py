@@ -0,0 +1,178 @@
+'''
+
+Encoding and writing of the rendered images outside of Blender. The render loop reads
+the pixels of every view from the Viewer node and hands them to an AsyncWriter, whose
+threads convert, encode and write them while the next view renders. PNG is encoded
+with numpy and zlib, which release the GIL, so no extra package is needed inside
+Blender. Lossless WebP and JPEG use Pillow, when it is installed.
+
+Nothing here depends on bpy.
+
+'''
+
+import io
+import os
+import struct
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+# Formats the writer can encode, with the extension of their files
+WRITE_FORMATS = {'PNG': '.png', 'WEBP': '.webp', 'JPEG': '.jpg'}
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+
+def linear_to_srgb(values):
+    # The Standard view transform of Blender
+    return np.where(values <= 0.0031308, values * 12.92, 1.055 * np.power(np.maximum(values, 0.0031308), 1 / 2.4) - 0.055)
+
+
+def to_output_pixels(pixels, width, height, color_depth='8', linear=True):
+    '''
+    Converts the flat, bottom row first, premultiplied linear RGBA floats of a Blender
+    image to the top row first, straight alpha, sRGB integers Blender writes to files.
+    With linear False, the floats are already straight alpha, display-referred colors,
+    e.g. converted by the compositor with the view transform of the scene, and are
+    only flipped and quantized.
+    '''
+    pixels = np.asarray(pixels, dtype=np.float32).reshape(height, width, 4)[::-1]
+    if linear:
+        alpha = pixels[..., 3:]
+        rgb = np.divide(pixels[..., :3], alpha, out=np.zeros_like(pixels[..., :3]), where=alpha > 0)
+        rgba = np.concatenate([linear_to_srgb(rgb), alpha], axis=-1)
+    else:
+        rgba = pixels
+    scale = 65535 if color_depth == '16' else 255
+    dtype = np.uint16 if color_depth == '16' else np.uint8
+    return (np.clip(rgba, 0, 1) * scale + 0.5).astype(dtype)
+
+
+def png_chunk(kind, data):
+    return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+
+
+def encode_png(pixels, compression=6):
+    '''
+    Encodes an HxW (gray), HxWx2 (gray and alpha), HxWx3 (RGB) or HxWx4 (RGBA) array
+    of uint8 or uint16 as PNG, at the zlib compression level (0-9). Every row uses the
+    Up filter, a cheap one which compresses renderings about as well as the adaptive
+    filters of libpng.
+    '''
+    pixels = np.asarray(pixels)
+    if pixels.ndim == 2:
+        pixels = pixels[..., None]
+    height, width, channels = pixels.shape
+    color_type = {1: 0, 2: 4, 3: 2, 4: 6}[channels]
+    bit_depth = 16 if pixels.dtype == np.uint16 else 8
+    rows = np.ascontiguousarray(pixels.astype('>u2' if bit_depth == 16 else np.uint8)).view(np.uint8)
+    rows = rows.reshape(height, -1)
+
+    scanlines = np.empty((height, rows.shape[1] + 1), dtype=np.uint8)
+    if compression > 0:
+        scanlines[:, 0] = 2
+        scanlines[0, 1:] = rows[0]
+        np.subtract(rows[1:], rows[:-1], out=scanlines[1:, 1:])
+    else:
+        scanlines[:, 0] = 0
+        scanlines[:, 1:] = rows
+
+    header = struct.pack('>IIBBBBB', width, height, bit_depth, color_type, 0, 0, 0)
+    return b''.join([
+        PNG_SIGNATURE,
+        png_chunk(b'IHDR', header),
+        png_chunk(b'IDAT', zlib.compress(scanlines.tobytes(), compression)),
+        png_chunk(b'IEND', b''),
+    ])
+
+
+def encode_image(pixels, file_format='PNG', compression=6, quality=90):
+    '''
+    Encodes the pixels of to_output_pixels as PNG, lossless WebP or JPEG. WebP and
+    JPEG are 8 bits per channel, and JPEG has no alpha.
+    '''
+    if file_format == 'PNG':
+        return encode_png(pixels, compression)
+    try:
+        from PIL import Image
+    except ImportError:
+        raise RuntimeError('writing {} images needs Pillow, use PNG or install Pillow'.format(file_format))
+    if pixels.dtype == np.uint16:
+        pixels = (pixels >> 8).astype(np.uint8)
+    image = Image.fromarray(pixels, 'RGBA')
+    buffer = io.BytesIO()
+    if file_format == 'WEBP':
+        image.save(buffer, 'WEBP', lossless=True, method=min(6, compression))
+    elif file_format == 'JPEG':
+        image.convert('RGB').save(buffer, 'JPEG', quality=quality)
+    else:
+        raise ValueError('unsupported format {}'.format(file_format))
+    return buffer.getvalue()
+
+
+def write_file(path, data):
+    # Written next to its final path, then renamed, so that a crash never leaves half an image
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+class AsyncWriter:
+    '''
+    Converts, encodes and writes images in a pool of threads. At most max_pending
+    images wait in memory: submit() blocks when they are reached, so the render loop
+    can not run ahead of the disk. wait() returns once every submitted image is
+    written, and raises the first error of the threads.
+    '''
+
+    def __init__(self, threads, max_pending=None, file_format='PNG', compression=6, quality=90, linear=True):
+        self.pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='image_io')
+        self.slots = threading.BoundedSemaphore(max_pending or 2 * threads)
+        self.file_format = file_format
+        self.compression = compression
+        self.quality = quality
+        self.linear = linear
+        self.futures = []
+        self.lock = threading.Lock()
+        self.written = 0
+        self.bytes_written = 0
+        self.encode_seconds = 0.0
+
+    def _write(self, pixels, width, height, color_depth, path):
+        try:
+            start = time.time()
+            data = encode_image(to_output_pixels(pixels, width, height, color_depth, self.linear),
+                                self.file_format, self.compression, self.quality)
+            write_file(path, data)
+            with self.lock:
+                self.written += 1
+                self.bytes_written += len(data)
+                self.encode_seconds += time.time() - start
+        finally:
+            self.slots.release()
+
+    def submit(self, pixels, width, height, path, color_depth='8'):
+        '''
+        Queues the raw pixels of an image, which must not be modified afterwards.
+        Returns the seconds spent waiting for a free slot.
+        '''
+        start = time.time()
+        self.slots.acquire()
+        waited = time.time() - start
+        self.futures.append(self.pool.submit(self._write, pixels, width, height, color_depth, path))
+        return waited
+
+    def wait(self):
+        futures, self.futures = self.futures, []
+        for future in futures:
+            future.result()
+
+    def close(self):
+        try:
+            self.wait()
+        finally:
+            self.pool.shutdown()
@@ -0,0 +1,196 @@
+'''
+
+Cache of the materials and texture images of the imported models, kept in bpy.data
+from one model to the next inside a worker. Materials are keyed by the values of their
+Principled BSDF and by the content hash of their textures, so that the many ShapeNet
+models sharing texture files and near-identical materials reuse the same datablocks:
+a texture is decoded by the first model using it, and reused as is by the following
+ones. Optionally, the textures are downscaled once to a size matched to the render
+resolution; the ones already small enough, according to the header of their PNG or
+JPEG file, are left as they are without being decoded for it.
+
+The cached datablocks have a fake user, so that they survive the purge of the data
+left by every model, and are released when they fall out of the cache.
+
+'''
+
+import hashlib
+import os
+import struct
+from collections import OrderedDict
+
+import bpy
+
+# Specular of the Principled BSDF of the imported materials
+SPECULAR = 0.05
+
+# Inputs of the Principled BSDF which identify a material
+KEY_INPUTS = ['Base Color', 'Alpha', 'Roughness', 'Metallic', 'Specular', 'Specular IOR Level', 'Emission']
+
+
+def texture_size(value, resolution):
+    '''
+    Returns the maximum side of the cached textures: 0 keeps them as they are, auto
+    takes the power of two covering the render resolution.
+    '''
+    if value == 'auto':
+        return 1 << max(0, int(resolution) - 1).bit_length()
+    return int(value)
+
+
+def image_file_size(path):
+    '''
+    Returns the (width, height) in the header of a PNG or JPEG file, without decoding
+    it, or None for the other formats.
+    '''
+    with open(path, 'rb') as f:
+        head = f.read(24)
+        if head[:8] == b'\x89PNG\r\n\x1a\n' and head[12:16] == b'IHDR':
+            return struct.unpack('>II', head[16:24])
+        if head[:2] != b'\xff\xd8':
+            return None
+        # The segments of a JPEG up to its start of frame, which holds the size
+        f.seek(2)
+        while True:
+            marker = f.read(2)
+            if len(marker) < 2 or marker[0] != 0xFF:
+                return None
+            if marker[1] == 0xFF or 0xD0 <= marker[1] <= 0xD9 or marker[1] == 0x01:
+                # Fill byte, or marker without a segment
+                f.seek(-1 if marker[1] == 0xFF else 0, 1)
+                continue
+            if 0xC0 <= marker[1] <= 0xCF and marker[1] not in (0xC4, 0xC8, 0xCC):
+                segment = f.read(7)
+                if len(segment) < 7:
+                    return None
+                height, width = struct.unpack('>HH', segment[3:7])
+                return width, height
+            length = f.read(2)
+            if len(length) < 2:
+                return None
+            f.seek(struct.unpack('>H', length)[0] - 2, 1)
+
+
+def principled_nodes(material):
+    if material is None or material.node_tree is None:
+        return []
+    return [node for node in material.node_tree.nodes if node.type == 'BSDF_PRINCIPLED']
+
+
+def set_specular(material):
+    for node in principled_nodes(material):
+        # Renamed in Blender 4.0
+        specular = node.inputs.get('Specular') or node.inputs.get('Specular IOR Level')
+        if specular is not None:
+            specular.default_value = SPECULAR
+
+
+def input_value(socket):
+    value = getattr(socket, 'default_value', None)
+    if value is None:
+        return None
+    try:
+        return tuple(round(v, 4) for v in value)
+    except TypeError:
+        return round(value, 4)
+
+
+class MaterialCache:
+    '''
+    LRU cache of at most max_materials materials and of their images.
+    '''
+
+    def __init__(self, max_materials=256, max_texture_size=0):
+        self.max_materials = max_materials
+        self.max_texture_size = max_texture_size
+        self.materials = OrderedDict()
+        self.images = OrderedDict()
+        self.file_digests = {}
+        self.reused = 0
+        self.created = 0
+
+    def file_digest(self, path):
+        # Content hash of a texture file, read again only when the file changes
+        st = os.stat(path)
+        stat_key = (path, st.st_size, st.st_mtime_ns)
+        if stat_key not in self.file_digests:
+            sha = hashlib.sha1()
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(2**20), b''):
+                    sha.update(chunk)
+            self.file_digests[stat_key] = sha.hexdigest()
+        return self.file_digests[stat_key]
+
+    def image_key(self, image):
+        path = bpy.path.abspath(image.filepath)
+        if image.packed_file is not None or not os.path.exists(path):
+            return 'name:' + image.name
+        return self.file_digest(path)
+
+    def material_key(self, material):
+        key = [material.blend_method]
+        for node in principled_nodes(material):
+            key.append(tuple((name, input_value(node.inputs[name])) for name in KEY_INPUTS if name in node.inputs))
+        for node in material.node_tree.nodes if material.node_tree is not None else []:
+            if node.type == 'TEX_IMAGE' and node.image is not None:
+                key.append(self.image_key(node.image))
+        return hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+
+    def cached_image(self, image):
+        # The cached copy of the image, downscaled once if larger than the texture size
+        key = self.image_key(image)
+        if key in self.images:
+            self.images.move_to_end(key)
+            return self.images[key]
+        if self.max_texture_size > 0:
+            # image.size decodes the image, the header of its file does not
+            path = bpy.path.abspath(image.filepath)
+            size = None
+            if image.packed_file is None and os.path.exists(path):
+                size = image_file_size(path)
+            width, height = size if size is not None else image.size
+            if max(width, height) > self.max_texture_size:
+                ratio = self.max_texture_size / max(width, height)
+                image.scale(max(1, int(width * ratio)), max(1, int(height * ratio)))
+        image.use_fake_user = True
+        self.images[key] = image
+        if len(self.images) > self.max_materials:
+            _, evicted = self.images.popitem(last=False)
+            evicted.use_fake_user = False
+        return image
+
+    def add(self, key, material):
+        set_specular(material)
+        if material.node_tree is not None:
+            for node in material.node_tree.nodes:
+                if node.type == 'TEX_IMAGE' and node.image is not None:
+                    node.image = self.cached_image(node.image)
+        material.use_fake_user = True
+        self.materials[key] = material
+        if len(self.materials) > self.max_materials:
+            # Released at the next purge, once no model uses it
+            _, evicted = self.materials.popitem(last=False)
+            evicted.use_fake_user = False
+
+    def apply(self, obj):
+        '''
+        Replaces the materials of the object with the cached ones with the same content,
+        and caches the others. Returns the number of reused and of new materials.
+        '''
+        reused = created = 0
+        for slot in obj.material_slots:
+            material = slot.material
+            if material is None:
+                continue
+            key = self.material_key(material)
+            cached = self.materials.get(key)
+            if cached is not None and cached != material:
+                slot.material = cached
+                self.materials.move_to_end(key)
+                reused += 1
+            elif cached is None:
+                self.add(key, material)
+                created += 1
+        self.reused += reused
+        self.created += created
+        return reused, created
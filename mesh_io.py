@@ -0,0 +1,385 @@
+'''
+
+Fast OBJ/MTL loading with NumPy, as an alternative to bpy.ops.import_scene.obj.
+The geometry is parsed in bulk, welded (as remove_doubles) and split along sharp
+edges (as the EdgeSplit modifier) with vectorized operations, and the result can be
+cached on disk as one .npz per model, so that later runs skip parsing and
+preprocessing altogether. Nothing here depends on bpy.
+
+'''
+
+import hashlib
+import json
+import os
+import time
+
+import numpy as np
+
+CACHE_VERSION = 1
+
+# Same values used by render_shapenet_obj.py with bpy operators
+MERGE_DISTANCE = 0.0001
+SPLIT_ANGLE = 1.32645
+
+# Camera of render_shapenet_obj.py: location (0, 1, 0.6), lens 35mm, sensor 32mm
+CAMERA_DISTANCE = (1 + 0.6 ** 2) ** 0.5
+CAMERA_LENS = 35.0
+CAMERA_SENSOR = 32.0
+
+
+def parse_mtl(mtl_path):
+    materials = []
+    if not os.path.exists(mtl_path):
+        return materials
+    mtl_dir = os.path.dirname(mtl_path)
+    with open(mtl_path, errors='replace') as f:
+        for line in f:
+            tokens = line.split()
+            if not tokens:
+                continue
+            if tokens[0] == 'newmtl':
+                material = {'name': ' '.join(tokens[1:]), 'Kd': [0.8, 0.8, 0.8], 'Ks': [0.5, 0.5, 0.5], 'd': 1.0, 'map_Kd': None}
+                materials.append(material)
+            elif not materials:
+                continue
+            elif tokens[0] in ('Kd', 'Ks') and len(tokens) >= 4:
+                material[tokens[0]] = [float(t) for t in tokens[1:4]]
+            elif tokens[0] == 'd' and len(tokens) >= 2:
+                material['d'] = float(tokens[1])
+            elif tokens[0] == 'Tr' and len(tokens) >= 2:
+                material['d'] = 1.0 - float(tokens[1])
+            elif tokens[0] == 'map_Kd' and len(tokens) >= 2:
+                # The file name is the last token, after the options
+                material['map_Kd'] = os.path.normpath(os.path.join(mtl_dir, tokens[-1]))
+    return materials
+
+
+def _parse_floats(lines, width):
+    if not lines:
+        return np.zeros((0, width), dtype=np.float32)
+    values = np.array(' '.join(lines).split(), dtype=np.float64)
+    if values.size == width * len(lines):
+        return values.reshape(-1, width).astype(np.float32)
+    # Some lines carry extra components (e.g. vertex colors or w): parse them one by one
+    return np.array([[float(t) for t in line.split()[:width]] for line in lines], dtype=np.float32)
+
+
+def _parse_face_indices(tokens):
+    # Fast path when all the corners share the same layout (v, v/vt, v//vn or v/vt/vn)
+    layout = tokens[0].count('/'), '//' in tokens[0]
+    if all(t.count('/') == layout[0] and ('//' in t) == layout[1] for t in tokens):
+        width = layout[0] + 1 - int(layout[1])
+        values = np.array(' '.join(tokens).replace('/', ' ').split(), dtype=np.int64).reshape(-1, width)
+        v = values[:, 0]
+        vt = values[:, 1] if layout[0] >= 1 and not layout[1] else np.zeros_like(v)
+        return v, vt
+    v = np.empty(len(tokens), dtype=np.int64)
+    vt = np.zeros(len(tokens), dtype=np.int64)
+    for i, token in enumerate(tokens):
+        parts = token.split('/')
+        v[i] = int(parts[0])
+        if len(parts) > 1 and parts[1]:
+            vt[i] = int(parts[1])
+    return v, vt
+
+
+def _resolve_indices(indices, counts):
+    # OBJ indices are 1-based, negative ones are relative to the elements defined before the face
+    return np.where(indices > 0, indices - 1, indices + counts)
+
+
+def find_mtl_paths(obj_path, mtllibs=None):
+    # The MTL files of the mtllib lines, read from the OBJ when not given
+    if mtllibs is None:
+        with open(obj_path, errors='replace') as f:
+            mtllibs = [os.path.join(os.path.dirname(obj_path), line[6:].strip())
+                       for line in f if line.startswith('mtllib')]
+    # Fall back to the MTL named as the OBJ, as for the files in input_examples/
+    if not any(os.path.exists(p) for p in mtllibs):
+        mtllibs = [os.path.splitext(obj_path)[0] + '.mtl']
+    return mtllibs
+
+
+def parse_obj(obj_path):
+    '''
+    Returns the triangulated mesh of an OBJ file as a dict of arrays: vertices (V, 3),
+    uvs (T, 2), faces (F, 3) and face_uvs (F, 3) indices (-1 without UVs), per-face
+    material_index and smooth flags, plus the list of materials from the MTL files.
+    '''
+    with open(obj_path, errors='replace') as f:
+        lines = f.read().splitlines()
+
+    v_lines, vt_lines, face_tokens, face_sizes, face_materials, face_smooth = [], [], [], [], [], []
+    # Vertices and uvs defined before every face, for its negative indices
+    face_v_counts, face_vt_counts = [], []
+    mtllibs = []
+    material_names = []
+    material = -1
+    smooth = False
+    for line in lines:
+        head = line[:2]
+        if head == 'v ':
+            v_lines.append(line[2:])
+        elif head == 'vt':
+            vt_lines.append(line[3:])
+        elif head == 'f ':
+            tokens = line[2:].split()
+            face_tokens += tokens
+            face_sizes.append(len(tokens))
+            face_v_counts.append(len(v_lines))
+            face_vt_counts.append(len(vt_lines))
+            face_materials.append(material)
+            face_smooth.append(smooth)
+        elif line.startswith('usemtl'):
+            name = line[6:].strip()
+            if name not in material_names:
+                material_names.append(name)
+            material = material_names.index(name)
+        elif head == 's ':
+            smooth = line[2:].strip() not in ('off', '0')
+        elif line.startswith('mtllib'):
+            mtllibs.append(os.path.join(os.path.dirname(obj_path), line[6:].strip()))
+
+    vertices = _parse_floats(v_lines, 3)
+    uvs = _parse_floats(vt_lines, 2)
+
+    if face_tokens:
+        v, vt = _parse_face_indices(face_tokens)
+        v = _resolve_indices(v, np.repeat(face_v_counts, face_sizes))
+        vt = np.where(vt == 0, -1, _resolve_indices(vt, np.repeat(face_vt_counts, face_sizes)))
+    else:
+        v = vt = np.zeros(0, dtype=np.int64)
+
+    # Fan triangulation of the polygons: (0, j, j+1) for j in 1..n-2
+    sizes = np.array(face_sizes, dtype=np.int64)
+    starts = np.concatenate([[0], np.cumsum(sizes)[:-1]]).astype(np.int64)
+    keep = sizes >= 3
+    sizes, starts = sizes[keep], starts[keep]
+    tris_per_face = sizes - 2
+    polygon = np.repeat(np.arange(len(sizes)), tris_per_face)
+    j = np.arange(len(polygon)) - np.repeat(np.cumsum(tris_per_face) - tris_per_face, tris_per_face) + 1
+    corners = np.stack([starts[polygon], starts[polygon] + j, starts[polygon] + j + 1], axis=1)
+
+    materials = []
+    for mtllib in find_mtl_paths(obj_path, mtllibs):
+        materials += parse_mtl(mtllib)
+    by_name = {m['name']: m for m in materials}
+    mesh_materials = [by_name.get(name, {'name': name, 'Kd': [0.8, 0.8, 0.8], 'Ks': [0.5, 0.5, 0.5], 'd': 1.0, 'map_Kd': None})
+                      for name in material_names]
+
+    return {
+        'vertices': vertices,
+        'uvs': uvs,
+        'faces': v[corners].astype(np.int32),
+        'face_uvs': vt[corners].astype(np.int32),
+        'material_index': np.maximum(np.array(face_materials, dtype=np.int32)[keep][polygon], 0).astype(np.int16),
+        'smooth': np.array(face_smooth, dtype=bool)[keep][polygon],
+        'materials': mesh_materials,
+    }
+
+
+def _select_faces(mesh, mask):
+    for name in ('faces', 'face_uvs', 'material_index', 'smooth'):
+        mesh[name] = mesh[name][mask]
+
+
+def weld_vertices(mesh, distance=MERGE_DISTANCE):
+    # Merge the vertices falling in the same cell of a grid of the given size
+    cells = np.round(mesh['vertices'] / distance).astype(np.int64)
+    _, first, inverse = np.unique(cells, axis=0, return_index=True, return_inverse=True)
+    mesh['vertices'] = mesh['vertices'][first]
+    faces = inverse.reshape(-1)[mesh['faces']].astype(np.int32)
+    mesh['faces'] = faces
+    # Faces collapsed by the merge are removed, as remove_doubles does
+    valid = (faces[:, 0] != faces[:, 1]) & (faces[:, 1] != faces[:, 2]) & (faces[:, 0] != faces[:, 2])
+    _select_faces(mesh, valid)
+    return mesh
+
+
+def face_normals(vertices, faces):
+    tri = vertices[faces].astype(np.float64)
+    normals = np.cross(tri[:, 1] - tri[:, 0], tri[:, 2] - tri[:, 0])
+    norms = np.linalg.norm(normals, axis=1, keepdims=True)
+    return normals / np.maximum(norms, 1e-12)
+
+
+def split_edges(mesh, angle=SPLIT_ANGLE):
+    '''
+    Splits the mesh along the edges whose faces meet at an angle larger than the
+    given one, like the EdgeSplit modifier: the corners around a vertex are grouped
+    in fans connected by smooth edges, and every fan gets its own copy of the vertex.
+    '''
+    faces = mesh['faces']
+    num_faces = len(faces)
+    if num_faces == 0:
+        return mesh
+    normals = face_normals(mesh['vertices'], faces)
+
+    # Half-edges (a -> b) of every triangle, with the corners they start and end at
+    corner = np.arange(num_faces * 3).reshape(num_faces, 3)
+    start_v = faces.reshape(-1)
+    end_v = faces[:, [1, 2, 0]].reshape(-1)
+    start_c = corner.reshape(-1)
+    end_c = corner[:, [1, 2, 0]].reshape(-1)
+    low = np.minimum(start_v, end_v).astype(np.int64)
+    high = np.maximum(start_v, end_v).astype(np.int64)
+    low_c = np.where(start_v == low, start_c, end_c)
+    high_c = np.where(start_v == low, end_c, start_c)
+
+    # Only the edges with exactly two faces can be smooth: as in the modifier, edges
+    # with three or more faces (e.g. double-sided surfaces) are always split
+    key = low * (len(mesh['vertices']) + 1) + high
+    order = np.argsort(key, kind='stable')
+    key = key[order]
+    _, group_start, group_size = np.unique(key, return_index=True, return_counts=True)
+    pair = group_start[group_size == 2]
+    h1, h2 = order[pair], order[pair + 1]
+
+    face1, face2 = h1 // 3, h2 // 3
+    smooth = np.einsum('ij,ij->i', normals[face1], normals[face2]) > np.cos(angle)
+    h1, h2 = h1[smooth], h2[smooth]
+    union_a = np.concatenate([low_c[h1], high_c[h1]])
+    union_b = np.concatenate([low_c[h2], high_c[h2]])
+
+    # Connected components of the corners, by min-label propagation
+    labels = np.arange(num_faces * 3)
+    while True:
+        previous = labels.copy()
+        np.minimum.at(labels, union_a, labels[union_b])
+        np.minimum.at(labels, union_b, labels[union_a])
+        labels = labels[labels]
+        if np.array_equal(labels, previous):
+            break
+
+    roots, inverse = np.unique(labels, return_inverse=True)
+    mesh['vertices'] = mesh['vertices'][start_v[roots]]
+    mesh['faces'] = inverse.reshape(num_faces, 3).astype(np.int32)
+    return mesh
+
+
+def screen_space_cell_size(resolution, max_error, distance=CAMERA_DISTANCE, lens=CAMERA_LENS, sensor=CAMERA_SENSOR):
+    # World size covered by max_error pixels at the distance of the camera from the model
+    return max_error * distance * sensor / lens / resolution
+
+
+def _cluster_faces(mesh, cell_size):
+    vertices = mesh['vertices']
+    cells = np.floor((vertices - vertices.min(axis=0)) / cell_size).astype(np.int64)
+    _, inverse, counts = np.unique(cells, axis=0, return_inverse=True, return_counts=True)
+    inverse = inverse.reshape(-1)
+    faces = inverse[mesh['faces']]
+    valid = (faces[:, 0] != faces[:, 1]) & (faces[:, 1] != faces[:, 2]) & (faces[:, 0] != faces[:, 2])
+
+    # Faces collapsed onto the same cells are kept once, per orientation
+    rotation = np.argmin(faces, axis=1)
+    canonical = np.take_along_axis(faces, (rotation[:, None] + np.arange(3)) % 3, axis=1)
+    _, unique_faces = np.unique(canonical[valid], axis=0, return_index=True)
+    keep = np.zeros(len(faces), dtype=bool)
+    keep[np.nonzero(valid)[0][unique_faces]] = True
+    return inverse, counts, faces, keep
+
+
+def decimate_mesh(mesh, max_faces=None, cell_size=None):
+    '''
+    Simplifies the mesh by vertex clustering: the vertices falling in the same cell of a
+    grid are merged in their mean. The cell size is either given (e.g. from a screen-space
+    error) or searched so that the mesh has at most max_faces faces.
+    '''
+    num_faces = len(mesh['faces'])
+    if cell_size is None and (max_faces is None or num_faces <= max_faces):
+        return mesh
+
+    if cell_size is None:
+        # Bisection of the cell size, in log space, between no reduction and a single cell
+        extent = float(np.max(mesh['vertices'].max(axis=0) - mesh['vertices'].min(axis=0)))
+        low, high = extent * 1e-6, extent
+        for _ in range(16):
+            middle = np.sqrt(low * high)
+            if _cluster_faces(mesh, middle)[3].sum() > max_faces:
+                low = middle
+            else:
+                high = middle
+        cell_size = high
+
+    inverse, counts, faces, keep = _cluster_faces(mesh, cell_size)
+    sums = np.zeros((len(counts), 3), dtype=np.float64)
+    np.add.at(sums, inverse, mesh['vertices'])
+    mesh['vertices'] = (sums / counts[:, None]).astype(np.float32)
+    mesh['faces'] = faces.astype(np.int32)
+    _select_faces(mesh, keep)
+    return mesh
+
+
+def preprocess_mesh(mesh, scale=1.0, remove_doubles=True, edge_split=True, max_faces=None, cell_size=None):
+    if scale != 1:
+        mesh['vertices'] = mesh['vertices'] * np.float32(scale)
+    if remove_doubles:
+        weld_vertices(mesh)
+    if max_faces is not None or cell_size is not None:
+        num_faces = len(mesh['faces'])
+        decimate_mesh(mesh, max_faces, cell_size)
+        print('decimation: {} -> {} faces'.format(num_faces, len(mesh['faces'])))
+    if edge_split:
+        split_edges(mesh)
+    return mesh
+
+
+def cache_key(obj_path, **params):
+    st = os.stat(obj_path)
+    # The materials are cached with the mesh, an edited MTL file changes the key as well
+    mtl_stats = []
+    for mtl_path in find_mtl_paths(obj_path):
+        if os.path.exists(mtl_path):
+            mtl_st = os.stat(mtl_path)
+            mtl_stats.append([os.path.abspath(mtl_path), mtl_st.st_size, mtl_st.st_mtime_ns])
+    description = json.dumps({'version': CACHE_VERSION, 'path': os.path.abspath(obj_path),
+                              'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'mtl': mtl_stats,
+                              'params': params}, sort_keys=True)
+    return hashlib.sha1(description.encode()).hexdigest()
+
+
+def save_cached_mesh(cache_path, mesh, key):
+    os.makedirs(os.path.dirname(os.path.abspath(cache_path)), exist_ok=True)
+    arrays = {name: value for name, value in mesh.items() if isinstance(value, np.ndarray)}
+    tmp_path = cache_path + '.tmp.npz'
+    np.savez(tmp_path, key=np.array(key), materials=np.array(json.dumps(mesh['materials'])), **arrays)
+    os.replace(tmp_path, cache_path)
+
+
+def load_cached_mesh(cache_path, key):
+    if not os.path.exists(cache_path):
+        return None
+    try:
+        with np.load(cache_path) as data:
+            if str(data['key']) != key:
+                return None
+            mesh = {name: data[name] for name in data.files if name not in ('key', 'materials')}
+            mesh['materials'] = json.loads(str(data['materials']))
+    except (OSError, ValueError, KeyError):
+        # Truncated or stale cache file
+        return None
+    return mesh
+
+
+def load_mesh(obj_path, cache_path=None, **params):
+    '''
+    Parses and preprocesses an OBJ file, or reads the result from cache_path when it
+    was stored for the same file and the same parameters.
+    '''
+    start = time.time()
+    key = cache_key(obj_path, **params)
+    if cache_path is not None:
+        mesh = load_cached_mesh(cache_path, key)
+        if mesh is not None:
+            print('mesh loaded from cache in {:.2f}s: {} vertices, {} faces'.format(
+                time.time() - start, len(mesh['vertices']), len(mesh['faces'])))
+            return mesh
+
+    mesh = parse_obj(obj_path)
+    parsed = time.time()
+    preprocess_mesh(mesh, **params)
+    print('mesh parsed in {:.2f}s, preprocessed in {:.2f}s: {} vertices, {} faces'.format(
+        parsed - start, time.time() - parsed, len(mesh['vertices']), len(mesh['faces'])))
+    if cache_path is not None:
+        save_cached_mesh(cache_path, mesh, key)
+    return mesh
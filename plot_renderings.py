@@ -1,39 +1,64 @@
 import matplotlib.pyplot as plt
 from PIL import Image
-import csv
 import os
 import math
 import argparse
+import io
+import time
+from multiprocessing import Pool
+from caption_store import CaptionStore, ensure_index
+from contact_sheet import grid_shape, save_sheet
+from shard_store import ShardStore
+from thumbnail_cache import ThumbnailCache, DEFAULT_CACHE_DIR, DEFAULT_BUDGET_MB
 
 def find_descriptions(target_model_id, csv_file):
-    descriptions = []
-    
-    with open(csv_file, newline='') as csvfile:
-        reader = csv.DictReader(csvfile)
-        
-        for row in reader:
-            if row['modelId'] == target_model_id:
-                descriptions.append(row['description'])
-    
+    # Looked up in the index of the CSV, built on the first call
+    store = CaptionStore(csv_file)
+    descriptions = store.descriptions(target_model_id)
+    store.close()
     return descriptions
 
-def read_images(folder_path):
+def read_images(folder_path, thumbnails=None, threads=4):
     image_filenames = []
-    for filename in os.listdir(folder_path):
+    for filename in sorted(os.listdir(folder_path)):
         if filename.endswith('.png'):
             image_path = os.path.join(folder_path, filename)
             image_filenames.append(image_path)
+    if thumbnails is not None and threads > 0:
+        # The missing thumbnails of the views are built together, in threads, rather than one by one while drawing
+        thumbnails.warm(image_filenames, threads=threads)
     return image_filenames
 
-def plot_figure(image_paths, text_prompts, save_fig, output_fig):
-    # Calculate the number of rows and columns for the grid
-    num_images = len(image_paths)
-    num_rows = int(math.sqrt(num_images))
-    num_cols = int(math.ceil(num_images / num_rows))
+def read_images_from_store(store_dir, model_id):
+    # The views of the model, by angle, and the captions stored with them
+    store = ShardStore(store_dir)
+    views = store.views(model_id)
+    images = [io.BytesIO(store.read(key, 'png')) for key, view, angle in views]
+    captions = []
+    if views:
+        metadata = store.metadata(views[0][0])
+        # The views of a deduplicated model are those of its twin, with the captions of the twin
+        if metadata['model_id'] == model_id:
+            captions = metadata['captions']
+    store.close()
+    return images, captions
 
-    # Create a grid of subplots
-    fig, axes = plt.subplots(num_rows, num_cols, figsize=(12, 12))
+def create_figure(num_images):
+    # Create a grid of subplots, with the number of rows and columns of grid_shape
+    num_rows, num_cols = grid_shape(num_images)
+    fig, axes = plt.subplots(num_rows, num_cols, figsize=(12, 12), squeeze=False)
     plt.style.use('dark_background')
+    return fig, axes
+
+def draw_figure(fig, axes, image_paths, text_prompts, thumbnails=None):
+    # Draws the views and the descriptions on the axes of create_figure, cleared first so that a figure can be reused
+    num_images = len(image_paths)
+    num_rows, num_cols = axes.shape
+    # Width of a subplot in pixels, the views are read from the smallest thumbnail at least as large
+    cell_size = int(fig.get_figwidth() * fig.dpi / num_cols)
+    for ax in axes.flat:
+        ax.clear()
+        ax.set_visible(True)
 
     # Plot descriptions as text in the first subplot
     axes[0, 0].axis('off')
@@ -47,28 +72,127 @@ def plot_figure(image_paths, text_prompts, save_fig, output_fig):
         ax = axes[row_idx, col_idx]
         
         ax.axis('off')  # Turn off axis
+        if thumbnails is not None and isinstance(image_filename, str):
+            image_filename = thumbnails.thumbnail_path(image_filename, cell_size)
         image = Image.open(image_filename)
         ax.imshow(image)
         ax.get_xaxis().set_visible(False)
         ax.get_yaxis().set_visible(False)
 
-    # Remove any empty subplots
+    # Hide any empty subplots
     for i in range(num_images, num_rows * num_cols):
         row_idx = i // num_cols
         col_idx = i % num_cols
-        fig.delaxes(axes[row_idx, col_idx])
+        axes[row_idx, col_idx].set_visible(False)
+
+def plot_figure(image_paths, text_prompts, save_fig, output_fig, thumbnails=None):
+    fig, axes = create_figure(len(image_paths))
+    draw_figure(fig, axes, image_paths, text_prompts, thumbnails)
 
     if save_fig:
         plt.savefig(output_fig)
     plt.show()
 
+def find_model_folders(renders_folder):
+    # modelId -> folder of its views, for the layouts of render_shapenet_obj.py: <model>/ and <class>/<model>/
+    folders = {}
+    for dirpath, dirnames, filenames in os.walk(renders_folder):
+        model_id = os.path.basename(dirpath)
+        if any(name.startswith(model_id + '_r_') and name.endswith('.png') for name in filenames):
+            folders[model_id] = dirpath
+            dirnames[:] = []
+    return folders
+
+def open_thumbnails(args):
+    return None if args.no_thumbnails else ThumbnailCache(args.thumbnail_cache, args.thumbnail_budget)
+
+# State of a batch worker process, set by init_batch_worker
+worker_state = {}
+
+def init_batch_worker(args):
+    # Figures are only written to files, without a display
+    plt.switch_backend('Agg')
+    worker_state['args'] = args
+    worker_state['captions'] = CaptionStore(args.csv_path) if args.csv_path is not None and os.path.exists(args.csv_path) else None
+    worker_state['figures'] = {}
+    worker_state['thumbnails'] = open_thumbnails(args)
+
+def plot_model(task):
+    '''
+    Writes the figure of one model in a batch worker, reusing the figure of the
+    previous model with the same grid. Returns the model and its status.
+    '''
+    model_id, folder = task
+    args = worker_state['args']
+    output_path = os.path.join(args.output_folder, model_id + '.png')
+    if not args.force and os.path.exists(output_path):
+        return model_id, 'skipped'
+    try:
+        if args.store is not None:
+            image_filenames, descriptions = read_images_from_store(args.store, model_id)
+        else:
+            # Without warming up the thumbnails, the processes of the pool already work in parallel
+            image_filenames, descriptions = read_images(folder, worker_state['thumbnails'], threads=0), []
+        if not image_filenames:
+            return model_id, 'no views'
+        if not descriptions and worker_state['captions'] is not None:
+            descriptions = worker_state['captions'].descriptions(model_id)
+        if args.compositor == 'pil':
+            save_sheet(image_filenames, descriptions, output_path, thumbnails=worker_state['thumbnails'])
+            return model_id, 'done'
+
+        shape = grid_shape(len(image_filenames))
+        if shape not in worker_state['figures']:
+            worker_state['figures'][shape] = create_figure(len(image_filenames))
+        fig, axes = worker_state['figures'][shape]
+        draw_figure(fig, axes, image_filenames, descriptions, worker_state['thumbnails'])
+        fig.savefig(output_path)
+    except Exception as e:
+        return model_id, 'failed: {!r}'.format(e)
+    return model_id, 'done'
+
+def plot_batch(args):
+    '''
+    Writes one figure per rendered model, <output_folder>/<modelId>.png, with a pool of
+    processes, and reports the figures per second.
+    '''
+    if args.store is not None:
+        store = ShardStore(args.store)
+        folders = {model_id: None for model_id in store.models()}
+        store.close()
+    else:
+        folders = find_model_folders(args.renders_folder)
+    model_ids = sorted(folders)
+    if args.model_ids is not None:
+        with open(args.model_ids) as f:
+            model_ids = [line.strip() for line in f if line.strip() in folders]
+    os.makedirs(args.output_folder, exist_ok=True)
+    if args.csv_path is not None and os.path.exists(args.csv_path):
+        # Built once here, rather than by every worker opening the captions at the same time
+        ensure_index(args.csv_path)
+    # Likewise for the log of a thumbnail cache written before it
+    open_thumbnails(args)
+    print('plotting {} models with {} processes'.format(len(model_ids), args.processes))
+
+    start = time.time()
+    tasks = [(model_id, folders[model_id]) for model_id in model_ids]
+    done = 0
+    with Pool(args.processes, initializer=init_batch_worker, initargs=(args,)) as pool:
+        for model_id, status in pool.imap_unordered(plot_model, tasks, chunksize=8):
+            if status == 'done':
+                done += 1
+            elif status != 'skipped':
+                print('{}: {}'.format(model_id, status))
+    elapsed = time.time() - start
+    print('wrote {} figures in {:.2f}s, {:.2f} figures/s'.format(done, elapsed, done / elapsed if elapsed > 0 else 0.0))
+
 def parse_args():
     parser = argparse.ArgumentParser(description='Renders given obj file by rotation a camera around it.')
     
     parser.add_argument('--csv_path', type=str, default='input_examples/captions.tablechair.csv',
                         help='path to CSV file with textual descriptions')
     
-    parser.add_argument('--obj_path', type=str, default='', required=True,
+    parser.add_argument('--obj_path', type=str, default=None,
                         help='path to OBJ file of the 3D shape')
     
     parser.add_argument('--renders_folder', type=str, default='output_renders/',
@@ -77,24 +201,68 @@ def parse_args():
     parser.add_argument('--output_folder', type=str, default='output_plots/',
                         help='path to the image to save')
 
+    parser.add_argument('--store', type=str, default=None,
+                        help='path to the folder of the tar shards written by render_shapenet_obj.py --output_mode tar, read instead of renders_folder')
+
+    parser.add_argument('--compositor', type=str, default='matplotlib', choices=['matplotlib', 'pil'],
+                        help='How the figure is drawn: a grid of matplotlib subplots, or the views tiled directly with NumPy and PIL under the descriptions (contact_sheet.py), an order of magnitude faster.')
+
+    parser.add_argument('--batch', action="store_true",
+                        help='if set, write one figure per rendered model found in renders_folder (or in the store), named <modelId>.png in output_folder, instead of plotting obj_path')
+
+    parser.add_argument('--model_ids', type=str, default=None,
+                        help='Text file with one modelId per line, to plot only these models with --batch.')
+
+    parser.add_argument('--processes', type=int, default=os.cpu_count(),
+                        help='Number of processes writing the figures with --batch.')
+
+    parser.add_argument('--force', action="store_true",
+                        help='if set, write again the figures which already exist with --batch')
+
+    parser.add_argument('--thumbnail_cache', type=str, default=DEFAULT_CACHE_DIR,
+                        help='Folder of the thumbnails of the views, read instead of the full-resolution renderings when they are large enough for the figure.')
+
+    parser.add_argument('--thumbnail_budget', type=int, default=DEFAULT_BUDGET_MB,
+                        help='Size of the thumbnail cache in MB, the least recently used thumbnails are removed beyond it.')
+
+    parser.add_argument('--no_thumbnails', action="store_true",
+                        help='if set, always read the full-resolution renderings')
+
     args = parser.parse_args()
+    if not args.batch and args.obj_path is None:
+        parser.error('--obj_path is required without --batch')
     return args
 
 
 def main():
     args = parse_args()
+    if args.batch:
+        plot_batch(args)
+        return
     model_id = os.path.splitext(os.path.basename(args.obj_path))[0]
     print('model id: ', model_id)
+    # The views of a store are read from memory, without thumbnails
+    thumbnails = open_thumbnails(args) if args.store is None else None
     
-    descriptions = find_descriptions(model_id, args.csv_path)
-    print('descriptions: ', descriptions)
-    
-    renders_folder = os.path.join(args.renders_folder, model_id)
-    image_filenames = read_images(folder_path=renders_folder)
-    print('image_filenames: ', image_filenames)
+    if args.store is not None:
+        image_filenames, descriptions = read_images_from_store(args.store, model_id)
+        print('views in store: ', len(image_filenames))
+        if not descriptions:
+            descriptions = find_descriptions(model_id, args.csv_path)
+        print('descriptions: ', descriptions)
+    else:
+        descriptions = find_descriptions(model_id, args.csv_path)
+        print('descriptions: ', descriptions)
+
+        renders_folder = os.path.join(args.renders_folder, model_id)
+        image_filenames = read_images(folder_path=renders_folder, thumbnails=thumbnails)
+        print('image_filenames: ', image_filenames)
     
     output_path = os.path.join(args.output_folder, 'output_renderings.png')
-    plot_figure(image_filenames, descriptions, save_fig=True, output_fig=output_path)
+    if args.compositor == 'pil':
+        save_sheet(image_filenames, descriptions, output_path, thumbnails=thumbnails)
+        return
+    plot_figure(image_filenames, descriptions, save_fig=True, output_fig=output_path, thumbnails=thumbnails)
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -7,7 +7,7 @@ This script plots worldclouds to visualize the most frequent words of the datase
 import argparse
 import matplotlib.pyplot as plt
 from wordcloud import WordCloud
-import csv
+from caption_store import CaptionStore
 import os
 
 def parse_args():
@@ -27,19 +27,10 @@ def parse_args():
     return args
     
 def build_text(csv_path, category):
-    text_prompts = []
-    with open(csv_path, newline='') as csvfile:
-        reader = csv.DictReader(csvfile)
-        for row in reader:
-            if category != 'all':
-                if row["category"] == category:
-                    text_prompt = row['description']
-                    text_prompt = text_prompt.lower()
-                    text_prompts.append(text_prompt)   
-            else:
-                text_prompt = row['description']
-                text_prompt = text_prompt.lower()
-                text_prompts.append(text_prompt)   
+    # The descriptions of the category, or all of them, from the index of the CSV
+    store = CaptionStore(csv_path)
+    text_prompts = [text_prompt.lower() for text_prompt in store.category_descriptions(category)]
+    store.close()
 
     all_texts = "\n\n".join(text_prompts)
     return all_texts, text_prompts
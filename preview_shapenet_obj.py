@@ -0,0 +1,307 @@
+'''
+
+Preview renderer without Blender, for a quick look over the whole dataset. The
+triangles of every OBJ are rasterized with a vectorized NumPy z-buffer, flat shaded
+with the colors of their materials or colored by their normals, from the same orbit
+camera as render_shapenet_obj.py: location (0, 1, 0.6), lens 35, sensor 32, and view
+i at 360 / views * i degrees. The previews are framed pixel for pixel like the full
+renders and written with the same names:
+
+python preview_shapenet_obj.py --category Chair --views 8 --resolution 128 --processes 8
+
+'''
+
+import argparse
+import math
+import os
+import time
+from multiprocessing import Pool
+
+import numpy as np
+
+import image_io
+import mesh_io
+from shape_index import class_to_class_id, get_obj_paths, iter_shape_paths, load_shape_index
+
+CAMERA_LOCATION = (0.0, 1.0, 0.6)
+
+# Rotation of the default light of the Blender startup scene, the sun of the full renders
+LIGHT_ROTATION = (math.radians(37.261), math.radians(3.16371), math.radians(106.936))
+
+AMBIENT = 0.25
+
+# Closer triangles are dropped instead of clipped
+NEAR_CLIP = 0.01
+
+# Pixel-triangle pairs rasterized at once, which bounds the memory of a chunk
+CHUNK_FRAGMENTS = 2**22
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Renders quick previews of obj files with NumPy, without Blender.')
+
+    parser.add_argument('--views', type=int, default=20,
+                        help='number of views to be rendered')
+
+    parser.add_argument('--resolution', type=int, default=256,
+                        help='Resolution of the previews.')
+
+    parser.add_argument('--shading', type=str, default='flat', choices=['flat', 'normal'],
+                        help='flat shades the faces with the colors of their materials and the sun of the full renders, normal colors them by their world space normal, as the normal pass.')
+
+    parser.add_argument('--supersample', type=int, default=1,
+                        help='Samples per pixel along each axis, averaged to smooth the edges.')
+
+    parser.add_argument('--data_root', type=str, default='/media/data2/aamaduzzi/datasets/ShapeNetCore.v2',
+                        help='The path to the dataset folder')
+
+    parser.add_argument('--category', type=str, default='Chair', choices=["Chair", "Table", "all"],
+                        help='The name of the category of shapes to render.')
+
+    parser.add_argument('--csv_path', type=str, default=None,
+                        help='Text2Shape captions CSV. If set, only the models with a caption are rendered, taken from the cached shape index.')
+
+    parser.add_argument('--shape_index', type=str, default=None,
+                        help='Path of the cached shape index built from --csv_path. Defaults to shape_index.json in the output folder.')
+
+    parser.add_argument('--obj_path', type=str, default=None,
+                        help='The path of the single .obj file to render')
+
+    parser.add_argument('--paths_file', type=str, default=None,
+                        help='Text file with one .obj path per line to render. Takes precedence over --obj_path and --category.')
+
+    parser.add_argument('--output_folder', type=str, default='./output_previews',
+                        help='The path the output will be dumped to.')
+
+    parser.add_argument('--scale', type=float, default=1,
+                        help='Scaling factor applied to model. Depends on size of mesh.')
+
+    parser.add_argument('--processes', type=int, default=1,
+                        help='Number of models rendered in parallel.')
+
+    parser.add_argument('--force', action="store_true",
+                        help='if set, render again the models whose previews already exist')
+
+    args = parser.parse_args()
+    return args
+
+
+def collect_paths(args):
+    # The models render_shapenet_obj.py renders with the same options
+    if args.paths_file is not None:
+        with open(args.paths_file) as f:
+            return [line.strip() for line in f if line.strip()]
+    if args.obj_path is not None:
+        return [args.obj_path]
+    categories = ['Table', 'Chair'] if args.category == 'all' else [args.category]
+    if args.csv_path is not None:
+        index_path = args.shape_index or os.path.join(os.path.abspath(args.output_folder), 'shape_index.json')
+        entries = load_shape_index(index_path, args.data_root, args.csv_path)
+        return list(iter_shape_paths(entries, categories))
+    paths = []
+    for category in categories:
+        paths += get_obj_paths(os.path.join(args.data_root, class_to_class_id[category]))
+    return paths
+
+
+def preview_paths(args, path):
+    # Same folders and names as the views of render_shapenet_obj.py
+    if args.obj_path is not None and args.paths_file is None:
+        model_identifier = os.path.splitext(os.path.basename(path))[0]
+        fp = os.path.join(os.path.abspath(args.output_folder), model_identifier)
+    else:
+        model_identifier = os.path.normpath(path).split(os.sep)[-3]
+        class_identifier = os.path.normpath(path).split(os.sep)[-4]
+        fp = os.path.join(os.path.abspath(args.output_folder), class_identifier, model_identifier)
+    stepsize = 360.0 / args.views
+    return [os.path.join(fp, model_identifier + '_r_{0:03d}.png'.format(int(i * stepsize))) for i in range(args.views)]
+
+
+def euler_matrix(x, y, z):
+    # Blender XYZ Euler rotation
+    rx = np.array([[1, 0, 0], [0, math.cos(x), -math.sin(x)], [0, math.sin(x), math.cos(x)]])
+    ry = np.array([[math.cos(y), 0, math.sin(y)], [0, 1, 0], [-math.sin(y), 0, math.cos(y)]])
+    rz = np.array([[math.cos(z), -math.sin(z), 0], [math.sin(z), math.cos(z), 0], [0, 0, 1]])
+    return rz @ ry @ rx
+
+
+def camera_basis(angle):
+    '''
+    Location and right, up and forward axes of the camera of the view at angle degrees:
+    parented to an empty at the origin rotated about Z, tracking the empty with its
+    -Z axis and with its Y axis up.
+    '''
+    theta = math.radians(angle)
+    x, y, z = CAMERA_LOCATION
+    eye = np.array([x * math.cos(theta) - y * math.sin(theta), x * math.sin(theta) + y * math.cos(theta), z])
+    forward = -eye / np.linalg.norm(eye)
+    right = np.cross(forward, [0.0, 0.0, 1.0])
+    right /= np.linalg.norm(right)
+    up = np.cross(right, forward)
+    return eye, right, up, forward
+
+
+def load_preview_mesh(path, scale=1.0):
+    mesh = mesh_io.parse_obj(path)
+    vertices = mesh['vertices'].astype(np.float64) * scale
+    # The OBJ importer turns Y up into Z up: (x, y, z) -> (x, -z, y)
+    vertices = np.stack([vertices[:, 0], -vertices[:, 2], vertices[:, 1]], axis=1)
+    colors = np.array([m['Kd'] for m in mesh['materials']] or [[0.8, 0.8, 0.8]], dtype=np.float64)
+    face_colors = colors[np.minimum(mesh['material_index'], len(colors) - 1)]
+    return vertices, mesh['faces'].astype(np.int64), face_colors
+
+
+def rasterize(screen, depth, faces, size):
+    '''
+    Returns the index of the closest face at the center of every pixel of a size x size
+    image, -1 for the background. screen holds the pixel coordinates of the vertices,
+    depth their distance along the view axis.
+    '''
+    face_ids = np.full(size * size, -1, dtype=np.int64)
+    inv_depth = np.zeros(size * size, dtype=np.float64)
+
+    tri = screen[faces]
+    tri_inv_depth = 1.0 / depth[faces]
+    area = ((tri[:, 1, 0] - tri[:, 0, 0]) * (tri[:, 2, 1] - tri[:, 0, 1])
+            - (tri[:, 2, 0] - tri[:, 0, 0]) * (tri[:, 1, 1] - tri[:, 0, 1]))
+    # Pixels whose center is inside the bounding box of the triangle
+    x0 = np.clip(np.ceil(tri[:, :, 0].min(axis=1) - 0.5), 0, size).astype(np.int64)
+    x1 = np.clip(np.floor(tri[:, :, 0].max(axis=1) - 0.5), -1, size - 1).astype(np.int64)
+    y0 = np.clip(np.ceil(tri[:, :, 1].min(axis=1) - 0.5), 0, size).astype(np.int64)
+    y1 = np.clip(np.floor(tri[:, :, 1].max(axis=1) - 0.5), -1, size - 1).astype(np.int64)
+    width = np.maximum(x1 - x0 + 1, 0)
+    height = np.maximum(y1 - y0 + 1, 0)
+    fragments = width * height
+    visible = np.flatnonzero((fragments > 0) & (np.abs(area) > 1e-12))
+
+    # The barycentric coordinates of the first two vertices and 1/depth, which is linear in
+    # screen space, as planes a * x + b * y + c over the pixel centers of every triangle
+    tri, area, tri_inv_depth = tri[visible], area[visible, None], tri_inv_depth[visible]
+    planes = np.empty((len(visible), 3, 3))
+    for k, (i, j) in enumerate([(1, 2), (2, 0)]):
+        planes[:, k, 0] = (tri[:, i, 1] - tri[:, j, 1]) / area[:, 0]
+        planes[:, k, 1] = (tri[:, j, 0] - tri[:, i, 0]) / area[:, 0]
+        planes[:, k, 2] = (tri[:, i, 0] * tri[:, j, 1] - tri[:, j, 0] * tri[:, i, 1]) / area[:, 0]
+    w2 = np.array([0.0, 0.0, 1.0]) - planes[:, 0] - planes[:, 1]
+    planes[:, 2] = (planes[:, 0] * tri_inv_depth[:, :1] + planes[:, 1] * tri_inv_depth[:, 1:2]
+                    + w2 * tri_inv_depth[:, 2:])
+    # One row per coefficient, so that the repeated coefficients are contiguous
+    planes = np.ascontiguousarray(planes.reshape(-1, 9).T)
+    x0, y0, width, fragments = x0[visible], y0[visible], width[visible], fragments[visible]
+
+    # Chunks of triangles with a bounded number of fragments
+    ends = np.cumsum(fragments)
+    start = 0
+    while start < len(visible):
+        stop = max(start + 1, int(np.searchsorted(ends, ends[start] - fragments[start] + CHUNK_FRAGMENTS, 'right')))
+        counts = fragments[start:stop]
+        local = np.repeat(np.arange(stop - start), counts)
+        offset = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        chunk_width = np.repeat(width[start:stop], counts)
+        row, column = np.divmod(offset, chunk_width)
+        px = np.repeat(x0[start:stop], counts) + column
+        py = np.repeat(y0[start:stop], counts) + row
+
+        p = np.repeat(planes[:, start:stop], counts, axis=1)
+        cx = px + 0.5
+        cy = py + 0.5
+        w0 = p[0] * cx + p[1] * cy + p[2]
+        w1 = p[3] * cx + p[4] * cy + p[5]
+        inside = np.flatnonzero((w0 >= 0) & (w1 >= 0) & (w0 + w1 <= 1))
+        cx, cy, p = cx[inside], cy[inside], p[6:, inside]
+        # The closest fragment has the largest 1/depth
+        d = p[0] * cx + p[1] * cy + p[2]
+        face = visible[start + local[inside]]
+        pixel = py[inside] * size + px[inside]
+        np.maximum.at(inv_depth, pixel, d)
+        front = d >= inv_depth[pixel]
+        face_ids[pixel[front]] = face[front]
+        start = stop
+    return face_ids.reshape(size, size)
+
+
+def render_view(vertices, faces, face_colors, angle, resolution, shading='flat', supersample=1):
+    '''
+    Renders one view as an RGBA uint8 image, top row first.
+    '''
+    size = resolution * supersample
+    eye, right, up, forward = camera_basis(angle)
+    relative = vertices - eye
+    depth = relative @ forward
+    # Blender fits the sensor width to the image: the focal length in pixels is lens / sensor * width
+    focal = mesh_io.CAMERA_LENS / mesh_io.CAMERA_SENSOR * size
+    with np.errstate(divide='ignore', invalid='ignore'):
+        screen = np.stack([size / 2 + focal * (relative @ right) / depth,
+                           size / 2 - focal * (relative @ up) / depth], axis=1)
+    keep = (depth[faces] > NEAR_CLIP).all(axis=1)
+    faces, face_colors = faces[keep], face_colors[keep]
+    face_ids = rasterize(screen, depth, faces, size)
+
+    # Face normals turned toward the camera, as Cycles shades back faces
+    normals = mesh_io.face_normals(vertices, faces)
+    toward = vertices[faces].mean(axis=1) - eye
+    normals[np.einsum('ij,ij->i', normals, toward) > 0] *= -1
+    if shading == 'normal':
+        colors = normals * 0.5 + 0.5
+    else:
+        light = euler_matrix(*LIGHT_ROTATION) @ np.array([0.0, 0.0, 1.0])
+        # The MTL colors are linear, as for Blender, and shown with the Standard view transform
+        colors = image_io.linear_to_srgb(face_colors * (AMBIENT + (1 - AMBIENT) * np.clip(normals @ light, 0, 1))[:, None])
+
+    covered = face_ids >= 0
+    image = np.zeros((size, size, 4), dtype=np.float64)
+    image[covered, :3] = colors[face_ids[covered]]
+    image[covered, 3] = 1.0
+    if supersample > 1:
+        # Premultiplied average of the samples of every pixel
+        image[..., :3] *= image[..., 3:]
+        image = image.reshape(resolution, supersample, resolution, supersample, 4).mean(axis=(1, 3))
+        image[..., :3] = np.divide(image[..., :3], image[..., 3:], out=np.zeros_like(image[..., :3]),
+                                   where=image[..., 3:] > 0)
+    return (np.clip(image, 0, 1) * 255 + 0.5).astype(np.uint8)
+
+
+def preview_model(task):
+    args, path = task
+    output_paths = preview_paths(args, path)
+    if not args.force and all(os.path.exists(p) for p in output_paths):
+        return path, 0, 'skipped'
+    try:
+        vertices, faces, face_colors = load_preview_mesh(path, args.scale)
+        stepsize = 360.0 / args.views
+        os.makedirs(os.path.dirname(output_paths[0]), exist_ok=True)
+        for i, output_path in enumerate(output_paths):
+            image = render_view(vertices, faces, face_colors, stepsize * i, args.resolution, args.shading, args.supersample)
+            image_io.write_file(output_path, image_io.encode_png(image))
+    except Exception as e:
+        return path, 0, 'failed: {!r}'.format(e)
+    return path, len(output_paths), 'done'
+
+
+def main():
+    args = parse_args()
+    paths = collect_paths(args)
+    print('previewing {} models'.format(len(paths)))
+    start = time.time()
+    tasks = [(args, path) for path in paths]
+    views = 0
+    if args.processes > 1:
+        with Pool(args.processes) as pool:
+            results = pool.imap_unordered(preview_model, tasks, chunksize=4)
+            for path, count, status in results:
+                views += count
+                if status != 'done':
+                    print('{}: {}'.format(path, status))
+    else:
+        for task in tasks:
+            path, count, status = preview_model(task)
+            views += count
+            if status != 'done':
+                print('{}: {}'.format(path, status))
+    elapsed = time.time() - start
+    print('rendered {} views of {} models in {:.2f}s, {:.1f} views/s'.format(
+        views, len(paths), elapsed, views / elapsed if elapsed > 0 else 0.0))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+'''
+
+Render manifest: remembers, for every model, the content hash of its OBJ/MTL files
+and the render parameters used, so that an interrupted or repeated run only renders
+the models (or the single views) whose output is missing or out of date.
+
+The manifest is an append-only JSONL file, the last record of a model wins.
+Appending short lines is safe with several workers writing to the same file.
+
+'''
+
+import hashlib
+import json
+import os
+
+MANIFEST_NAME = 'render_manifest.jsonl'
+
+# Render parameters that change the rendered images
+RENDER_PARAMS = ['views', 'resolution', 'engine', 'scale', 'format', 'animation', 'frames']
+
+# Parameters that change the images only when not at their default, so that existing entries stay valid
+OPTIONAL_RENDER_PARAMS = {
+    'max_faces': 0,
+    'max_screen_error': 0,
+    'quality': None,
+    'passes': None,
+    'frame_stride': 1,
+    'preview_resolution': 0,
+    'video_format': 'avi',
+    'texture_size': '0',
+    'color_depth': '8',
+    'loader': 'bpy',
+    'remove_doubles': True,
+    'edge_split': True,
+    'png_compression': 15,
+    'jpeg_quality': 90,
+}
+
+FORMAT_EXTENSIONS = {
+    'PNG': '.png',
+    'OPEN_EXR': '.exr',
+    'JPEG': '.jpg',
+    'BMP': '.bmp',
+    'TIFF': '.tif',
+    'TARGA': '.tga',
+    'WEBP': '.webp',
+}
+
+
+def manifest_path(output_folder):
+    return os.path.join(os.path.abspath(output_folder), MANIFEST_NAME)
+
+
+def load_manifest(path):
+    manifest = {}
+    if not os.path.exists(path):
+        return manifest
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # Truncated last line of a crashed run
+                continue
+            manifest[entry['path']] = entry
+    return manifest
+
+
+def append_entry(path, entry):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'a') as f:
+        f.write(json.dumps(entry) + '\n')
+
+
+def render_params(args):
+    params = {name: getattr(args, name) for name in RENDER_PARAMS}
+    for name, default in OPTIONAL_RENDER_PARAMS.items():
+        if getattr(args, name, default) != default:
+            params[name] = getattr(args, name)
+    # The images are encoded by image_io instead of Blender, whatever the number of threads
+    if getattr(args, 'write_behind', 0) > 0:
+        params['write_behind'] = True
+    return params
+
+
+def file_stat(path):
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime_ns]
+
+
+def find_mtl_paths(obj_path, content):
+    mtl_paths = []
+    for line in content.splitlines():
+        if line.startswith(b'mtllib'):
+            name = line[len(b'mtllib'):].strip().decode('utf-8', 'replace')
+            mtl_paths.append(os.path.join(os.path.dirname(obj_path), name))
+    return mtl_paths
+
+
+def model_hash(obj_path, entry=None):
+    '''
+    Returns the content hash of the OBJ file and of its MTL libraries, together with
+    the stat of the files. The hash of the previous entry is reused when the files
+    have not been touched, so that resuming does not read every OBJ again.
+    '''
+    stats = {obj_path: file_stat(obj_path)}
+    if entry is not None and entry.get('stats', {}).get(obj_path) == stats[obj_path]:
+        mtl_paths = [p for p in entry['stats'] if p != obj_path]
+        if all(os.path.exists(p) and entry['stats'][p] == file_stat(p) for p in mtl_paths):
+            return entry['hash'], entry['stats']
+
+    sha = hashlib.sha1()
+    with open(obj_path, 'rb') as f:
+        content = f.read()
+    sha.update(content)
+    for mtl_path in find_mtl_paths(obj_path, content):
+        if os.path.exists(mtl_path):
+            with open(mtl_path, 'rb') as f:
+                sha.update(f.read())
+            stats[mtl_path] = file_stat(mtl_path)
+    return sha.hexdigest(), stats
+
+
+def pending_views(entry, digest, params, view_outputs, exists=os.path.exists):
+    '''
+    Returns the indices of the views that have to be rendered: all of them if the model
+    is new, if its files or render parameters changed or if its last render did not
+    complete (a crash may have left a truncated image), otherwise only the ones with a
+    missing output file. view_outputs has the list of output files of every view, and
+    exists tells whether one of them was written (e.g. to a shard store).
+    '''
+    if entry is None or entry['hash'] != digest or entry['params'] != params or not entry.get('complete'):
+        return list(range(len(view_outputs)))
+    return [i for i, paths in enumerate(view_outputs) if not all(exists(p) for p in paths)]
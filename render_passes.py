@@ -0,0 +1,89 @@
+'''
+
+Storage of the render passes (depth, normal, albedo, object ID) written next to every
+rendered view, as a single multi-layer EXR or as a packed NPZ. The NPZ files are stored
+uncompressed, so that their arrays can be memory-mapped by training data loaders
+without reading or unzipping the whole file. Nothing here depends on bpy.
+
+'''
+
+import os
+import struct
+import zipfile
+
+import numpy as np
+
+PASS_NAMES = ['depth', 'normal', 'albedo', 'id']
+
+PASS_CHANNELS = {'depth': 1, 'normal': 3, 'albedo': 4, 'id': 1}
+
+# Depth keeps full precision: half floats overflow on the background (~1e10) and keep ~3 digits
+PASS_DTYPES = {'depth': np.float32, 'normal': np.float16, 'albedo': np.float16, 'id': np.uint16}
+
+PASSES_EXTENSIONS = {'exr': '.exr', 'npz': '.npz'}
+
+
+def passes_path(view_path, mode):
+    return os.path.splitext(view_path)[0] + '_passes' + PASSES_EXTENSIONS[mode]
+
+
+def pack_passes(pixels):
+    '''
+    Converts the RGBA float pixels of every pass (H, W, 4), top row first, to the
+    arrays stored in the NPZ: depth (H, W), normal (H, W, 3), albedo (H, W, 4) and
+    id (H, W).
+    '''
+    arrays = {}
+    for name in PASS_NAMES:
+        channels = PASS_CHANNELS[name]
+        values = pixels[name][:, :, 0] if channels == 1 else pixels[name][:, :, :channels]
+        if name == 'id':
+            values = np.rint(values)
+        arrays[name] = np.ascontiguousarray(values.astype(PASS_DTYPES[name]))
+    return arrays
+
+
+def save_passes(path, arrays):
+    # np.savez stores the arrays uncompressed, which is what makes them memory-mappable
+    tmp_path = path + '.tmp.npz'
+    np.savez(tmp_path, **arrays)
+    os.replace(tmp_path, path)
+
+
+def _member_offsets(path):
+    offsets = {}
+    with zipfile.ZipFile(path) as zf, open(path, 'rb') as f:
+        for info in zf.infolist():
+            if info.compress_type != zipfile.ZIP_STORED:
+                raise ValueError('{} is compressed, it can not be memory-mapped'.format(path))
+            # The data follows the local file header, whose extra field can differ from the central one
+            f.seek(info.header_offset)
+            header = f.read(30)
+            name_length, extra_length = struct.unpack('<HH', header[26:30])
+            offsets[os.path.splitext(info.filename)[0]] = info.header_offset + 30 + name_length + extra_length
+    return offsets
+
+
+def load_passes(path, mmap=True, names=None):
+    '''
+    Returns the passes stored in a packed NPZ as a dict of arrays. With mmap the arrays
+    are read-only views on the file, and only the pixels actually used are read.
+    '''
+    if not mmap:
+        with np.load(path) as data:
+            return {name: data[name] for name in (names or data.files)}
+
+    passes = {}
+    with open(path, 'rb') as f:
+        for name, offset in _member_offsets(path).items():
+            if names is not None and name not in names:
+                continue
+            f.seek(offset)
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+            passes[name] = np.memmap(path, dtype=dtype, mode='r', offset=f.tell(), shape=shape,
+                                     order='F' if fortran_order else 'C')
+    return passes
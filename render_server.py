@@ -0,0 +1,338 @@
+'''
+
+Long-lived local render service. The scene, compositor, lights and camera are set up
+once, and the process stays warm between requests, so that rendering a model for
+inspection does not pay the start of Blender and the scene setup every time.
+
+Requests are JSON posted to http://127.0.0.1:<port>/render, e.g.
+
+{"path": "input_examples/chair/a682c4bf731e3af2ca6a405498436716.obj", "views": 8, "resolution": 256}
+
+or {"model_id": ..., "category": "Chair"} for a model of data_root. They are rendered
+one at a time from a bounded queue, and the results are kept in an on-disk LRU cache,
+keyed by the content of the model and the render parameters, from which the repeated
+requests are served. The images are served under /files/<key>/<name>.
+
+Options not listed here are the ones of render_shapenet_obj.py, used for every request:
+
+python render_server.py --port 8765 --cache_size 2048 --engine CYCLES --quality draft
+
+'''
+
+import argparse
+import hashlib
+import json
+import os
+import queue
+import re
+import shutil
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import bpy
+import render_manifest
+import render_shapenet_obj
+from shape_index import shapenet_obj_path
+
+# Parameters a request can set, with their limits
+MAX_VIEWS = 360
+MAX_RESOLUTION = 4096
+
+KEY_PATTERN = re.compile(r'[0-9a-f]{40}')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Serves renderings of OBJ files from a warm Blender scene.')
+
+    parser.add_argument('--host', type=str, default='127.0.0.1',
+                        help='address to listen on, localhost only by default')
+
+    parser.add_argument('--port', type=int, default=8765,
+                        help='port to listen on')
+
+    parser.add_argument('--cache_dir', type=str, default='./render_cache',
+                        help='folder of the cached renderings')
+
+    parser.add_argument('--cache_size', type=int, default=2048,
+                        help='size of the cache in MB, the least recently used renderings are removed beyond it')
+
+    parser.add_argument('--queue_size', type=int, default=16,
+                        help='number of requests waiting to be rendered, beyond which requests are refused')
+
+    parser.add_argument('--request_timeout', type=float, default=600,
+                        help='seconds a request waits for its rendering')
+
+    args, render_argv = parser.parse_known_args()
+    return args, render_argv
+
+
+class RenderCache:
+    '''
+    One folder per rendering, with its images and a meta.json whose modification time
+    is the last use. The least recently used folders are removed beyond max_bytes.
+    '''
+
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def entry_dir(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def get(self, key):
+        meta_path = os.path.join(self.entry_dir(key), 'meta.json')
+        with self.lock:
+            if not os.path.exists(meta_path):
+                return None
+            os.utime(meta_path)
+            with open(meta_path) as f:
+                return json.load(f)
+
+    def put(self, key, files, meta):
+        # Moves the rendered files in the cache, then evicts the oldest entries
+        tmp_dir = self.entry_dir(key) + '.tmp'
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+        for path in files:
+            shutil.move(path, os.path.join(tmp_dir, os.path.basename(path)))
+        meta = dict(meta, key=key, files=[os.path.basename(path) for path in files])
+        with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+        with self.lock:
+            shutil.rmtree(self.entry_dir(key), ignore_errors=True)
+            os.replace(tmp_dir, self.entry_dir(key))
+            self.evict(keep=key)
+        return meta
+
+    def entries(self):
+        entries = []
+        for key in os.listdir(self.cache_dir):
+            meta_path = os.path.join(self.cache_dir, key, 'meta.json')
+            if key.endswith('.tmp') or not os.path.exists(meta_path):
+                continue
+            size = sum(entry.stat().st_size for entry in os.scandir(os.path.join(self.cache_dir, key)))
+            entries.append((os.path.getmtime(meta_path), size, key))
+        return sorted(entries)
+
+    def evict(self, keep=None):
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, key in entries:
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            shutil.rmtree(self.entry_dir(key), ignore_errors=True)
+            total -= size
+
+    def file_path(self, key, name):
+        # Only the files of an entry: the key is a SHA-1 and the name a plain file name
+        if not KEY_PATTERN.fullmatch(key) or not name or name != os.path.basename(name) or name.startswith('.'):
+            return None
+        path = os.path.join(self.entry_dir(key), name)
+        return path if os.path.isfile(path) else None
+
+
+class RenderJob:
+    def __init__(self, key, path, views, resolution):
+        self.key = key
+        self.path = path
+        self.views = views
+        self.resolution = resolution
+        self.done = threading.Event()
+        # Folder where the views are rendered before moving to the cache
+        self.work_dir = None
+        self.result = None
+        self.error = None
+
+
+class RenderService:
+    '''
+    Renders the queued jobs one at a time in the thread calling run(), which must be the
+    main thread as bpy is not thread-safe. The HTTP handlers only enqueue and wait.
+    '''
+
+    def __init__(self, args, render_argv):
+        self.args = args
+        self.base_args = render_shapenet_obj.parse_args(render_argv)
+        self.cache = RenderCache(args.cache_dir, args.cache_size * 2**20)
+        self.jobs = queue.Queue(maxsize=args.queue_size)
+        self.pending = {}
+        self.models = {}
+        self.lock = threading.Lock()
+        self.rendered = 0
+        self.hits = 0
+        start = time.time()
+        self.rig = render_shapenet_obj.setup_scene(self.base_args)
+        print('scene ready in {:.2f}s'.format(time.time() - start))
+
+    def request_key(self, path, views, resolution):
+        # The hash of a model is only computed again when its files change
+        with self.lock:
+            entry = self.models.get(path)
+        digest, stats = render_manifest.model_hash(path, entry)
+        with self.lock:
+            self.models[path] = {'hash': digest, 'stats': stats}
+        params = dict(render_manifest.render_params(self.base_args), views=views, resolution=resolution)
+        return hashlib.sha1(json.dumps([digest, params], sort_keys=True).encode('utf-8')).hexdigest()
+
+    def submit(self, path, views, resolution):
+        '''
+        Returns the cached result of the request, or the job rendering it, shared by the
+        identical requests waiting at the same time. Raises queue.Full if the queue is.
+        '''
+        key = self.request_key(path, views, resolution)
+        result = self.cache.get(key)
+        if result is not None:
+            self.hits += 1
+            return result, None
+        with self.lock:
+            job = self.pending.get(key)
+            if job is None:
+                job = RenderJob(key, path, views, resolution)
+                self.jobs.put_nowait(job)
+                self.pending[key] = job
+        return None, job
+
+    def render(self, job):
+        args = argparse.Namespace(**vars(self.base_args))
+        args.obj_path = job.path
+        args.views = job.views
+        args.resolution = job.resolution
+        args.output_folder = os.path.join(self.cache.cache_dir, 'work')
+        args.animation = False
+        # One frame-range job, without saving a .blend file per view
+        args.batch_views = True
+        args.force = True
+        args.output_mode = 'files'
+        args.stats_log = None
+
+        scene = bpy.context.scene
+        scene.render.resolution_x = job.resolution
+        scene.render.resolution_y = job.resolution
+        model_identifier, fp = render_shapenet_obj.model_output(args, job.path)
+        # The files of an earlier render of the model must not end up in the cache entry
+        shutil.rmtree(fp, ignore_errors=True)
+        job.work_dir = fp
+        start = time.time()
+        # Rendered with force, the server has no use for a render manifest
+        render_shapenet_obj.render_model(args, job.path, self.rig, {}, None)
+        files = render_shapenet_obj.view_file_paths(args, model_identifier, fp)
+        missing = [os.path.basename(path) for path in files if not os.path.isfile(path)]
+        if missing:
+            raise RuntimeError('{} of the {} views were not rendered: {}'.format(len(missing), job.views, ', '.join(missing)))
+        meta = {'path': job.path, 'model': model_identifier, 'views': job.views, 'resolution': job.resolution,
+                'seconds': time.time() - start}
+        result = self.cache.put(job.key, files, meta)
+        shutil.rmtree(fp, ignore_errors=True)
+        return result
+
+    def run(self):
+        while True:
+            job = self.jobs.get()
+            try:
+                job.result = self.render(job)
+                self.rendered += 1
+            except Exception as e:
+                render_shapenet_obj.remove_models()
+                if job.work_dir is not None:
+                    shutil.rmtree(job.work_dir, ignore_errors=True)
+                job.error = repr(e)
+            with self.lock:
+                self.pending.pop(job.key, None)
+            job.done.set()
+
+    def status(self):
+        return {'queued': self.jobs.qsize(), 'rendered': self.rendered, 'cache_hits': self.hits,
+                'cache_entries': len(self.cache.entries())}
+
+
+def make_handler(service):
+    class RenderHandler(BaseHTTPRequestHandler):
+        def send_json(self, code, payload):
+            body = json.dumps(payload).encode('utf-8')
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == '/status':
+                self.send_json(200, service.status())
+                return
+            parts = self.path.strip('/').split('/')
+            if len(parts) == 3 and parts[0] == 'files':
+                path = service.cache.file_path(parts[1], parts[2])
+                if path is not None:
+                    with open(path, 'rb') as f:
+                        body = f.read()
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'image/png' if path.endswith('.png') else 'application/octet-stream')
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                    return
+            self.send_json(404, {'error': 'not found'})
+
+        def do_POST(self):
+            if self.path != '/render':
+                self.send_json(404, {'error': 'not found'})
+                return
+            try:
+                request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                if not isinstance(request, dict):
+                    raise ValueError('the request must be a JSON object')
+                if 'path' in request:
+                    path = os.path.abspath(request['path'])
+                else:
+                    path = shapenet_obj_path(service.base_args.data_root, request['category'], request['model_id'])
+                views = int(request.get('views', service.base_args.views))
+                resolution = int(request.get('resolution', service.base_args.resolution))
+                if not os.path.isfile(path) or not 0 < views <= MAX_VIEWS or not 0 < resolution <= MAX_RESOLUTION:
+                    raise ValueError('no such model, or views/resolution out of range')
+            except (ValueError, KeyError) as e:
+                self.send_json(400, {'error': str(e)})
+                return
+
+            try:
+                result, job = service.submit(path, views, resolution)
+            except queue.Full:
+                self.send_json(503, {'error': 'render queue full, retry later'})
+                return
+            cached = result is not None
+            if job is not None:
+                if not job.done.wait(service.args.request_timeout):
+                    self.send_json(504, {'error': 'rendering not finished, retry later', 'key': job.key})
+                    return
+                if job.error is not None:
+                    self.send_json(500, {'error': job.error})
+                    return
+                result = job.result
+            urls = ['/files/{}/{}'.format(result['key'], name) for name in result['files']]
+            self.send_json(200, dict(result, cached=cached, urls=urls))
+
+        def log_message(self, format, *args):
+            sys.stderr.write('[{}] {}\n'.format(time.strftime('%H:%M:%S'), format % args))
+
+    return RenderHandler
+
+
+def main():
+    args, render_argv = parse_args()
+    service = RenderService(args, render_argv)
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(service))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print('serving on http://{}:{}'.format(args.host, args.port))
+    try:
+        service.run()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,75 +1,68 @@
-import argparse, sys, os, math, re
+import argparse, sys, os, math, re, time, traceback, json
 import bpy
+import material_cache
+import geometry_dedup
+import image_io
+import mesh_io
+import numpy as np
+import render_manifest
+import render_passes
+import render_stats
+import utils
+import render_workers
+import shard_store
+import turntable
 from glob import glob
+from shape_index import class_to_class_id, get_obj_paths, load_shape_index, iter_shape_paths, read_captions, ORDERS
 
-class_to_class_id = {
-    'Table': '04379243',
-    'Jar': '03593526',
-    'Skateboard': '04225987',
-    'Car': '02958343',
-    'Bottle': '02876657',
-    'Tower': '04460130',
-    'Chair': '03001627',
-    'Bookshelf': '02871439',
-    'Camera': '02942699',
-    'Airplane': '02691156',
-    'Laptop': '03642806',
-    'Basket': '02801938',
-    'Sofa': '04256520',
-    'Knife': '03624134',
-    'Can': '02946921',
-    'Rifle': '04090263',
-    'Train': '04468005',
-    'Pillow': '03938244',
-    'Lamp': '03636649',
-    'Trash bin': '02747177',
-    'Mailbox': '03710193',
-    'Watercraft': '04530566',
-    'Motorbike': '03790512',
-    'Dishwasher': '03207941',
-    'Bench': '02828884',
-    'Pistol': '03948459',
-    'Rocket': '04099429',
-    'Loudspeaker': '03691459',
-    'File cabinet': '03337140',
-    'Bag': '02773838',
-    'Cabinet': '02933112',
-    'Bed': '02818832',
-    'Birdhouse': '02843684',
-    'Display': '03211117',
-    'Piano': '03928116',
-    'Earphone': '03261776',
-    'Telephone': '04401088',
-    'Stove': '04330267',
-    'Microphone': '03759954',
-    'Bus': '02924116',
-    'Mug': '03797390',
-    'Remote': '04074963',
-    'Bathtub': '02808440',
-    'Bowl': '02880940',
-    'Keyboard': '03085013',
-    'Guitar': '03467517',
-    'Washer': '04554684',
-    'Bicycle': '02834778',
-    'Faucet': '03325088',
-    'Printer': '04004475',
-    'Cap': '02954340'
-}
-
-def get_obj_paths(root_directory):
-    obj_paths = []
-    for dirpath, _, filenames in os.walk(root_directory):
-        for filename in filenames:
-            if filename.endswith(".obj"):
-                obj_paths.append(os.path.join(dirpath, filename))
-    return obj_paths
-
-def parse_args():
+def collect_paths(args):
+    if args.paths_file is not None:
+        with open(args.paths_file) as f:
+            return [line.strip() for line in f if line.strip()]
+    if args.obj_path is not None:
+        return [args.obj_path]
+    if args.category=='all':
+        categories = ['Table', 'Chair']
+    else:
+        categories = [args.category]
+    if args.csv_path is not None:
+        # Only the captioned models, from the cached index instead of walking the dataset
+        index_path = args.shape_index or os.path.join(os.path.abspath(args.output_folder), 'shape_index.json')
+        entries = load_shape_index(index_path, args.data_root, args.csv_path)
+        return list(iter_shape_paths(entries, categories, args.order))
+    paths = []
+    for category in categories:
+        # Iterate over all the paths of the models
+        root_directory = os.path.join(args.data_root, class_to_class_id[category])
+        paths += get_obj_paths(root_directory)
+    return paths
+
+# Color space of the images of a view transform on an sRGB display, applied by the
+# compositor with --write_behind
+VIEW_TRANSFORM_SPACES = {'Standard': 'sRGB', 'Filmic': 'Filmic sRGB', 'Filmic Log': 'Filmic Log', 'AgX': 'AgX Base sRGB'}
+
+# Distance along Z between the models rendered together with --pack, far enough for
+# every camera to see only its own model
+PACK_SPACING = 100.0
+
+def parse_args(argv=None):
     parser = argparse.ArgumentParser(description='Renders given obj file by rotation a camera around it.')
 
-    parser.add_argument('--animation', action="store_true", help='if set, the output of this script will be an AVI video of the rotating 3D shape')
+    parser.add_argument('--animation', action="store_true", help='if set, the output of this script will be a video of the rotating 3D shape')
     
     parser.add_argument('--frames', type=int, default=400, help='the number of frames of the animation')
+
+    parser.add_argument('--frame_stride', type=int, default=1,
+                        help='Render one frame every frame_stride frames of the animation. The video keeps the same duration, at a lower frame rate.')
+
+    parser.add_argument('--preview_resolution', type=int, default=0,
+                        help='Resolution of the animation, if lower than --resolution. 0 uses --resolution.')
+
+    parser.add_argument('--video_format', type=str, default='avi', choices=list(turntable.VIDEO_FORMATS),
+                        help='Format of the animation: AVI_JPEG, H.264 MP4, VP9 WebM, or animated WebP (encoded with ffmpeg).')
+
+    parser.add_argument('--frame_range', type=str, default=None,
+                        help='first:last frames of the animation to render as a video segment. Set by the coordinator when the frames of a model are split between workers.')
     
     parser.add_argument('--views', type=int, default=20,
                         help='number of views to be rendered')
@@ -80,6 +73,15 @@ def parse_args():
     parser.add_argument('--category', type=str, default='Chair', choices=["Chair", "Table", "all"],
                         help='The name of the category of shapes to render.')
     
+    parser.add_argument('--csv_path', type=str, default=None,
+                        help='Text2Shape captions CSV. If set, only the models with a caption are rendered, taken from a cached shape index instead of walking data_root.')
+
+    parser.add_argument('--shape_index', type=str, default=None,
+                        help='Path of the cached shape index built from --csv_path. Defaults to shape_index.json in the output folder.')
+
+    parser.add_argument('--order', type=str, default='index', choices=ORDERS,
+                        help='Order in which the indexed models are rendered. largest_first balances the load of the workers.')
+
     parser.add_argument('--obj_path', type=str, default=None,
                         help='The path of the single .obj file to render')    
     
@@ -95,6 +97,27 @@ def parse_args():
     parser.add_argument('--edge_split', type=bool, default=True,
                         help='Adds edge split filter.')
     
+    parser.add_argument('--loader', type=str, default='bpy', choices=['bpy', 'numpy'],
+                        help='How meshes are loaded: with the Blender OBJ importer and operators, or parsed and preprocessed with NumPy and built with bulk buffers.')
+
+    parser.add_argument('--mesh_cache', type=str, default=None,
+                        help='Folder where the numpy loader caches the preprocessed geometry of every model as .npz, so that later runs skip parsing and preprocessing.')
+
+    parser.add_argument('--material_cache', action="store_true",
+                        help='if set, the materials and textures of the models are kept from one model to the next and reused by the models with the same material values and texture files, instead of being loaded again')
+
+    parser.add_argument('--material_cache_size', type=int, default=256,
+                        help='Number of materials, and of textures, kept by --material_cache.')
+
+    parser.add_argument('--texture_size', type=str, default='0',
+                        help='With --material_cache, textures larger than this size are downscaled once when cached. auto matches the render resolution, 0 keeps the original size.')
+
+    parser.add_argument('--max_faces', type=int, default=0,
+                        help='Face budget: meshes with more faces are simplified before rendering. 0 disables it.')
+
+    parser.add_argument('--max_screen_error', type=float, default=0,
+                        help='Simplify meshes by clustering vertices closer than this many pixels at --resolution (numpy loader only). 0 disables it.')
+
     parser.add_argument('--depth_scale', type=float, default=1.4,
                         help='Scaling that is applied to depth. Depends on size of mesh. Try out various values until you get a good result. Ignored if format is OPEN_EXR.')
     
@@ -104,17 +127,258 @@ def parse_args():
     parser.add_argument('--format', type=str, default='PNG',
                         help='Format of files generated. Either PNG or OPEN_EXR')
     
+    parser.add_argument('--png_compression', type=int, default=15,
+                        help='PNG compression in percent, as in Blender: 0 writes fastest, 100 writes the smallest files.')
+
+    parser.add_argument('--jpeg_quality', type=int, default=90,
+                        help='Quality of the JPEG images, from 0 to 100.')
+
+    parser.add_argument('--write_behind', type=int, default=0,
+                        help='Number of threads encoding and writing the images of the views while the next views render, instead of Blender writing them after every render, and without saving the .blend file after every view. The images keep the view transform of the scene. Supports the PNG, WEBP (lossless) and JPEG formats. 0 disables it.')
+
+    parser.add_argument('--write_queue', type=int, default=0,
+                        help='Number of images waiting to be written with --write_behind, beyond which the render waits. 0 means twice the number of threads.')
+
     parser.add_argument('--resolution', type=int, default=600,
                         help='Resolution of the images.')
     
     parser.add_argument('--engine', type=str, default='CYCLES',
                         help='Blender internal engine for rendering. E.g. CYCLES, BLENDER_EEVEE, ...')
 
-    args = parser.parse_args()
+    parser.add_argument('--batch_views', action="store_true",
+                        help='if set, all the views of a model are rendered as one frame-range job, with the camera keyframed over the views, instead of one render (and .blend save) per view')
+
+    parser.add_argument('--passes', type=str, default=None, choices=['exr', 'npz'],
+                        help='Also write depth, normal, albedo and object ID of every view, from the same render: as one multi-layer EXR, or packed in one NPZ (see render_passes.load_passes).')
+
+    parser.add_argument('--pack', type=int, default=1,
+                        help='Number of models rendered together by every render call, each one by its own camera, to amortize the per-render overhead on small views.')
+
+    parser.add_argument('--pack_check', action="store_true",
+                        help='if set with --pack, render every view of the first pack again one model at a time, and print the speedup of the pack and its largest and mean pixel differences with the models rendered alone')
+
+    parser.add_argument('--quality', type=str, default=None, choices=list(utils.QUALITY_PRESETS),
+                        help='Cycles preset for CPU rendering: sets samples, adaptive sampling threshold, light bounces and tile size together, and denoises with OpenImageDenoise. If not set, Blender defaults are used.')
+
+    parser.add_argument('--stats_log', type=str, default=None,
+                        help='JSONL file where per-model and per-view stage durations, face/vertex counts, bpy.data block counts and RSS are appended. Summarize it with render_stats.py.')
+
+    parser.add_argument('--output_mode', type=str, default='files', choices=['files', 'tar'],
+                        help='files writes one image per view in output_folder/<class>/<model>/. tar appends the views, their camera metadata and the captions of the model to WebDataset tar shards, indexed for random access by modelId and view angle.')
+
+    parser.add_argument('--store_dir', type=str, default=None,
+                        help='Folder of the tar shards and of their index, with --output_mode tar. Defaults to shards/ in the output folder.')
+
+    parser.add_argument('--shard_size', type=int, default=shard_store.SHARD_SIZE_MB,
+                        help='Size in MB after which a new tar shard is started.')
+
+    parser.add_argument('--dedup', action="store_true",
+                        help='if set, models with the same geometry and materials are rendered once, and their outputs are hard-linked for the duplicates. The duplicates and the render time saved are listed in dedup_report.json in the output folder.')
+
+    parser.add_argument('--dedup_index', type=str, default=None,
+                        help='Path of the cached geometry fingerprints used by --dedup. Defaults to geometry_index.json in the output folder.')
+
+    parser.add_argument('--force', action="store_true",
+                        help='if set, render every model again, ignoring the render manifest in the output folder')
+
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of parallel Blender worker processes. The models are split in one shard per worker.')
+
+    parser.add_argument('--threads', type=int, default=0,
+                        help='Render threads per worker. 0 lets Blender decide, or splits the CPU cores evenly when --workers > 1.')
+
+    parser.add_argument('--model_timeout', type=float, default=0,
+                        help='Seconds after which a worker stuck on a model is killed and restarted on the following models. 0 disables the timeout. Setting it (or --max_memory) runs the models in supervised workers even with --workers 1.')
+
+    parser.add_argument('--max_memory', type=int, default=0,
+                        help='Resident memory in MB above which a worker is killed and restarted on the following models. 0 disables the limit.')
+
+    parser.add_argument('--retries', type=int, default=1,
+                        help='Number of times the failed models are rendered again, each time at half the resolution and with at most --retry_max_faces faces. The failures are listed in dead_letter.jsonl in the output folder.')
+
+    parser.add_argument('--retry_max_faces', type=int, default=20000,
+                        help='Face budget of the failed models when they are retried.')
+
+    parser.add_argument('--paths_file', type=str, default=None,
+                        help='Text file with one .obj path per line to render. Takes precedence over --obj_path and --category.')
+
+    parser.add_argument('--worker_report', type=str, default=None,
+                        help='JSONL file where the outcome of every model is appended. Set by the coordinator for its workers.')
+
+    args = parser.parse_args(argv)
+    if args.pack > 1 and (args.animation or args.batch_views or args.passes is not None):
+        parser.error('--pack can not be combined with --animation, --batch_views or --passes')
+    if args.pack_check and args.pack < 2:
+        parser.error('--pack_check needs --pack')
+    if args.write_behind > 0:
+        if args.animation or args.batch_views or args.pack > 1:
+            parser.error('--write_behind can not be combined with --animation, --batch_views or --pack')
+        if args.format not in image_io.WRITE_FORMATS:
+            parser.error('--write_behind supports the formats {}'.format(', '.join(image_io.WRITE_FORMATS)))
     return args
 
 def main():
     args = parse_args()
+
+    paths = collect_paths(args)
+    print('paths: ', len(paths))
+
+    # Render one model of every group of identical ones, the workers get the deduplicated paths
+    groups = None
+    if args.dedup and args.worker_report is None:
+        index_path = args.dedup_index or os.path.join(os.path.abspath(args.output_folder), 'geometry_index.json')
+        fingerprints = geometry_dedup.load_fingerprints(index_path, paths, max(args.workers, 1))
+        groups = geometry_dedup.group_duplicates(paths, fingerprints)
+        paths = [group[0] for group in groups]
+        print('unique models: {}, duplicates: {}'.format(len(groups), sum(len(g) - 1 for g in groups)))
+
+    # Split the work across worker processes, each one running this script on its own shard.
+    # Workers are also used to supervise a single process, which a coordinator can kill
+    supervised = args.worker_report is None and (args.model_timeout > 0 or args.max_memory > 0)
+    if args.workers > 1 or supervised:
+        model_seconds = {}
+        if args.animation and len(paths) < args.workers:
+            # Not enough models to keep the workers busy, split the frames of each one instead
+            render_split_animations(args, paths)
+        else:
+            model_seconds = render_workers.run_coordinator(args, paths)['model_seconds']
+        if groups is not None:
+            link_duplicates(args, groups, fingerprints, model_seconds)
+        return
+
+    rig = setup_scene(args)
+
+    manifest_file = render_manifest.manifest_path(args.output_folder)
+    manifest = render_manifest.load_manifest(manifest_file)
+
+    store = None
+    captions = {}
+    if args.output_mode == 'tar' and not args.animation:
+        store = shard_store.ShardWriter(args.store_dir or os.path.join(os.path.abspath(args.output_folder), 'shards'),
+                                        args.shard_size)
+        if args.csv_path is not None:
+            captions = read_captions(args.csv_path)
+
+    # With --pack, several models are rendered by every render call
+    slots = None
+    batch_size = 1
+    if args.pack > 1:
+        slots = setup_pack(args, rig)
+        batch_size = args.pack
+
+    model_seconds = {}
+    failures = []
+    for i in range(0, len(paths), batch_size):
+        batch = paths[i:i + batch_size]
+        start = time.time()
+        if args.worker_report is not None:
+            # Lets the coordinator know which model to blame if this process hangs or dies
+            for path in batch:
+                render_workers.append_progress(args.worker_report, {'path': path, 'status': 'start', 'time': start})
+        try:
+            if slots is not None:
+                statuses = render_pack(args, batch, rig, slots, manifest, manifest_file, store, captions,
+                                       check=args.pack_check and i == 0)
+            else:
+                statuses = {batch[0]: render_model(args, batch[0], rig, manifest, manifest_file, store, captions)}
+        except Exception as e:
+            traceback.print_exc()
+            print('failed to render {}: {}'.format(', '.join(batch), e))
+            remove_models()
+            for path in batch:
+                failures.append({'path': path, 'error': repr(e)})
+                if args.worker_report is not None:
+                    render_workers.append_progress(args.worker_report, {'path': path, 'status': 'failed', 'error': repr(e)})
+                if args.stats_log is not None:
+                    render_stats.append_record(args.stats_log, {'type': 'model', 'path': path, 'status': 'failed',
+                                                                'error': repr(e), 'rss_mb': render_stats.rss_mb()})
+            continue
+        seconds = (time.time() - start) / len(batch)
+        for path, status in statuses.items():
+            if status == 'done':
+                model_seconds[path] = seconds
+            if args.worker_report is not None:
+                render_workers.append_progress(args.worker_report, {'path': path, 'status': status, 'seconds': seconds})
+    if store is not None:
+        store.close()
+    if rig['writer'] is not None:
+        rig['writer'].close()
+    if args.worker_report is None and failures:
+        # Without a coordinator, the failures are dead-lettered and retried here, in worker processes
+        report = {'done': 0, 'skipped': 0, 'failures': failures, 'seconds': 0.0, 'model_seconds': {}, 'workers': []}
+        model_seconds.update(render_workers.retry_failures(args, report)['model_seconds'])
+    if groups is not None:
+        link_duplicates(args, groups, fingerprints, model_seconds)
+
+def link_duplicates(args, groups, fingerprints, model_seconds):
+    '''
+    Gives the duplicates of every rendered model its outputs, hard-linked in their own
+    folder (or aliased in the index of the shard store), and reports the render time
+    saved, estimated from the time of the rendered model.
+    '''
+    store_dir = args.store_dir or os.path.join(os.path.abspath(args.output_folder), 'shards')
+    use_store = args.output_mode == 'tar' and not args.animation
+    mean_seconds = sum(model_seconds.values()) / len(model_seconds) if model_seconds else 0.0
+    seconds_saved = 0.0
+    linked = 0
+    for group in groups:
+        if len(group) == 1:
+            continue
+        model_identifier, fp = model_output(args, group[0])
+        sources = view_file_paths(args, model_identifier, fp)
+        if args.passes is not None and not args.animation:
+            sources += [render_passes.passes_path(path, args.passes) for path in sources]
+        for duplicate in group[1:]:
+            duplicate_identifier, duplicate_fp = model_output(args, duplicate)
+            if use_store:
+                shard_store.alias_model(store_dir, model_identifier, duplicate_identifier, model_category(duplicate))
+            else:
+                existing = [path for path in sources if os.path.exists(path)]
+                if not existing:
+                    continue
+                os.makedirs(duplicate_fp, exist_ok=True)
+                for path in existing:
+                    name = os.path.basename(path).replace(model_identifier, duplicate_identifier, 1)
+                    geometry_dedup.link_file(path, os.path.join(duplicate_fp, name))
+            linked += 1
+            seconds_saved += model_seconds.get(group[0], mean_seconds)
+
+    report = {
+        'models': sum(len(g) for g in groups),
+        'unique': len(groups),
+        'duplicates': sum(len(g) - 1 for g in groups),
+        'linked': linked,
+        'seconds_saved': seconds_saved,
+        'groups': [g for g in groups if len(g) > 1],
+        'near_duplicates': geometry_dedup.near_duplicates(groups, fingerprints),
+    }
+    report_path = os.path.join(os.path.abspath(args.output_folder), 'dedup_report.json')
+    with open(report_path, 'w') as f:
+        json.dump(report, f, indent=2)
+    print('linked the outputs of {} duplicates, about {:.0f}s of rendering saved. Report: {}'.format(
+        linked, seconds_saved, report_path))
+
+def render_split_animations(args, paths):
+    manifest_file = render_manifest.manifest_path(args.output_folder)
+    manifest = render_manifest.load_manifest(manifest_file)
+    params = render_manifest.render_params(args)
+    for path in paths:
+        model_identifier, fp = model_output(args, path)
+        output_path = view_file_paths(args, model_identifier, fp)[0]
+        digest, stats = render_manifest.model_hash(path, manifest.get(path))
+        if not args.force and not render_manifest.pending_views(manifest.get(path), digest, params, [[output_path]]):
+            print('skipping {}, already rendered'.format(model_identifier))
+            continue
+        os.makedirs(fp, exist_ok=True)
+        if render_workers.run_frame_split(args, path, output_path):
+            render_manifest.append_entry(manifest_file, {'path': path, 'model': model_identifier, 'hash': digest,
+                                                         'stats': stats, 'params': params, 'complete': True})
+
+def setup_scene(args):
+    '''
+    Builds the parts of the scene shared by all the models (render settings, compositor,
+    lights and camera rig) once. Only the mesh and its materials change between models.
+    '''
     # Set up rendering
     context = bpy.context
     scene = bpy.context.scene
@@ -124,8 +388,13 @@ def main():
     render.image_settings.color_mode = 'RGBA' # ('RGB', 'RGBA', ...)
     render.image_settings.color_depth = args.color_depth # ('8', '16')
     render.image_settings.file_format = args.format # ('PNG', 'OPEN_EXR', 'JPEG, ...)
-    render.resolution_x = args.resolution
-    render.resolution_y = args.resolution
+    render.image_settings.compression = args.png_compression
+    render.image_settings.quality = args.jpeg_quality
+    resolution = args.resolution
+    if args.animation and 0 < args.preview_resolution < args.resolution:
+        resolution = args.preview_resolution
+    render.resolution_x = resolution
+    render.resolution_y = resolution
     render.resolution_percentage = 100
     render.film_transparent = True
 
@@ -222,151 +491,748 @@ def main():
         links.new(render_layers.outputs['IndexOB'], divide_node.inputs[0])
         links.new(divide_node.outputs[0], id_file_output.inputs[0])
 
+    # All the passes of a view in one file, from the same render
+    passes_file_output = None
+    if args.passes is not None:
+        passes_file_output = nodes.new(type="CompositorNodeOutputFile")
+        passes_file_output.label = 'Passes Output'
+        passes_file_output.format.file_format = 'OPEN_EXR_MULTILAYER' if args.passes == 'exr' else 'OPEN_EXR'
+        # Full floats, which the depth needs, the format of a multi-layer EXR applies to all its layers
+        passes_file_output.format.color_depth = '32'
+        passes_file_output.format.color_mode = 'RGBA'
+        passes_file_output.file_slots.clear()
+        for name in render_passes.PASS_NAMES:
+            passes_file_output.file_slots.new(name)
+        links.new(render_layers.outputs['Depth'], passes_file_output.inputs['depth'])
+        links.new(render_layers.outputs['Normal'], passes_file_output.inputs['normal'])
+        links.new(alpha_albedo.outputs['Image'], passes_file_output.inputs['albedo'])
+        links.new(render_layers.outputs['IndexOB'], passes_file_output.inputs['id'])
+
+    # The pixels of every view, read back and written by the threads of the writer
+    writer = None
+    if args.write_behind > 0:
+        # The view transform of the scene is applied by the compositor, to straight alpha colors as
+        # when Blender writes the image itself, so that the Viewer node holds the pixels of the file
+        view_settings = scene.view_settings
+        if (view_settings.view_transform not in VIEW_TRANSFORM_SPACES or view_settings.look != 'None'
+                or view_settings.exposure != 0 or view_settings.gamma != 1 or view_settings.use_curve_mapping
+                or scene.display_settings.display_device != 'sRGB'):
+            raise ValueError('--write_behind supports the view transforms {} on an sRGB display, without look, '
+                             'exposure, gamma or curves'.format(', '.join(VIEW_TRANSFORM_SPACES)))
+        straight = nodes.new(type="CompositorNodePremulKey")
+        straight.mapping = 'PREMUL_TO_STRAIGHT'
+        links.new(render_layers.outputs['Image'], straight.inputs['Image'])
+        display = nodes.new(type="CompositorNodeConvertColorSpace")
+        try:
+            display.from_color_space = 'Linear'
+        except TypeError:
+            # Name of the scene linear space since Blender 4.0
+            display.from_color_space = 'Linear Rec.709'
+        display.to_color_space = VIEW_TRANSFORM_SPACES[view_settings.view_transform]
+        links.new(straight.outputs['Image'], display.inputs['Image'])
+        viewer = nodes.new(type="CompositorNodeViewer")
+        viewer.use_alpha = True
+        links.new(display.outputs['Image'], viewer.inputs['Image'])
+        links.new(render_layers.outputs['Alpha'], viewer.inputs['Alpha'])
+        writer = image_io.AsyncWriter(args.write_behind, args.write_queue or None, args.format,
+                                      compression=int(args.png_compression * 9 / 100), quality=args.jpeg_quality,
+                                      linear=False)
+
     # Delete default cube
     context.active_object.select_set(True)
     bpy.ops.object.delete()
 
-    if args.obj_path is not None:
-        paths = [args.obj_path]
-    else:
-        if args.category=='all':
-            categories = ['Table', 'Chair']
-            paths = []
-            for category in categories:
-                # Iterate over all the paths of the models
-                root_directory = os.path.join(args.data_root, class_to_class_id[category])
-                paths += get_obj_paths(root_directory) 
+    if args.threads > 0:
+        render.threads_mode = 'FIXED'
+        render.threads = args.threads
+    if args.quality is not None:
+        if args.engine != 'CYCLES':
+            print('--quality only applies to CYCLES, ignored for {}'.format(args.engine))
         else:
-            root_directory = os.path.join(args.data_root, class_to_class_id[args.category])
-            paths = get_obj_paths(root_directory)             
-    
-    print('paths: ', len(paths))
-    count = 0
-    for path in paths:
-        count +=1
-        # Import textured mesh
-        bpy.ops.object.select_all(action='DESELECT')
+            utils.set_quality_preset(scene, args.quality, args.threads)
 
-        bpy.ops.import_scene.obj(filepath=path)
+    # Make light just directional, disable shadows.
+    light = bpy.data.lights['Light']
+    light.type = 'SUN'
+    light.use_shadow = False
+    # Possibly disable specular shading:
+    light.specular_factor = 1.0
+    light.energy = 10.0
+
+    # Add another light source so stuff facing away from light is not completely dark
+    bpy.ops.object.light_add(type='SUN')
+    light2 = bpy.data.lights['Sun']
+    light2.use_shadow = False
+    light2.specular_factor = 1.0
+    light2.energy = 0.015
+    bpy.data.objects['Sun'].rotation_euler = bpy.data.objects['Light'].rotation_euler
+    bpy.data.objects['Sun'].rotation_euler[0] += 180
+
+    # Place camera
+    cam = scene.objects['Camera']
+    cam.location = (0, 1, 0.6)
+    cam.data.lens = 35
+    cam.data.sensor_width = 32
+
+    cam_constraint = cam.constraints.new(type='TRACK_TO')
+    cam_constraint.track_axis = 'TRACK_NEGATIVE_Z'
+    cam_constraint.up_axis = 'UP_Y'
+
+    cam_empty = bpy.data.objects.new("Empty", None)
+    cam_empty.location = (0, 0, 0)
+    cam.parent = cam_empty
 
-        obj = bpy.context.selected_objects[0]
+    scene.collection.objects.link(cam_empty)
+    context.view_layer.objects.active = cam_empty
+    cam_constraint.target = cam_empty
 
+    # Materials and textures shared by the models rendered by this process
+    materials = None
+    if args.material_cache:
+        materials = material_cache.MaterialCache(args.material_cache_size,
+                                                 material_cache.texture_size(args.texture_size, args.resolution))
+
+    return {
+        'camera': cam,
+        'cam_empty': cam_empty,
+        'depth_output': depth_file_output,
+        'normal_output': normal_file_output,
+        'albedo_output': albedo_file_output,
+        'id_output': id_file_output,
+        'passes_output': passes_file_output,
+        'material_cache': materials,
+        'writer': writer,
+    }
+
+def import_model(args, path, model_identifier, timings, materials=None):
+    context = bpy.context
+
+    if args.loader == 'numpy':
+        cache_path = None
+        if args.mesh_cache is not None:
+            cache_path = os.path.join(args.mesh_cache, model_identifier + '.npz')
+        cell_size = None
+        if args.max_screen_error > 0:
+            cell_size = mesh_io.screen_space_cell_size(args.resolution, args.max_screen_error)
+        with render_stats.stage(timings, 'load_mesh'):
+            mesh = mesh_io.load_mesh(path, cache_path, scale=args.scale,
+                                     remove_doubles=args.remove_doubles, edge_split=args.edge_split,
+                                     max_faces=args.max_faces or None, cell_size=cell_size)
+        if len(mesh['faces']) == 0:
+            raise ValueError('no faces loaded from {}'.format(path))
+        with render_stats.stage(timings, 'build_mesh'):
+            obj = utils.create_mesh_object(model_identifier, mesh)
+        # Same orientation the OBJ importer gives to the object (Y up to Z up)
+        obj.rotation_euler = (math.radians(90), 0, 0)
+        bpy.ops.object.select_all(action='DESELECT')
+        obj.select_set(True)
         context.view_layer.objects.active = obj
+    else:
+        obj = import_model_bpy(args, path, timings)
 
-        # Possibly disable specular shading
+    # Possibly disable specular shading
+    if materials is not None:
+        # Reuses the materials and textures of the previous models, already set up
+        with render_stats.stage(timings, 'materials'):
+            reused, created = materials.apply(obj)
+        print('materials: {} reused, {} new, {} cached'.format(reused, created, len(materials.materials)))
+    else:
         for slot in obj.material_slots:
-            node = slot.material.node_tree.nodes['Principled BSDF']
-            node.inputs['Specular'].default_value = 0.05
+            material_cache.set_specular(slot.material)
+
+    # Set objekt IDs
+    obj.pass_index = 1
+
+    return obj
 
-        if args.scale != 1:
-            bpy.ops.transform.resize(value=(args.scale,args.scale,args.scale))
-            bpy.ops.object.transform_apply(scale=True)
-        if args.remove_doubles:
+def import_model_bpy(args, path, timings):
+    context = bpy.context
+
+    # Import textured mesh
+    bpy.ops.object.select_all(action='DESELECT')
+
+    with render_stats.stage(timings, 'import'):
+        bpy.ops.import_scene.obj(filepath=path)
+
+    if not bpy.context.selected_objects:
+        raise ValueError('no mesh imported from {}'.format(path))
+    obj = bpy.context.selected_objects[0]
+
+    context.view_layer.objects.active = obj
+
+    if args.scale != 1:
+        bpy.ops.transform.resize(value=(args.scale,args.scale,args.scale))
+        bpy.ops.object.transform_apply(scale=True)
+    if args.remove_doubles:
+        with render_stats.stage(timings, 'remove_doubles'):
             bpy.ops.object.mode_set(mode='EDIT')
             bpy.ops.mesh.remove_doubles()
             bpy.ops.object.mode_set(mode='OBJECT')
-        if args.edge_split:
+    if args.max_screen_error > 0:
+        print('--max_screen_error is only supported by the numpy loader, ignored')
+    if args.max_faces > 0:
+        with render_stats.stage(timings, 'decimate'):
+            num_faces = sum(len(polygon.vertices) - 2 for polygon in obj.data.polygons)
+            if num_faces > args.max_faces:
+                bpy.ops.object.modifier_add(type='DECIMATE')
+                context.object.modifiers["Decimate"].ratio = args.max_faces / num_faces
+                bpy.ops.object.modifier_apply(modifier="Decimate")
+        print('decimation: {} -> {} faces'.format(num_faces, sum(len(polygon.vertices) - 2 for polygon in obj.data.polygons)))
+    if args.edge_split:
+        with render_stats.stage(timings, 'edge_split'):
             bpy.ops.object.modifier_add(type='EDGE_SPLIT')
             context.object.modifiers["EdgeSplit"].split_angle = 1.32645
             bpy.ops.object.modifier_apply(modifier="EdgeSplit")
 
-        # Set objekt IDs
-        obj.pass_index = 1
-
-        # Make light just directional, disable shadows.
-        light = bpy.data.lights['Light']
-        light.type = 'SUN'
-        light.use_shadow = False
-        # Possibly disable specular shading:
-        light.specular_factor = 1.0
-        light.energy = 10.0
-
-        # Add another light source so stuff facing away from light is not completely dark
-        bpy.ops.object.light_add(type='SUN')
-        light2 = bpy.data.lights['Sun']
-        light2.use_shadow = False
-        light2.specular_factor = 1.0
-        light2.energy = 0.015
-        bpy.data.objects['Sun'].rotation_euler = bpy.data.objects['Light'].rotation_euler
-        bpy.data.objects['Sun'].rotation_euler[0] += 180
-
-        # Place camera
-        cam = scene.objects['Camera']
-        cam.location = (0, 1, 0.6)
-        cam.data.lens = 35
-        cam.data.sensor_width = 32
+    return obj
+
+def remove_models():
+    '''
+    Removes the imported meshes from the scene, together with the meshes, materials and
+    images left without users, so that bpy.data does not grow from one model to the next.
+    '''
+    # A model failing in edit mode would leave the scene there
+    if bpy.context.object is not None and bpy.context.object.mode != 'OBJECT':
+        bpy.ops.object.mode_set(mode='OBJECT')
+    for obj in list(bpy.context.scene.objects):
+        if obj.type == 'MESH':
+            bpy.data.objects.remove(obj, do_unlink=True)
+    bpy.data.orphans_purge(do_local_ids=True, do_linked_ids=True, do_recursive=True)
+
+def bpy_data_counts():
+    return {name: len(getattr(bpy.data, name)) for name in ('objects', 'meshes', 'materials', 'images', 'actions')}
+
+def model_output(args, path):
+    if args.obj_path is not None:
+        model_identifier = os.path.splitext(os.path.basename(path))[0]
+        fp = os.path.join(os.path.abspath(args.output_folder), model_identifier)
+    else:
+        model_identifier = os.path.normpath(path).split(os.sep)[-3]
+        class_identifier = os.path.normpath(path).split(os.sep)[-4]
+        fp = os.path.join(os.path.abspath(args.output_folder), class_identifier, model_identifier)
+    return model_identifier, fp
+
+def model_category(path):
+    # The category of the synset folder of the model, None for a single OBJ outside the dataset
+    class_id = os.path.normpath(path).split(os.sep)[-4:-3]
+    for category, category_id in class_to_class_id.items():
+        if class_id == [category_id]:
+            return category
+    return None
+
+def store_member(path):
+    # Key and extension of an output file in the shard store: <key>.png, <key>.passes.npz, ...
+    name, ext = os.path.splitext(os.path.basename(path))
+    if name.endswith('_passes'):
+        return name[:-len('_passes')], 'passes' + ext
+    return name, ext[1:]
+
+def view_metadata(args, rig, model_identifier, category, view, captions):
+    angle = 360.0 / args.views * view
+    camera = rig['camera']
+    # The camera orbits the origin with its parent empty, rotated about Z by the view angle
+    x, y, z = camera.location
+    theta = math.radians(angle)
+    render = bpy.context.scene.render
+    return {
+        'model_id': model_identifier,
+        'category': category,
+        'view': view,
+        'angle': angle,
+        'camera': {
+            'location': [x * math.cos(theta) - y * math.sin(theta), x * math.sin(theta) + y * math.cos(theta), z],
+            'target': [0.0, 0.0, 0.0],
+            'lens': camera.data.lens,
+            'sensor_width': camera.data.sensor_width,
+            'resolution': [render.resolution_x, render.resolution_y],
+        },
+        'captions': captions.get(model_identifier, []),
+    }
+
+def store_views(args, rig, store, captions, path, model_identifier, fp, views, view_outputs):
+    # Moves the files written for every view into the shard store
+    category = model_category(path)
+    for i in views:
+        metadata = view_metadata(args, rig, model_identifier, category, i, captions)
+        files = {}
+        for output_path in view_outputs[i]:
+            key, ext = store_member(output_path)
+            with open(output_path, 'rb') as f:
+                files[ext] = f.read()
+        files['json'] = json.dumps(metadata).encode('utf-8')
+        store.add_sample(key, files, model_identifier, category, i, int(metadata['angle']))
+        for output_path in view_outputs[i]:
+            os.remove(output_path)
+    if os.path.isdir(fp) and not os.listdir(fp):
+        os.rmdir(fp)
+
+def view_file_paths(args, model_identifier, fp):
+    # Paths of the files Blender writes, including the extension it appends
+    if args.animation:
+        output_path = turntable.video_path(fp, model_identifier, args.video_format)
+        if args.frame_range is not None:
+            first, last = turntable.parse_frame_range(args.frame_range)
+            return [turntable.segment_path(output_path, first, last, args.video_format)]
+        return [output_path]
+    stepsize = 360.0 / args.views
+    extension = render_manifest.FORMAT_EXTENSIONS.get(args.format, '.' + args.format.lower())
+    return [os.path.join(fp, model_identifier + '_r_{0:03d}'.format(int(i * stepsize))) + extension
+            for i in range(args.views)]
+
+def set_passes_output(args, rig, model_identifier, fp):
+    node = rig['passes_output']
+    if args.passes == 'exr':
+        # One multi-layer file per frame: <base_path><frame>.exr
+        node.base_path = os.path.join(fp, model_identifier + '_passes_')
+    else:
+        # One single-layer file per pass and frame, packed and removed after the render
+        node.base_path = fp
+        for slot, name in zip(node.file_slots, render_passes.PASS_NAMES):
+            slot.path = '{}_{}_'.format(model_identifier, name)
+
+def read_exr_pixels(path):
+    image = bpy.data.images.load(path)
+    image.colorspace_settings.name = 'Non-Color'
+    width, height = image.size
+    pixels = np.empty(width * height * 4, dtype=np.float32)
+    image.pixels.foreach_get(pixels)
+    bpy.data.images.remove(image)
+    # Blender stores the bottom row first
+    return pixels.reshape(height, width, 4)[::-1]
+
+def collect_passes(args, model_identifier, fp, views, view_paths):
+    # View i is rendered at frame i+1, in both the per-view and the batch mode
+    for i in views:
+        frame = '{0:04d}'.format(i + 1)
+        output_path = render_passes.passes_path(view_paths[i], args.passes)
+        if args.passes == 'exr':
+            os.replace(os.path.join(fp, model_identifier + '_passes_' + frame + '.exr'), output_path)
+            continue
+        frame_paths = {name: os.path.join(fp, '{}_{}_{}.exr'.format(model_identifier, name, frame))
+                       for name in render_passes.PASS_NAMES}
+        pixels = {name: read_exr_pixels(path) for name, path in frame_paths.items()}
+        render_passes.save_passes(output_path, render_passes.pack_passes(pixels))
+        for path in frame_paths.values():
+            os.remove(path)
+
+def render_views_batched(scene, cam_empty, model_identifier, fp, views, view_paths, num_views):
+    # Keyframe the camera rig once per view, frame i+1 showing view i
+    stepsize = 360.0 / num_views
+    cam_empty.animation_data_clear()
+    for i in range(num_views):
+        cam_empty.rotation_euler[2] = math.radians(stepsize * i)
+        cam_empty.keyframe_insert('rotation_euler', index=2, frame=i + 1)
+    for fcurve in cam_empty.animation_data.action.fcurves:
+        for keyframe in fcurve.keyframe_points:
+            keyframe.interpolation = 'CONSTANT'
+
+    # A single frame-range job for all the pending views, without saving the .blend
+    scene.frame_start = views[0] + 1
+    scene.frame_end = views[-1] + 1
+    scene.frame_step = 1
+    scene.render.filepath = os.path.join(fp, model_identifier + '_frame_')
+    print('rendering frames {}-{}...'.format(scene.frame_start, scene.frame_end))
+    # Time of every frame written, for the per-view stats
+    write_times = [time.time()]
+    def on_render_write(*_):
+        write_times.append(time.time())
+    bpy.app.handlers.render_write.append(on_render_write)
+    try:
+        bpy.ops.render.render(animation=True)
+    finally:
+        bpy.app.handlers.render_write.remove(on_render_write)
+
+    # Give the frames the same names as the views rendered one at a time
+    for i in range(views[0], views[-1] + 1):
+        os.replace(scene.render.frame_path(frame=i + 1), view_paths[i])
+    view_seconds = [t1 - t0 for t0, t1 in zip(write_times[:-1], write_times[1:])]
+    return list(range(views[0], views[-1] + 1)), view_seconds
+
+def set_video_output(scene, video_format):
+    settings = turntable.VIDEO_FORMATS[video_format]
+    image_settings = scene.render.image_settings
+    image_settings.file_format = settings['file_format']
+    if settings['file_format'] != 'FFMPEG':
+        return
+    ffmpeg = scene.render.ffmpeg
+    ffmpeg.format = settings['container']
+    ffmpeg.codec = settings['codec']
+    ffmpeg.audio_codec = 'NONE'
+    if settings['codec'] == 'H264':
+        ffmpeg.constant_rate_factor = 'MEDIUM'
+        ffmpeg.ffmpeg_preset = 'GOOD'
+        image_settings.color_mode = 'RGB'
+    else:
+        # VP9 and FFV1 keep the transparent background
+        image_settings.color_mode = 'RGBA'
+
+def setup_pack(args, rig):
+    '''
+    Adds one camera rig per packed model, copied from the one of the scene and shifted
+    along Z by PACK_SPACING, and renders each camera as a view of a multiview render.
+    The lights are suns without shadows, so every model is lit as if it were alone, and
+    the other models are far outside the field of view of its camera.
+    '''
+    scene = bpy.context.scene
+    render = scene.render
+    render.use_multiview = True
+    render.views_format = 'MULTIVIEW'
+    render.image_settings.views_format = 'INDIVIDUAL'
+    for view in render.views:
+        view.use = False
 
+    camera = rig['camera']
+    slots = []
+    for k in range(args.pack):
+        # The camera of a view is the one named as the scene camera, with the suffix of the view
+        suffix = '_s{}'.format(k)
+        view = render.views.new('slot' + suffix)
+        view.camera_suffix = suffix
+        view.use = True
+
+        cam_empty = bpy.data.objects.new('PackEmpty' + suffix, None)
+        cam_empty.location = (0, 0, k * PACK_SPACING)
+        scene.collection.objects.link(cam_empty)
+        cam = bpy.data.objects.new('PackCamera' + suffix, camera.data)
+        cam.location = camera.location
+        cam.parent = cam_empty
         cam_constraint = cam.constraints.new(type='TRACK_TO')
         cam_constraint.track_axis = 'TRACK_NEGATIVE_Z'
         cam_constraint.up_axis = 'UP_Y'
+        cam_constraint.target = cam_empty
+        scene.collection.objects.link(cam)
+        slots.append({'suffix': suffix, 'view': view, 'camera': cam, 'cam_empty': cam_empty, 'offset': k * PACK_SPACING})
+    scene.camera = slots[0]['camera']
+    return slots
 
-        cam_empty = bpy.data.objects.new("Empty", None)
-        cam_empty.location = (0, 0, 0)
-        cam.parent = cam_empty
+def pack_output_path(pack_path, slot, extension):
+    # Every view of a multiview still is written with its suffix before the extension,
+    # except when a single view is enabled, which is written as a plain still
+    path = pack_path + slot['suffix'] + extension
+    return path if os.path.exists(path) else pack_path + extension
 
-        scene.collection.objects.link(cam_empty)
-        context.view_layer.objects.active = cam_empty
-        cam_constraint.target = cam_empty
+def read_image_pixels(path):
+    image = bpy.data.images.load(path)
+    pixels = np.empty(len(image.pixels), dtype=np.float32)
+    image.pixels.foreach_get(pixels)
+    bpy.data.images.remove(image)
+    return pixels
 
-        stepsize = 360.0 / args.views
-        rotation_mode = 'XYZ'
+def check_pack_view(slots, models, i, check_path, extension):
+    '''
+    Renders view i of every packed model again with the other models hidden, and
+    compares it with the packed image, in 8 bit levels. Returns the render seconds
+    and the absolute differences of all the pixels.
+    '''
+    scene = bpy.context.scene
+    seconds = 0.0
+    diffs = []
+    scene.render.filepath = check_path
+    for k, model in enumerate(models):
+        for other in models:
+            other['object'].hide_render = other is not model
+        for j, slot in enumerate(slots):
+            slot['view'].use = j == k
+        start = time.time()
+        bpy.ops.render.render(write_still=True)
+        seconds += time.time() - start
+        solo_path = pack_output_path(check_path, slots[k], extension)
+        diffs.append(np.abs(read_image_pixels(solo_path) - read_image_pixels(model['view_paths'][i])) * 255)
+        os.remove(solo_path)
+    for model in models:
+        model['object'].hide_render = False
+    for j, slot in enumerate(slots):
+        slot['view'].use = j < len(models)
+    return seconds, np.concatenate(diffs)
 
-        if args.obj_path is not None:
-            model_identifier = os.path.splitext(os.path.basename(path))[0]
-            fp = os.path.join(os.path.abspath(args.output_folder), model_identifier)
-        else:
-            model_identifier = os.path.normpath(path).split(os.sep)[-3]
-            class_identifier = os.path.normpath(path).split(os.sep)[-4]
-            fp = os.path.join(os.path.abspath(args.output_folder), class_identifier, model_identifier)
+def render_pack(args, paths, rig, slots, manifest, manifest_file, store=None, captions=None, check=False):
+    '''
+    Renders up to len(slots) models with one render call per view, each model in its own
+    slot, and moves the image of every slot to the view file of its model. Returns the
+    status of every model. With check, every view is also rendered one model at a time
+    and compared with the packed one (see check_pack_view).
+    '''
+    scene = bpy.context.scene
+    statuses = {}
+    models = []
+    params = render_manifest.render_params(args)
+    for path in paths:
+        model_identifier, fp = model_output(args, path)
+        view_paths = view_file_paths(args, model_identifier, fp)
+        entry = manifest.get(path)
+        digest, stats = render_manifest.model_hash(path, entry)
+        exists = os.path.exists
+        if store is not None:
+            exists = lambda output_path: store.contains(*store_member(output_path))
+        if not args.force and not render_manifest.pending_views(entry, digest, params, [[p] for p in view_paths], exists):
+            print('skipping {}, already rendered'.format(model_identifier))
+            statuses[path] = 'skipped'
+            continue
+        entry = {'path': path, 'model': model_identifier, 'hash': digest, 'stats': stats, 'params': params, 'complete': False}
+        render_manifest.append_entry(manifest_file, entry)
+        models.append({'path': path, 'model': model_identifier, 'fp': fp, 'view_paths': view_paths, 'entry': entry})
+    if not models:
+        return statuses
+
+    timings = {}
+    for slot, model in zip(slots, models):
+        print('model identifier: ', model['model'])
+        obj = import_model(args, model['path'], model['model'], timings, rig['material_cache'])
+        model['faces'], model['vertices'] = len(obj.data.polygons), len(obj.data.vertices)
+        model['object'] = obj
+        obj.location[2] += slot['offset']
+    for k, slot in enumerate(slots):
+        slot['view'].use = k < len(models)
+
+    start = time.time()
+    stepsize = 360.0 / args.views
+    extension = render_manifest.FORMAT_EXTENSIONS.get(args.format, '.' + args.format.lower())
+    pack_path = os.path.join(os.path.abspath(args.output_folder), '.pack', 'pack')
+    pack_seconds, check_seconds, check_diffs = 0.0, 0.0, []
+    for i in range(args.views):
+        scene.frame_set(i + 1)
+        for slot in slots:
+            slot['cam_empty'].rotation_euler[2] = math.radians(stepsize * i)
+        scene.render.filepath = pack_path
+        render_start = time.time()
+        with render_stats.stage(timings, 'render'):
+            bpy.ops.render.render(write_still=True)
+        pack_seconds += time.time() - render_start
+        for slot, model in zip(slots, models):
+            os.makedirs(model['fp'], exist_ok=True)
+            os.replace(pack_output_path(pack_path, slot, extension), model['view_paths'][i])
+        if check:
+            seconds, diffs = check_pack_view(slots, models, i, pack_path + '_check', extension)
+            check_seconds += seconds
+            check_diffs.append(diffs)
+    elapsed = time.time() - start
+    print('pack of {} models: rendered {} views in {:.2f}s, {:.2f}s per model view'.format(
+        len(models), args.views, elapsed, elapsed / (args.views * len(models))))
+    if check:
+        # The other models of a pack are outside of the field of view of a camera, but not of its indirect rays
+        diffs = np.concatenate(check_diffs)
+        result = {
+            'type': 'pack_check',
+            'models': len(models),
+            'views': args.views,
+            'pack_seconds': pack_seconds,
+            'single_seconds': check_seconds,
+            'speedup': check_seconds / pack_seconds if pack_seconds > 0 else 0.0,
+            'max_diff': float(diffs.max()),
+            'mean_diff': float(diffs.mean()),
+            'differing_values': float(np.mean(diffs >= 0.5)),
+        }
+        print('pack check: render calls of {:.2f}s packed, {:.2f}s one model at a time ({:.2f}x), '
+              'pixel differences up to {:.1f} levels, {:.4f} on average, {:.2%} of the values differ'.format(
+                  pack_seconds, check_seconds, result['speedup'], result['max_diff'], result['mean_diff'],
+                  result['differing_values']))
+        if args.stats_log is not None:
+            render_stats.append_record(args.stats_log, result)
+
+    if store is not None:
+        with render_stats.stage(timings, 'store'):
+            for model in models:
+                store_views(args, rig, store, captions or {}, model['path'], model['model'], model['fp'],
+                            list(range(args.views)), [[p] for p in model['view_paths']])
+    with render_stats.stage(timings, 'cleanup'):
+        remove_models()
+    for model in models:
+        if args.stats_log is not None:
+            # The stages of the pack are shared by its models
+            render_stats.append_record(args.stats_log, {
+                'type': 'model',
+                'model': model['model'],
+                'path': model['path'],
+                'status': 'done',
+                'time': time.time(),
+                'views': args.views,
+                'pack': len(models),
+                'stages': {name: seconds / len(models) for name, seconds in timings.items()},
+                'faces': model['faces'],
+                'vertices': model['vertices'],
+                'rss_mb': render_stats.rss_mb(),
+                'peak_rss_mb': render_stats.peak_rss_mb(),
+                'bpy_data': bpy_data_counts(),
+            })
+        model['entry']['complete'] = True
+        render_manifest.append_entry(manifest_file, model['entry'])
+        statuses[model['path']] = 'done'
+    return statuses
 
-        print('model identifier: ', model_identifier)
-        if args.animation:
-            obj.rotation_mode = 'XYZ'
+def render_model(args, path, rig, manifest, manifest_file, store=None, captions=None):
+    scene = bpy.context.scene
+    cam_empty = rig['cam_empty']
+
+    timings = {}
+    model_identifier, fp = model_output(args, path)
+    view_paths = view_file_paths(args, model_identifier, fp)
+    outputs = [[path] for path in view_paths]
+    if args.passes is not None and not args.animation:
+        outputs = [[path, render_passes.passes_path(path, args.passes)] for path in view_paths]
+    params = render_manifest.render_params(args)
+    entry = manifest.get(path)
+    with render_stats.stage(timings, 'hash'):
+        digest, stats = render_manifest.model_hash(path, entry)
+    if args.force or args.frame_range is not None:
+        # The segments of a split animation are recorded by the coordinator once joined
+        views = list(range(len(view_paths)))
+    else:
+        exists = os.path.exists
+        if store is not None:
+            exists = lambda output_path: store.contains(*store_member(output_path))
+        views = render_manifest.pending_views(entry, digest, params, outputs, exists)
+    if not views:
+        print('skipping {}, already rendered'.format(model_identifier))
+        return 'skipped'
+
+    # Record the model before rendering, so that a crash leaves it incomplete and rendered again
+    entry = {'path': path, 'model': model_identifier, 'hash': digest, 'stats': stats, 'params': params, 'complete': False}
+    # Without a manifest file, e.g. for the render server, nothing is recorded
+    if args.frame_range is None and manifest_file is not None:
+        render_manifest.append_entry(manifest_file, entry)
+
+    print('model identifier: ', model_identifier)
+    obj = import_model(args, path, model_identifier, timings, rig['material_cache'])
+    num_faces, num_vertices = len(obj.data.polygons), len(obj.data.vertices)
+
+    view_stats = []
+    start = time.time()
+    if args.animation:
+        obj.rotation_mode = 'XYZ'
+        # A full turn every args.frames frames, at constant speed, so that the video loops
+        obj.rotation_euler = (math.radians(90), 0, 0)
+        obj.keyframe_insert('rotation_euler', index=-1 ,frame=1)
+        obj.rotation_euler = (math.radians(90), 0, math.radians(360))
+        obj.keyframe_insert('rotation_euler', index=-1 ,frame=args.frames + 1)
+        for fcurve in obj.animation_data.action.fcurves:
+            for keyframe in fcurve.keyframe_points:
+                keyframe.interpolation = 'LINEAR'
+
+        if args.frame_range is not None:
+            scene.frame_start, scene.frame_end = turntable.parse_frame_range(args.frame_range)
+        else:
             scene.frame_start = 1
-            scene.frame_end = args.frames
-            obj.rotation_euler = (math.radians(90), 0, 0)
-            obj.keyframe_insert('rotation_euler', index=-1 ,frame=scene.frame_start)
-            obj.rotation_euler = (math.radians(90), 0, math.radians(360))
-            obj.keyframe_insert('rotation_euler', index=-1 ,frame=scene.frame_end)
-
-            render_file_path = os.path.join(fp, model_identifier)
-            scene.render.filepath = render_file_path
-            scene.render.image_settings.file_format = "AVI_JPEG"
-            scene.render.film_transparent = True
+            scene.frame_end = turntable.rendered_frames(args.frames, args.frame_stride)[-1]
+        scene.frame_step = args.frame_stride
+        scene.render.fps_base = args.frame_stride
+        set_video_output(scene, args.video_format)
+        scene.render.filepath = os.path.join(fp, model_identifier + '_turntable_')
+        scene.render.film_transparent = True
+        with render_stats.stage(timings, 'render'):
             bpy.ops.render.render(write_still=False, animation=True)
-        else:
-            for i in range(0, args.views):
+        rendered_path = scene.render.frame_path(frame=scene.frame_start)
+        with render_stats.stage(timings, 'write'):
+            if args.frame_range is not None:
+                os.replace(rendered_path, view_paths[0])
+            else:
+                turntable.finish_video(rendered_path, view_paths[0], args.video_format)
+    elif args.batch_views:
+        if args.passes is not None:
+            set_passes_output(args, rig, model_identifier, fp)
+        with render_stats.stage(timings, 'render'):
+            rendered, view_seconds = render_views_batched(scene, cam_empty, model_identifier, fp, views, view_paths, args.views)
+        view_stats = [{'view': i, 'seconds': seconds} for i, seconds in zip(rendered, view_seconds)]
+        if args.passes is not None:
+            with render_stats.stage(timings, 'passes'):
+                collect_passes(args, model_identifier, fp, rendered, view_paths)
+    else:
+        stepsize = 360.0 / args.views
+        if args.passes is not None:
+            set_passes_output(args, rig, model_identifier, fp)
+        writer = rig['writer']
+        if writer is not None:
+            # Blender creates the folder when it writes the image itself
+            os.makedirs(fp, exist_ok=True)
+        try:
+            for i in views:
                 print("Rotation {}, {}".format((stepsize * i), math.radians(stepsize * i)))
+                # The frame numbers the files of the passes
+                scene.frame_set(i + 1)
+                cam_empty.rotation_euler[2] = math.radians(stepsize * i)
 
                 render_file_path = os.path.join(fp, model_identifier + '_r_{0:03d}'.format(int(i * stepsize)))
 
                 scene.render.filepath = render_file_path
                 print('render file path: ', render_file_path)
-                
+            
                 # Uncomment to get depth, normal, albedo, id
-                #depth_file_output.file_slots[0].path = render_file_path + "_depth"
-                #normal_file_output.file_slots[0].path = render_file_path + "_normal"
-                #albedo_file_output.file_slots[0].path = render_file_path + "_albedo"
-                #id_file_output.file_slots[0].path = render_file_path + "_id"
+                #rig['depth_output'].file_slots[0].path = render_file_path + "_depth"
+                #rig['normal_output'].file_slots[0].path = render_file_path + "_normal"
+                #rig['albedo_output'].file_slots[0].path = render_file_path + "_albedo"
+                #rig['id_output'].file_slots[0].path = render_file_path + "_id"
 
                 print('rendering...')
-                bpy.ops.render.render(write_still=True)  # render still
-                print('save')
-                bpy.ops.wm.save_mainfile()
-
-                cam_empty.rotation_euler[2] += math.radians(stepsize)
-        
-        # Delete the current mesh from the scene
-        for obj in bpy.context.scene.objects:
-            # If the object type is 'MESH', it is likely the imported mesh
-            if obj.type == 'MESH':
-                mesh_name = obj.name
-                break
-        bpy.data.objects[mesh_name].select_set(True)
-        bpy.ops.object.delete()
-        
-        # For debugging the workflow
-        #bpy.ops.wm.save_as_mainfile(filepath='debug.blend')
+                view_timings = {}
+                with render_stats.stage(view_timings, 'render'):
+                    bpy.ops.render.render(write_still=writer is None)  # render still
+                if writer is not None:
+                    with render_stats.stage(view_timings, 'readback'):
+                        viewer = bpy.data.images['Viewer Node']
+                        width, height = viewer.size
+                        pixels = np.empty(width * height * 4, dtype=np.float32)
+                        viewer.pixels.foreach_get(pixels)
+                    view_timings['write_wait'] = writer.submit(pixels, width, height, view_paths[i], args.color_depth)
+                if writer is None:
+                    # Not with the writer, whose point is not to stall the render loop between views
+                    print('save')
+                    with render_stats.stage(view_timings, 'save'):
+                        bpy.ops.wm.save_mainfile()
+                if args.passes is not None:
+                    with render_stats.stage(view_timings, 'passes'):
+                        collect_passes(args, model_identifier, fp, [i], view_paths)
+                for name, seconds in view_timings.items():
+                    timings[name] = timings.get(name, 0.0) + seconds
+                view_stats.append({'view': i, 'seconds': view_timings['render'], 'stages': view_timings})
+        finally:
+            if writer is not None:
+                # The images are complete before the store or the manifest refer to them
+                with render_stats.stage(timings, 'write_wait'):
+                    writer.wait()
+        if writer is not None:
+            print('write-behind, since the start: {} images, {:.1f} MB, {:.2f}s encoding in {} threads'.format(
+                writer.written, writer.bytes_written / 2**20, writer.encode_seconds, args.write_behind))
+
+    elapsed = time.time() - start
+    if not args.animation:
+        print('model {}: rendered {} views in {:.2f}s, {:.2f}s per view ({} mode, {} quality)'.format(
+            model_identifier, len(views), elapsed, elapsed / len(views), 'batch' if args.batch_views else 'per view',
+            args.quality or 'default'))
+    
+    if store is not None:
+        with render_stats.stage(timings, 'store'):
+            store_views(args, rig, store, captions or {}, path, model_identifier, fp, views, outputs)
+
+    # Delete the current mesh, and the data it leaves behind, from the scene
+    with render_stats.stage(timings, 'cleanup'):
+        remove_models()
+    data_counts = bpy_data_counts()
+    print('bpy.data: {}'.format(data_counts))
+
+    if args.stats_log is not None:
+        for view in view_stats:
+            render_stats.append_record(args.stats_log, dict(view, type='view', model=model_identifier))
+        render_stats.append_record(args.stats_log, {
+            'type': 'model',
+            'model': model_identifier,
+            'path': path,
+            'status': 'done',
+            'time': time.time(),
+            'views': len(views),
+            'stages': timings,
+            'faces': num_faces,
+            'vertices': num_vertices,
+            'bpy_data': data_counts,
+            'rss_mb': render_stats.rss_mb(),
+            'peak_rss_mb': render_stats.peak_rss_mb(),
+        })
+
+    # For debugging the workflow
+    #bpy.ops.wm.save_as_mainfile(filepath='debug.blend')
+
+    if args.frame_range is None and manifest_file is not None:
+        entry['complete'] = True
+        render_manifest.append_entry(manifest_file, entry)
+    return 'done'
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
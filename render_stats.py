@@ -0,0 +1,168 @@
+'''
+
+Instrumentation of the render loop: per-stage durations, mesh sizes, bpy.data block
+counts and process memory, appended as one JSONL record per model and per view.
+Run as a script to summarize a log into percentiles and the slowest models:
+
+python render_stats.py output_renders/render_stats.jsonl --top 20
+
+'''
+
+import argparse
+import json
+import os
+import resource
+import time
+from contextlib import contextmanager
+
+
+@contextmanager
+def stage(timings, name):
+    start = time.time()
+    try:
+        yield
+    finally:
+        timings[name] = timings.get(name, 0.0) + time.time() - start
+
+
+def rss_mb(pid='self'):
+    # Current resident set size of a process, from /proc when available
+    try:
+        with open('/proc/{}/statm'.format(pid)) as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except (OSError, ValueError, IndexError):
+        return peak_rss_mb() if pid == 'self' else 0.0
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+
+
+def append_record(path, record):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, 'a') as f:
+        f.write(json.dumps(record) + '\n')
+
+
+def read_records(path):
+    records = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                continue
+    return records
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    position = (len(values) - 1) * q / 100.0
+    low = int(position)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (position - low)
+
+
+def summarize(records, top=10):
+    models = [r for r in records if r.get('type') == 'model' and r.get('status') == 'done']
+    views = [r for r in records if r.get('type') == 'view']
+    failed = [r for r in records if r.get('type') == 'model' and r.get('status') == 'failed']
+
+    stage_names = sorted(set(name for r in models for name in r['stages']))
+    stages = {}
+    for name in stage_names + ['total']:
+        if name == 'total':
+            values = [sum(r['stages'].values()) for r in models]
+        else:
+            values = [r['stages'][name] for r in models if name in r['stages']]
+        stages[name] = {
+            'count': len(values),
+            'mean': sum(values) / len(values) if values else 0.0,
+            'p50': percentile(values, 50),
+            'p90': percentile(values, 90),
+            'p99': percentile(values, 99),
+            'max': max(values) if values else 0.0,
+        }
+
+    view_seconds = [r['seconds'] for r in views]
+    slowest = sorted(models, key=lambda r: sum(r['stages'].values()), reverse=True)[:top]
+    return {
+        'models': len(models),
+        'failed': len(failed),
+        'views': len(views),
+        'stages': stages,
+        'view_seconds': {
+            'p50': percentile(view_seconds, 50),
+            'p90': percentile(view_seconds, 90),
+            'p99': percentile(view_seconds, 99),
+        },
+        # A growing RSS or bpy.data from the first to the last model points at a leak
+        'rss_mb': {
+            'first': models[0]['rss_mb'] if models else 0.0,
+            'last': models[-1]['rss_mb'] if models else 0.0,
+            'peak': max((r['peak_rss_mb'] for r in models), default=0.0),
+        },
+        'bpy_data': {
+            'first': models[0].get('bpy_data', {}) if models else {},
+            'last': models[-1].get('bpy_data', {}) if models else {},
+        },
+        'slowest': [{
+            'model': r['model'],
+            'seconds': sum(r['stages'].values()),
+            'faces': r.get('faces'),
+            'stages': r['stages'],
+        } for r in slowest],
+    }
+
+
+def print_summary(summary):
+    print('models: {}, failed: {}, views: {}'.format(summary['models'], summary['failed'], summary['views']))
+    print('{:<16}{:>8}{:>10}{:>10}{:>10}{:>10}{:>10}'.format('stage', 'count', 'mean', 'p50', 'p90', 'p99', 'max'))
+    for name, s in summary['stages'].items():
+        print('{:<16}{:>8}{:>10.3f}{:>10.3f}{:>10.3f}{:>10.3f}{:>10.3f}'.format(
+            name, s['count'], s['mean'], s['p50'], s['p90'], s['p99'], s['max']))
+    v = summary['view_seconds']
+    print('seconds per view: p50 {:.3f}, p90 {:.3f}, p99 {:.3f}'.format(v['p50'], v['p90'], v['p99']))
+    r = summary['rss_mb']
+    print('RSS: first model {:.0f} MB, last model {:.0f} MB, peak {:.0f} MB'.format(r['first'], r['last'], r['peak']))
+    print('bpy.data: first model {}, last model {}'.format(summary['bpy_data']['first'], summary['bpy_data']['last']))
+    print('slowest models:')
+    for m in summary['slowest']:
+        stages = ', '.join('{} {:.2f}s'.format(name, seconds) for name, seconds in m['stages'].items())
+        print('  {} {:.2f}s, {} faces ({})'.format(m['model'], m['seconds'], m['faces'], stages))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Summarizes the stats logged by render_shapenet_obj.py --stats_log.')
+
+    parser.add_argument('stats_log', type=str,
+                        help='path to the JSONL stats log')
+
+    parser.add_argument('--top', type=int, default=10,
+                        help='number of slowest models to list')
+
+    parser.add_argument('--json', action="store_true",
+                        help='if set, print the summary as JSON')
+
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    args = parse_args()
+    summary = summarize(read_records(args.stats_log), args.top)
+    if args.json:
+        print(json.dumps(summary, indent=2))
+    else:
+        print_summary(summary)
+
+
+if __name__ == '__main__':
+    main()
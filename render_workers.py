@@ -0,0 +1,346 @@
+'''
+
+Coordinator for multi-process rendering: splits the list of OBJ paths into shards,
+starts one headless render_shapenet_obj.py worker per shard and merges their
+progress and failures into a single report.
+
+'''
+
+import json
+import os
+import subprocess
+import sys
+import time
+
+import caption_store
+import render_stats
+import turntable
+
+# Options owned by the coordinator, never forwarded to the workers
+COORDINATOR_OPTIONS = ['--workers', '--threads', '--paths_file', '--worker_report', '--frame_range',
+                       '--model_timeout', '--max_memory', '--retries', '--retry_max_faces']
+
+DEAD_LETTER_NAME = 'dead_letter.jsonl'
+
+
+def split_shards(paths, num_shards):
+    # Round-robin, so that every shard gets a mix of categories and model sizes
+    shards = [paths[i::num_shards] for i in range(num_shards)]
+    return [shard for shard in shards if shard]
+
+
+def strip_options(argv, options):
+    stripped = []
+    skip_next = False
+    for token in argv:
+        if skip_next:
+            skip_next = False
+            continue
+        name = token.split('=', 1)[0]
+        if name in options:
+            skip_next = '=' not in token
+            continue
+        stripped.append(token)
+    return stripped
+
+
+def thread_budget(num_workers, threads=0):
+    if threads > 0:
+        return threads
+    return max(1, (os.cpu_count() or 1) // num_workers)
+
+
+def read_progress(report_path):
+    records = []
+    if not os.path.exists(report_path):
+        return records
+    with open(report_path) as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                records.append(json.loads(line))
+    return records
+
+
+def append_progress(report_path, record):
+    # One short line per write, so concurrent readers never see a partial record
+    with open(report_path, 'a') as f:
+        f.write(json.dumps(record) + '\n')
+
+
+def launch_worker(worker_id, shard, work_dir, argv, threads, extra_argv=(), name=None, restart=False):
+    name = name or 'worker_{0:03d}'.format(worker_id)
+    paths_file = os.path.join(work_dir, name + '.txt')
+    report_path = os.path.join(work_dir, name + '.jsonl')
+    log_path = os.path.join(work_dir, name + '.log')
+    with open(paths_file, 'w') as f:
+        f.write('\n'.join(shard) + '\n')
+    # A restarted worker keeps the records and the log of the process it replaces
+    if os.path.exists(report_path) and not restart:
+        os.remove(report_path)
+
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'render_shapenet_obj.py')
+    cmd = [sys.executable, script] + argv + [
+        '--workers', '1',
+        '--threads', str(threads),
+        '--paths_file', paths_file,
+        '--worker_report', report_path,
+    ] + list(extra_argv)
+    log = open(log_path, 'a' if restart else 'w')
+    process = subprocess.Popen(cmd, stdout=log, stderr=subprocess.STDOUT)
+    return {
+        'id': worker_id,
+        'name': name,
+        'process': process,
+        'log': log,
+        'log_path': log_path,
+        'report_path': report_path,
+        'paths': shard,
+        'argv': argv + list(extra_argv),
+        'threads': threads,
+        'restarts': 0,
+        'finished': False,
+    }
+
+
+def current_model(records):
+    # Path and start time of the model the worker is rendering, if any
+    started = {}
+    for r in records:
+        if r['status'] == 'start':
+            started[r['path']] = r['time']
+        else:
+            started.pop(r['path'], None)
+    if not started:
+        return None, None
+    path = max(started, key=started.get)
+    return path, started[path]
+
+
+def check_worker(worker, records, model_timeout, max_memory):
+    '''
+    Returns why a running worker has to be stopped, or None: its current model takes
+    longer than model_timeout seconds, or the process uses more than max_memory MB.
+    '''
+    path, started = current_model(records)
+    if model_timeout > 0 and path is not None and time.time() - started > model_timeout:
+        return 'timeout after {:.0f}s'.format(time.time() - started)
+    if max_memory > 0:
+        rss = render_stats.rss_mb(worker['process'].pid)
+        if rss > max_memory:
+            return 'memory {:.0f} MB over the {} MB limit'.format(rss, max_memory)
+    return None
+
+
+def restart_worker(worker, work_dir, reason):
+    '''
+    Records the model the worker was rendering as failed, and starts a new process on
+    the models of the shard not rendered yet. Returns None if there is nothing to
+    restart, e.g. the worker died before starting its first model.
+    '''
+    worker['finished'] = True
+    records = read_progress(worker['report_path'])
+    path, _ = current_model(records)
+    if path is None:
+        return None
+    append_progress(worker['report_path'], {'path': path, 'status': 'failed', 'error': reason})
+    reported = set(r['path'] for r in records if r['status'] != 'start') | {path}
+    remaining = [p for p in worker['paths'] if p not in reported]
+    if not remaining:
+        return None
+    print('worker {}: {} on {}, restarting on {} models'.format(worker['id'], reason, path, len(remaining)))
+    worker['log'].close()
+    restarted = launch_worker(worker['id'], remaining, work_dir, worker['argv'], worker['threads'],
+                              name=worker['name'], restart=True)
+    restarted['paths'] = worker['paths']
+    restarted['restarts'] = worker['restarts'] + 1
+    return restarted
+
+
+def run_pass(args, paths, work_dir, argv, prefix, poll_interval):
+    shards = split_shards(paths, args.workers)
+    threads = thread_budget(len(shards), args.threads)
+    print('workers: {}, threads per worker: {}, models: {}'.format(len(shards), threads, len(paths)))
+
+    start = time.time()
+    workers = [launch_worker(i, shard, work_dir, argv, threads, name='{}worker_{:03d}'.format(prefix, i))
+               for i, shard in enumerate(shards)]
+
+    last_done = -1
+    while True:
+        for i, worker in enumerate(workers):
+            if worker['finished']:
+                continue
+            records = read_progress(worker['report_path'])
+            if worker['process'].poll() is None:
+                reason = check_worker(worker, records, args.model_timeout, args.max_memory)
+                if reason is None:
+                    continue
+                worker['process'].kill()
+                worker['process'].wait()
+            elif worker['process'].returncode == 0:
+                worker['finished'] = True
+                continue
+            else:
+                reason = 'worker exited with code {}'.format(worker['process'].returncode)
+            restarted = restart_worker(worker, work_dir, reason)
+            if restarted is not None:
+                workers[i] = restarted
+
+        running = [w for w in workers if not w['finished']]
+        records = [r for w in workers for r in read_progress(w['report_path'])]
+        done = sum(1 for r in records if r['status'] == 'done')
+        skipped = sum(1 for r in records if r['status'] == 'skipped')
+        failed = sum(1 for r in records if r['status'] == 'failed')
+        if done + skipped + failed != last_done:
+            last_done = done + skipped + failed
+            elapsed = time.time() - start
+            rate = done / elapsed if elapsed > 0 else 0.0
+            print('[{:.0f}s] rendered {}/{}, skipped {}, failed {}, {:.2f} models/s, {} workers running'.format(
+                elapsed, done, len(paths), skipped, failed, rate, len(running)))
+        if not running:
+            break
+        time.sleep(poll_interval)
+
+    return merge_reports(workers, time.time() - start)
+
+
+def degraded_options(args, attempt):
+    # Every retry halves the resolution and caps the number of faces
+    return ['--resolution', str(max(64, args.resolution // 2**attempt)),
+            '--max_faces', str(max(1000, args.retry_max_faces // attempt))]
+
+
+def append_dead_letters(output_folder, failures, attempt, options):
+    path = os.path.join(output_folder, DEAD_LETTER_NAME)
+    for failure in failures:
+        append_progress(path, {'path': failure['path'], 'error': failure.get('error'), 'attempt': attempt,
+                               'options': options, 'time': time.time()})
+    return path
+
+
+def run_coordinator(args, paths, poll_interval=5.0):
+    output_folder = os.path.abspath(args.output_folder)
+    work_dir = os.path.join(output_folder, '.workers')
+    os.makedirs(work_dir, exist_ok=True)
+    argv = strip_options(sys.argv[1:], COORDINATOR_OPTIONS)
+    if args.csv_path is not None:
+        # Built once here, rather than by every worker reading the captions at the same time
+        caption_store.ensure_index(args.csv_path)
+
+    report = run_pass(args, paths, work_dir, argv, '', poll_interval)
+    retry_failures(args, report, work_dir, argv, poll_interval)
+
+    report_path = os.path.join(output_folder, 'render_report.json')
+    with open(report_path, 'w') as f:
+        json.dump(report, f, indent=2)
+    print('rendered {} models, skipped {}, {} failures, in {:.0f}s ({:.2f}s per model). Report: {}'.format(
+        report['done'], report['skipped'], len(report['failures']), report['seconds'],
+        report['seconds_per_model'], report_path))
+    return report
+
+
+def retry_failures(args, report, work_dir=None, argv=None, poll_interval=5.0):
+    '''
+    Lists the failures of the report in the dead letter file, and renders the failed
+    models again in worker processes, --retries times with degraded settings. Also
+    used after a run without workers, whose failures are given as a report.
+    '''
+    output_folder = os.path.abspath(args.output_folder)
+    if work_dir is None:
+        work_dir = os.path.join(output_folder, '.workers')
+        os.makedirs(work_dir, exist_ok=True)
+    if argv is None:
+        argv = strip_options(sys.argv[1:], COORDINATOR_OPTIONS)
+    report['retried'] = 0
+    report['dead_letter'] = append_dead_letters(output_folder, report['failures'], 0, [])
+    for attempt in range(1, args.retries + 1):
+        failed = [f['path'] for f in report['failures']]
+        if not failed:
+            break
+        # Failed models are retried with cheaper settings, after all the others
+        options = degraded_options(args, attempt)
+        print('retrying {} failed models with {}'.format(len(failed), ' '.join(options)))
+        retry = run_pass(args, failed, work_dir, argv + options, 'retry{}_'.format(attempt), poll_interval)
+        append_dead_letters(output_folder, retry['failures'], attempt, options)
+        report['retried'] += len(failed)
+        report['done'] += retry['done']
+        report['skipped'] += retry['skipped']
+        report['failures'] = retry['failures']
+        report['seconds'] += retry['seconds']
+        report['model_seconds'].update(retry['model_seconds'])
+        report['workers'] += retry['workers']
+    return report
+
+
+def merge_reports(workers, seconds):
+    report = {'seconds': seconds, 'done': 0, 'skipped': 0, 'seconds_per_model': 0.0, 'failures': [], 'workers': [],
+              'model_seconds': {}}
+    model_seconds = []
+    for worker in workers:
+        if not worker['log'].closed:
+            worker['log'].close()
+        records = [r for r in read_progress(worker['report_path']) if r['status'] != 'start']
+        reported = set(r['path'] for r in records)
+        done = [r for r in records if r['status'] == 'done']
+        skipped = [r for r in records if r['status'] == 'skipped']
+        failures = [r for r in records if r['status'] == 'failed']
+
+        # Models the worker never got to, e.g. because the process crashed
+        returncode = worker['process'].returncode
+        for path in worker['paths']:
+            if path not in reported:
+                failures.append({'path': path, 'status': 'failed',
+                                 'error': 'worker {} exited with code {}'.format(worker['id'], returncode)})
+
+        model_seconds += [r['seconds'] for r in done if 'seconds' in r]
+        report['model_seconds'].update((r['path'], r['seconds']) for r in done if 'seconds' in r)
+        report['done'] += len(done)
+        report['skipped'] += len(skipped)
+        report['failures'] += failures
+        report['workers'].append({
+            'id': worker['id'],
+            'returncode': returncode,
+            'restarts': worker['restarts'],
+            'models': len(worker['paths']),
+            'done': len(done),
+            'skipped': len(skipped),
+            'failed': len(failures),
+            'log': worker['log_path'],
+        })
+    # Wall time of a single model inside its worker, to compare render modes
+    if model_seconds:
+        report['seconds_per_model'] = sum(model_seconds) / len(model_seconds)
+    return report
+
+
+def run_frame_split(args, path, output_path, poll_interval=1.0):
+    '''
+    Renders the turntable of a single model with one worker per frame range, and joins
+    the video segments they write. Returns False if a worker failed.
+    '''
+    work_dir = os.path.join(os.path.abspath(args.output_folder), '.workers')
+    os.makedirs(work_dir, exist_ok=True)
+
+    ranges = turntable.split_frame_ranges(args.frames, args.frame_stride, args.workers)
+    threads = thread_budget(len(ranges), args.threads)
+    argv = strip_options(sys.argv[1:], COORDINATOR_OPTIONS)
+    print('{}: frames {} split in {} ranges, threads per worker: {}'.format(
+        path, len(turntable.rendered_frames(args.frames, args.frame_stride)), len(ranges), threads))
+
+    start = time.time()
+    workers = [launch_worker(i, [path], work_dir, argv, threads, ['--frame_range', '{}:{}'.format(first, last)])
+               for i, (first, last) in enumerate(ranges)]
+    while any(w['process'].poll() is None for w in workers):
+        time.sleep(poll_interval)
+    for worker in workers:
+        worker['log'].close()
+
+    segments = [turntable.segment_path(output_path, first, last, args.video_format) for first, last in ranges]
+    missing = [w['log_path'] for w, segment in zip(workers, segments) if not os.path.exists(segment)]
+    if missing:
+        print('failed to render {}, see {}'.format(path, ', '.join(missing)))
+        return False
+    turntable.join_segments(segments, output_path, args.video_format)
+    print('rendered {} in {:.0f}s'.format(output_path, time.time() - start))
+    return True
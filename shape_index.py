@@ -0,0 +1,163 @@
+'''
+
+Index of the ShapeNet models to render. Instead of walking the whole category folders,
+the models are taken from the Text2Shape captions CSV, so that only the captioned ones
+are scheduled. The index (modelId, category, OBJ path, file size) is cached as JSON and
+rebuilt only when the CSV or the dataset root change.
+
+'''
+
+import json
+import os
+
+from caption_store import CaptionStore
+
+class_to_class_id = {
+    'Table': '04379243',
+    'Jar': '03593526',
+    'Skateboard': '04225987',
+    'Car': '02958343',
+    'Bottle': '02876657',
+    'Tower': '04460130',
+    'Chair': '03001627',
+    'Bookshelf': '02871439',
+    'Camera': '02942699',
+    'Airplane': '02691156',
+    'Laptop': '03642806',
+    'Basket': '02801938',
+    'Sofa': '04256520',
+    'Knife': '03624134',
+    'Can': '02946921',
+    'Rifle': '04090263',
+    'Train': '04468005',
+    'Pillow': '03938244',
+    'Lamp': '03636649',
+    'Trash bin': '02747177',
+    'Mailbox': '03710193',
+    'Watercraft': '04530566',
+    'Motorbike': '03790512',
+    'Dishwasher': '03207941',
+    'Bench': '02828884',
+    'Pistol': '03948459',
+    'Rocket': '04099429',
+    'Loudspeaker': '03691459',
+    'File cabinet': '03337140',
+    'Bag': '02773838',
+    'Cabinet': '02933112',
+    'Bed': '02818832',
+    'Birdhouse': '02843684',
+    'Display': '03211117',
+    'Piano': '03928116',
+    'Earphone': '03261776',
+    'Telephone': '04401088',
+    'Stove': '04330267',
+    'Microphone': '03759954',
+    'Bus': '02924116',
+    'Mug': '03797390',
+    'Remote': '04074963',
+    'Bathtub': '02808440',
+    'Bowl': '02880940',
+    'Keyboard': '03085013',
+    'Guitar': '03467517',
+    'Washer': '04554684',
+    'Bicycle': '02834778',
+    'Faucet': '03325088',
+    'Printer': '04004475',
+    'Cap': '02954340'
+}
+
+INDEX_VERSION = 1
+
+ORDERS = ['index', 'largest_first', 'smallest_first']
+
+
+def get_obj_paths(root_directory):
+    obj_paths = []
+    for dirpath, _, filenames in os.walk(root_directory):
+        for filename in filenames:
+            if filename.endswith(".obj"):
+                obj_paths.append(os.path.join(dirpath, filename))
+    return obj_paths
+
+
+def shapenet_obj_path(data_root, category, model_id):
+    return os.path.join(data_root, class_to_class_id[category], model_id, 'models', 'model_normalized.obj')
+
+
+def read_captioned_models(csv_path):
+    # modelId -> category, in order of first appearance in the CSV
+    store = CaptionStore(csv_path)
+    models = store.model_categories()
+    store.close()
+    return models
+
+
+def read_captions(csv_path):
+    # modelId -> list of its descriptions
+    store = CaptionStore(csv_path)
+    captions = store.captions()
+    store.close()
+    return captions
+
+
+def build_shape_index(data_root, csv_path):
+    entries = []
+    missing = 0
+    for model_id, category in read_captioned_models(csv_path).items():
+        if category not in class_to_class_id:
+            missing += 1
+            continue
+        path = shapenet_obj_path(data_root, category, model_id)
+        # One stat per captioned model, instead of listing every folder of the dataset
+        try:
+            size = os.stat(path).st_size
+        except OSError:
+            missing += 1
+            continue
+        entries.append({'model_id': model_id, 'category': category, 'path': path, 'size': size})
+    print('shape index: {} captioned models found, {} missing from {}'.format(len(entries), missing, data_root))
+    return entries
+
+
+def index_key(data_root, csv_path):
+    st = os.stat(csv_path)
+    return {
+        'version': INDEX_VERSION,
+        'data_root': os.path.abspath(data_root),
+        'csv_path': os.path.abspath(csv_path),
+        'csv_size': st.st_size,
+        'csv_mtime_ns': st.st_mtime_ns,
+    }
+
+
+def load_shape_index(index_path, data_root, csv_path):
+    key = index_key(data_root, csv_path)
+    if os.path.exists(index_path):
+        with open(index_path) as f:
+            cached = json.load(f)
+        if cached.get('key') == key:
+            return cached['entries']
+
+    entries = build_shape_index(data_root, csv_path)
+    os.makedirs(os.path.dirname(os.path.abspath(index_path)), exist_ok=True)
+    tmp_path = index_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump({'key': key, 'entries': entries}, f)
+    os.replace(tmp_path, index_path)
+    return entries
+
+
+def iter_shape_paths(entries, categories=None, order='index'):
+    '''
+    Yields the OBJ paths of the indexed models of the given categories. With
+    'largest_first' the biggest files come first, which balances the shards of the
+    workers, as the slowest models are spread among them and started early.
+    '''
+    if categories is not None:
+        entries = [e for e in entries if e['category'] in categories]
+    if order == 'largest_first':
+        entries = sorted(entries, key=lambda e: e['size'], reverse=True)
+    elif order == 'smallest_first':
+        entries = sorted(entries, key=lambda e: e['size'])
+    for entry in entries:
+        yield entry['path']
@@ -0,0 +1,172 @@
+'''
+
+Sharded output store: the rendered views are appended, with their camera metadata and
+the captions of the model, to sequential tar shards in the WebDataset layout
+(<key>.png, <key>.json, ... next to each other), instead of one small file each in a
+deep folder tree. An SQLite index records the shard, offset and size of every file, so
+that a single view can be read back by modelId and view angle without scanning the tars.
+
+Every writer process appends to its own shards, and only the index is shared.
+
+'''
+
+import io
+import json
+import os
+import sqlite3
+import tarfile
+import time
+
+INDEX_NAME = 'index.sqlite'
+
+SHARD_SIZE_MB = 1024
+
+INDEX_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS files (
+    key TEXT NOT NULL,
+    ext TEXT NOT NULL,
+    model_id TEXT NOT NULL,
+    category TEXT,
+    view INTEGER,
+    angle INTEGER,
+    shard TEXT NOT NULL,
+    offset INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    PRIMARY KEY (key, ext)
+);
+CREATE INDEX IF NOT EXISTS files_model ON files (model_id, angle);
+'''
+
+
+def open_index(store_dir):
+    os.makedirs(store_dir, exist_ok=True)
+    # Several workers commit to the same index, wait for the lock instead of failing
+    connection = sqlite3.connect(os.path.join(store_dir, INDEX_NAME), timeout=60)
+    connection.executescript(INDEX_SCHEMA)
+    return connection
+
+
+def alias_model(store_dir, model_id, alias_id, category=None):
+    # Indexes the files of a model a second time under another modelId, without copying them
+    index = open_index(store_dir)
+    with index:
+        index.execute('INSERT OR REPLACE INTO files '
+                      'SELECT replace(key, ?, ?), ext, ?, ?, view, angle, shard, offset, size FROM files WHERE model_id = ?',
+                      (model_id, alias_id, alias_id, category, model_id))
+    index.close()
+
+
+class ShardWriter:
+    '''
+    Appends samples to tar shards of at most shard_size_mb, starting a new shard when
+    the current one is full, and records every file in the index.
+    '''
+
+    def __init__(self, store_dir, shard_size_mb=SHARD_SIZE_MB):
+        self.store_dir = os.path.abspath(store_dir)
+        self.max_bytes = shard_size_mb * 2**20
+        self.index = open_index(self.store_dir)
+        # Unique per process, so that workers never write to the same shard
+        self.prefix = 'shard-{}-{}'.format(time.strftime('%Y%m%d%H%M%S'), os.getpid())
+        self.shard_count = 0
+        self.tar = None
+        self.shard_name = None
+
+    def _next_shard(self):
+        self.close_shard()
+        self.shard_name = '{}-{:05d}.tar'.format(self.prefix, self.shard_count)
+        self.shard_count += 1
+        self.tar = tarfile.open(os.path.join(self.store_dir, self.shard_name), 'w', format=tarfile.USTAR_FORMAT)
+
+    def add_sample(self, key, files, model_id, category=None, view=None, angle=None):
+        '''
+        Appends the files of a sample, a dict from extension (e.g. png, json) to bytes,
+        and indexes them under key.
+        '''
+        if self.tar is None or self.tar.offset >= self.max_bytes:
+            self._next_shard()
+        rows = []
+        for ext, data in files.items():
+            info = tarfile.TarInfo('{}.{}'.format(key, ext))
+            info.size = len(data)
+            info.mtime = int(time.time())
+            self.tar.addfile(info, io.BytesIO(data))
+            # The data ends at the current offset, padded to a whole 512 bytes block
+            offset = self.tar.offset - (len(data) + tarfile.BLOCKSIZE - 1) // tarfile.BLOCKSIZE * tarfile.BLOCKSIZE
+            rows.append((key, ext, model_id, category, view, angle, self.shard_name, offset, len(data)))
+        # The files are on disk before the index points at them
+        self.tar.fileobj.flush()
+        with self.index:
+            self.index.executemany('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+
+    def contains(self, key, ext):
+        row = self.index.execute('SELECT 1 FROM files WHERE key = ? AND ext = ?', (key, ext)).fetchone()
+        return row is not None
+
+    def close_shard(self):
+        if self.tar is not None:
+            self.tar.close()
+            self.tar = None
+
+    def close(self):
+        self.close_shard()
+        self.index.close()
+
+
+class ShardStore:
+    '''
+    Random access reader of a store written by ShardWriter.
+    '''
+
+    def __init__(self, store_dir):
+        self.store_dir = os.path.abspath(store_dir)
+        if not os.path.exists(os.path.join(self.store_dir, INDEX_NAME)):
+            raise FileNotFoundError('no {} in {}'.format(INDEX_NAME, self.store_dir))
+        self.index = sqlite3.connect(os.path.join(self.store_dir, INDEX_NAME), timeout=60)
+        self.shards = {}
+
+    def models(self, category=None):
+        if category is None:
+            rows = self.index.execute('SELECT DISTINCT model_id FROM files ORDER BY model_id')
+        else:
+            rows = self.index.execute('SELECT DISTINCT model_id FROM files WHERE category = ? ORDER BY model_id',
+                                      (category,))
+        return [row[0] for row in rows]
+
+    def views(self, model_id, ext='png'):
+        # (key, view, angle) of the views of a model, by angle
+        rows = self.index.execute('SELECT key, view, angle FROM files WHERE model_id = ? AND ext = ? ORDER BY angle',
+                                  (model_id, ext))
+        return rows.fetchall()
+
+    def contains(self, key, ext):
+        row = self.index.execute('SELECT 1 FROM files WHERE key = ? AND ext = ?', (key, ext)).fetchone()
+        return row is not None
+
+    def read(self, key, ext):
+        row = self.index.execute('SELECT shard, offset, size FROM files WHERE key = ? AND ext = ?',
+                                 (key, ext)).fetchone()
+        if row is None:
+            raise KeyError('{}.{}'.format(key, ext))
+        shard, offset, size = row
+        if shard not in self.shards:
+            self.shards[shard] = open(os.path.join(self.store_dir, shard), 'rb')
+        f = self.shards[shard]
+        f.seek(offset)
+        return f.read(size)
+
+    def read_view(self, model_id, angle, ext='png'):
+        row = self.index.execute('SELECT key FROM files WHERE model_id = ? AND angle = ? AND ext = ?',
+                                 (model_id, angle, ext)).fetchone()
+        if row is None:
+            raise KeyError('{} at {} degrees'.format(model_id, angle))
+        return self.read(row[0], ext)
+
+    def metadata(self, key):
+        return json.loads(self.read(key, 'json'))
+
+    def close(self):
+        for f in self.shards.values():
+            f.close()
+        self.shards = {}
+        self.index.close()
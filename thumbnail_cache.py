@@ -0,0 +1,246 @@
+'''
+
+Cache of downscaled copies of the rendered views, so that figures, contact sheets and
+galleries do not decode the full-resolution renders and downsample them again every
+time. Every view gets a pyramid of thumbnails (64, 128 and 256 pixels by default),
+built from a single decode of the view, and stored as PNG under a key made of the path,
+modification time and size of the view: a view rendered again gets new thumbnails.
+
+Thumbnails are built lazily, on the first request of a view, or in bulk by a pool of
+threads:
+
+python thumbnail_cache.py output_renders/ --threads 8
+
+The least recently used thumbnails are removed when the cache exceeds its size budget.
+The views in the cache and the size of their thumbnails are listed in an append-only
+log, entries.log, so that opening the cache does not walk it.
+
+'''
+
+import argparse
+import hashlib
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    # Without it, processes sharing the cache may lose a few entries of the log when evicting
+    fcntl = None
+
+from PIL import Image
+
+LEVELS = (64, 128, 256)
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'text2shape_thumbnails')
+
+DEFAULT_BUDGET_MB = 1024
+
+LOG_NAME = 'entries.log'
+
+
+class ThumbnailCache:
+    '''
+    Thumbnails of at most budget_mb in cache_dir, one folder per first two characters
+    of the key of the view, like the objects of git. Every line of the log is the key
+    of a view and the bytes of its thumbnails.
+    '''
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, budget_mb=DEFAULT_BUDGET_MB, levels=LEVELS):
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_bytes = budget_mb * 2**20
+        self.levels = tuple(sorted(levels))
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.built = 0
+        self.log_path = os.path.join(self.cache_dir, LOG_NAME)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        if not os.path.exists(self.log_path):
+            # A cache written before the log, walked once
+            with self.locked():
+                if not os.path.exists(self.log_path):
+                    self.write_log(self.scan())
+        self.total_bytes = sum(self.read_log().values())
+
+    @contextmanager
+    def locked(self):
+        # Between the threads of this process and, with fcntl, the other processes using the cache
+        with self.lock, open(os.path.join(self.cache_dir, '.lock'), 'a') as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            yield
+
+    def read_log(self):
+        # key -> bytes; a truncated last line, of a crashed process, is skipped
+        entries = {}
+        with open(self.log_path) as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) == 2 and line.endswith('\n'):
+                    entries[fields[0]] = int(fields[1])
+        return entries
+
+    def write_log(self, entries):
+        tmp_path = '{}.{}.tmp'.format(self.log_path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            f.writelines('{} {}\n'.format(key, size) for key, size in entries.items())
+        os.replace(tmp_path, self.log_path)
+
+    def key(self, source):
+        st = os.stat(source)
+        description = '{}|{}|{}'.format(os.path.abspath(source), st.st_mtime_ns, st.st_size)
+        return hashlib.sha1(description.encode('utf-8')).hexdigest()
+
+    def level_path(self, key, level):
+        return os.path.join(self.cache_dir, key[:2], '{}_{}.png'.format(key[2:], level))
+
+    def level_for(self, size):
+        # The smallest level at least as large as size, None when the view itself is needed
+        for level in self.levels:
+            if level >= size:
+                return level
+        return None
+
+    def build(self, source, key):
+        # All the levels of a view from one decode, each one downscaled from the next larger
+        image = Image.open(source)
+        image.load()
+        written = 0
+        for level in reversed(self.levels):
+            if max(image.size) > level:
+                scale = level / max(image.size)
+                size = (max(1, round(image.size[0] * scale)), max(1, round(image.size[1] * scale)))
+                image = image.resize(size, Image.LANCZOS, reducing_gap=2.0)
+            path = self.level_path(key, level)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Written next to its final path, then renamed, as several processes may share the cache
+            tmp_path = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+            image.save(tmp_path, 'PNG', compress_level=1)
+            os.replace(tmp_path, path)
+            written += os.path.getsize(path)
+        with self.locked():
+            with open(self.log_path, 'a') as f:
+                f.write('{} {}\n'.format(key, written))
+            self.built += 1
+            self.total_bytes += written
+        if self.total_bytes > self.max_bytes:
+            self.evict()
+
+    def thumbnail_path(self, source, size):
+        '''
+        Returns the path of the smallest thumbnail of the view at least size pixels
+        large, built if missing, or the view itself if no level is large enough.
+        '''
+        level = self.level_for(size)
+        if level is None:
+            return source
+        key = self.key(source)
+        path = self.level_path(key, level)
+        try:
+            # The modification time of a thumbnail is its last use
+            os.utime(path)
+            with self.lock:
+                self.hits += 1
+        except FileNotFoundError:
+            self.build(source, key)
+        return path
+
+    def open(self, source, size):
+        return Image.open(self.thumbnail_path(source, size))
+
+    def warm(self, sources, threads=8):
+        '''
+        Builds the missing thumbnails of the views with a pool of threads. Returns the
+        number of views whose thumbnails were built.
+        '''
+        def build_missing(source):
+            key = self.key(source)
+            if all(os.path.exists(self.level_path(key, level)) for level in self.levels):
+                return 0
+            self.build(source, key)
+            return 1
+        with ThreadPoolExecutor(threads) as pool:
+            return sum(pool.map(build_missing, sources))
+
+    def scan(self):
+        # key -> bytes of the thumbnails found in the folders of the cache
+        entries = {}
+        for folder in os.scandir(self.cache_dir):
+            if not folder.is_dir():
+                continue
+            for entry in os.scandir(folder.path):
+                if entry.name.endswith('.png'):
+                    key = folder.name + entry.name.rsplit('_', 1)[0]
+                    entries[key] = entries.get(key, 0) + entry.stat().st_size
+        return entries
+
+    def last_use(self, key):
+        # The thumbnail of a view used last, 0 when they are all gone
+        times = [0.0]
+        for level in self.levels:
+            try:
+                times.append(os.stat(self.level_path(key, level)).st_mtime)
+            except FileNotFoundError:
+                pass
+        return max(times)
+
+    def evict(self):
+        # Removes the thumbnails of the least recently used views down to 90% of the budget
+        with self.locked():
+            entries = self.read_log()
+            total = sum(entries.values())
+            for _, key in sorted((self.last_use(key), key) for key in entries):
+                if total <= 0.9 * self.max_bytes:
+                    break
+                for level in self.levels:
+                    try:
+                        os.remove(self.level_path(key, level))
+                    except FileNotFoundError:
+                        pass
+                total -= entries.pop(key)
+            self.write_log(entries)
+            self.total_bytes = total
+
+
+def find_views(renders_folder):
+    views = []
+    for dirpath, _, filenames in os.walk(renders_folder):
+        views += [os.path.join(dirpath, name) for name in sorted(filenames) if name.endswith('.png')]
+    return views
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Builds the thumbnails of all the rendered views.')
+
+    parser.add_argument('renders_folder', type=str,
+                        help='folder of the renderings, searched recursively for PNG views')
+
+    parser.add_argument('--cache_dir', type=str, default=DEFAULT_CACHE_DIR,
+                        help='folder of the thumbnails')
+
+    parser.add_argument('--budget', type=int, default=DEFAULT_BUDGET_MB,
+                        help='size of the cache in MB, the least recently used thumbnails are removed beyond it')
+
+    parser.add_argument('--threads', type=int, default=8,
+                        help='number of threads building the thumbnails')
+
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    args = parse_args()
+    cache = ThumbnailCache(args.cache_dir, args.budget)
+    views = find_views(args.renders_folder)
+    start = time.time()
+    built = cache.warm(views, args.threads)
+    elapsed = time.time() - start
+    print('{} views, thumbnails built for {} in {:.2f}s, cache size {:.1f} MB'.format(
+        len(views), built, elapsed, cache.total_bytes / 2**20))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+'''
+
+Turntable videos: output formats, split of the frame range between worker processes,
+and the ffmpeg steps joining the segments rendered by the workers. Blender encodes the
+frames directly to the video file, no image per frame is written. Animated WebP, which
+Blender can not write, is encoded by ffmpeg from a lossless FFV1 video.
+Nothing here depends on bpy.
+
+'''
+
+import os
+import shutil
+import subprocess
+import tempfile
+
+# Blender output of every format: FFmpeg container and codec, and extension of the rendered file
+VIDEO_FORMATS = {
+    'avi': {'file_format': 'AVI_JPEG', 'extension': '.avi'},
+    'mp4': {'file_format': 'FFMPEG', 'container': 'MPEG4', 'codec': 'H264', 'extension': '.mp4'},
+    'webm': {'file_format': 'FFMPEG', 'container': 'WEBM', 'codec': 'WEBM', 'extension': '.webm'},
+    'webp': {'file_format': 'FFMPEG', 'container': 'MKV', 'codec': 'FFV1', 'extension': '.mkv'},
+}
+
+VIDEO_EXTENSIONS = {'avi': '.avi', 'mp4': '.mp4', 'webm': '.webm', 'webp': '.webp'}
+
+
+def video_path(fp, model_identifier, video_format):
+    return os.path.join(fp, model_identifier + '_turntable' + VIDEO_EXTENSIONS[video_format])
+
+
+def segment_path(output_path, first, last, video_format):
+    return '{}_{:04d}-{:04d}{}'.format(os.path.splitext(output_path)[0], first, last,
+                                      VIDEO_FORMATS[video_format]['extension'])
+
+
+def parse_frame_range(value):
+    first, last = value.split(':')
+    return int(first), int(last)
+
+
+def rendered_frames(num_frames, stride):
+    return list(range(1, num_frames + 1, stride))
+
+
+def split_frame_ranges(num_frames, stride, num_parts):
+    '''
+    Splits the frames of the turntable (1 to num_frames, every stride frames) into at
+    most num_parts contiguous ranges (first, last) of about the same length.
+    '''
+    frames = rendered_frames(num_frames, stride)
+    num_parts = max(1, min(num_parts, len(frames)))
+    size, extra = divmod(len(frames), num_parts)
+    ranges = []
+    start = 0
+    for i in range(num_parts):
+        end = start + size + (1 if i < extra else 0)
+        ranges.append((frames[start], frames[end - 1]))
+        start = end
+    return ranges
+
+
+def find_ffmpeg():
+    ffmpeg = shutil.which('ffmpeg')
+    if ffmpeg is None:
+        raise RuntimeError('ffmpeg not found, it is required to join frame ranges and to encode WebP')
+    return ffmpeg
+
+
+def concat_videos(segment_paths, output_path):
+    # The segments share codec and settings, so they are joined without decoding them
+    with tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False) as f:
+        for path in segment_paths:
+            f.write("file '{}'\n".format(os.path.abspath(path).replace("'", "'\\''")))
+        list_path = f.name
+    try:
+        subprocess.run([find_ffmpeg(), '-y', '-loglevel', 'error', '-f', 'concat', '-safe', '0',
+                        '-i', list_path, '-c', 'copy', output_path], check=True)
+    finally:
+        os.remove(list_path)
+
+
+def encode_webp(input_path, output_path, quality=80):
+    subprocess.run([find_ffmpeg(), '-y', '-loglevel', 'error', '-i', input_path,
+                    '-c:v', 'libwebp', '-quality', str(quality), '-loop', '0', '-an', output_path], check=True)
+
+
+def finish_video(rendered_path, output_path, video_format):
+    # Moves the video written by Blender to its final name, encoding it first if needed
+    if video_format == 'webp':
+        encode_webp(rendered_path, output_path)
+        os.remove(rendered_path)
+    else:
+        os.replace(rendered_path, output_path)
+
+
+def join_segments(segment_paths, output_path, video_format):
+    if len(segment_paths) == 1:
+        finish_video(segment_paths[0], output_path, video_format)
+        return
+    joined_path = os.path.splitext(output_path)[0] + '_joined' + VIDEO_FORMATS[video_format]['extension']
+    concat_videos(segment_paths, joined_path)
+    for path in segment_paths:
+        os.remove(path)
+    finish_video(joined_path, output_path, video_format)
@@ -54,6 +54,7 @@ def set_engine_params(
     ids_cuda_devices: List[int] = [],
     use_adaptive_sampling: bool = False,
     use_denoiser: bool = True,
+    denoiser: str = "OPENIMAGEDENOISE",
 ) -> None:
     """Set Engine properties.
 
@@ -62,7 +63,8 @@ def set_engine_params(
         num_samples: The number of samples to render for cycles. Defaults to 4096.
         ids_cuda_devices: Ids to use for rendering, if empty use all the availabe devices. Defaults to [].
         use_adaptive_sampling: If True use adaptive sampling. Defaults to False.
-        use_denoiser: If True use optix denoiser. Defaults to True.
+        use_denoiser: If True use the denoiser. Defaults to True.
+        denoiser: The denoiser, OPENIMAGEDENOISE runs on CPU, OPTIX needs NVIDIA GPUs. Defaults to OPENIMAGEDENOISE.
 
     Raises:
         ValueError: if adaptive sampling is False and the number of samples is zero.
@@ -106,11 +108,60 @@ def set_engine_params(
 
     if use_denoiser:
         scene.cycles.use_denoising = True
-        scene.cycles.denoiser = "OPTIX"
+        scene.cycles.denoiser = denoiser
 
     print(f"Devices for rendering: {devices_enable}")
 
 
+QUALITY_PRESETS = {
+    "draft": {"samples": 16, "adaptive_threshold": 0.1, "max_bounces": 2, "tile_size": 64},
+    "preview": {"samples": 64, "adaptive_threshold": 0.05, "max_bounces": 4, "tile_size": 128},
+    "final": {"samples": 256, "adaptive_threshold": 0.01, "max_bounces": 8, "tile_size": 256},
+}
+
+
+def set_quality_preset(scene: bpy.types.Scene, preset: str, num_threads: int = 0) -> None:
+    """Set Cycles samples, adaptive sampling, light bounces, threads and tile size for CPU rendering.
+
+    The noise left by the low sample counts is removed with OpenImageDenoise, which runs on CPU.
+
+    Args:
+        scene: the scene to render.
+        preset: one of the keys of QUALITY_PRESETS (draft, preview or final).
+        num_threads: the number of render threads, if zero use all the cores. Defaults to 0.
+
+    Raises:
+        ValueError: if the preset does not exist.
+    """
+    if preset not in QUALITY_PRESETS:
+        raise ValueError(f"Unknown quality preset {preset}, choose one of {list(QUALITY_PRESETS)}.")
+    params = QUALITY_PRESETS[preset]
+
+    scene.cycles.device = "CPU"
+    scene.cycles.samples = params["samples"]
+    scene.cycles.use_adaptive_sampling = True
+    scene.cycles.adaptive_threshold = params["adaptive_threshold"]
+
+    scene.cycles.max_bounces = params["max_bounces"]
+    scene.cycles.diffuse_bounces = min(params["max_bounces"], 4)
+    scene.cycles.glossy_bounces = min(params["max_bounces"], 4)
+    scene.cycles.transmission_bounces = params["max_bounces"]
+    scene.cycles.transparent_max_bounces = params["max_bounces"]
+
+    scene.cycles.use_auto_tile = True
+    scene.cycles.tile_size = params["tile_size"]
+
+    if num_threads > 0:
+        scene.render.threads_mode = "FIXED"
+        scene.render.threads = num_threads
+    else:
+        scene.render.threads_mode = "AUTO"
+
+    scene.view_layers[0].cycles.use_denoising = True
+    scene.cycles.use_denoising = True
+    scene.cycles.denoiser = "OPENIMAGEDENOISE"
+
+
 def add_track_to_constraint(
     camera_object: bpy.types.Object, track_to_target_object: bpy.types.Object
 ) -> None:
@@ -445,3 +496,74 @@ def voxels_to_cube(
     bpy.context.collection.objects.link(obj)
     focus_target = obj
     return focus_target
+
+
+def create_obj_material(mtl: dict) -> bpy.types.Material:
+    """Create a Principled BSDF material from a material parsed from an MTL file.
+
+    Args:
+        mtl: the material, with keys name, Kd, d and map_Kd (path of the diffuse texture or None).
+
+    Returns:
+        The new material.
+    """
+    material = create_material(mtl["name"], use_nodes=True)
+    nodes = material.node_tree.nodes
+    principled_node = nodes["Principled BSDF"]
+    principled_node.inputs["Base Color"].default_value = (*mtl["Kd"], 1.0)
+    principled_node.inputs["Alpha"].default_value = mtl["d"]
+    if mtl["d"] < 1.0:
+        material.blend_method = "BLEND"
+
+    if mtl["map_Kd"] is not None and Path(mtl["map_Kd"]).exists():
+        texture_node = nodes.new(type="ShaderNodeTexImage")
+        texture_node.image = bpy.data.images.load(mtl["map_Kd"], check_existing=True)
+        material.node_tree.links.new(texture_node.outputs["Color"], principled_node.inputs["Base Color"])
+
+    return material
+
+
+def create_mesh_object(name: str, mesh_arrays: dict) -> bpy.types.Object:
+    """Create a mesh object from triangle arrays with bulk foreach_set calls.
+
+    Args:
+        name: the name of the object and of its mesh.
+        mesh_arrays: the arrays of the mesh, as returned by mesh_io.load_mesh: vertices (V, 3),
+            faces (F, 3), uvs (T, 2), face_uvs (F, 3), material_index (F,), smooth (F,) and the
+            list of materials.
+
+    Returns:
+        The new object, linked to the scene collection.
+    """
+    vertices = mesh_arrays["vertices"]
+    faces = mesh_arrays["faces"]
+    num_faces = len(faces)
+
+    mesh = bpy.data.meshes.new(name)
+    mesh.vertices.add(len(vertices))
+    mesh.vertices.foreach_set("co", vertices.astype(np.float32).ravel())
+    mesh.loops.add(num_faces * 3)
+    mesh.loops.foreach_set("vertex_index", faces.astype(np.int32).ravel())
+    mesh.polygons.add(num_faces)
+    mesh.polygons.foreach_set("loop_start", np.arange(0, num_faces * 3, 3, dtype=np.int32))
+    mesh.polygons.foreach_set("loop_total", np.full(num_faces, 3, dtype=np.int32))
+    mesh.polygons.foreach_set("use_smooth", mesh_arrays["smooth"].astype(bool))
+    mesh.polygons.foreach_set("material_index", mesh_arrays["material_index"].astype(np.int32))
+
+    face_uvs = mesh_arrays["face_uvs"]
+    if len(mesh_arrays["uvs"]) and (face_uvs >= 0).any():
+        loop_uvs = mesh_arrays["uvs"][np.maximum(face_uvs, 0)].reshape(-1, 2)
+        loop_uvs[face_uvs.ravel() < 0] = 0.0
+        uv_layer = mesh.uv_layers.new(name="UVMap")
+        uv_layer.data.foreach_set("uv", loop_uvs.astype(np.float32).ravel())
+
+    mesh.update(calc_edges=True)
+    mesh.validate()
+
+    for mtl in mesh_arrays["materials"]:
+        mesh.materials.append(create_obj_material(mtl))
+
+    obj = bpy.data.objects.new(name, mesh)
+    bpy.context.scene.collection.objects.link(obj)
+
+    return obj